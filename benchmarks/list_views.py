@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of loading a page of posts for list views: ORM objects versus read model rows
+"""
+import gc
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any, Optional
+
+import click
+from sqlalchemy.orm import defer, joinedload, selectinload
+
+from flaskr import create_app
+from flaskr.models import Post, db
+from flaskr.readmodel import list_posts, load_post_counts
+from flaskr.seed import seed_database
+
+
+def load_with_orm(limit: int) -> list[tuple[Any, ...]]:
+    """
+    Loads a page of posts as ORM objects, the way list views used to, and reads the fields they
+    show.
+
+    Args:
+        limit: Number of posts to load.
+
+    Returns:
+        The fields list views show, for each post.
+    """
+    posts = (
+        Post.query.options(
+            joinedload("author"),
+            joinedload("stats"),
+            selectinload("tags"),
+            defer("body"),
+        )
+        .order_by(Post.created.desc(), Post.id.desc())
+        .limit(limit)
+        .all()
+    )
+
+    return [
+        (
+            post.id,
+            post.title,
+            post.excerpt,
+            post.created,
+            post.author.username,
+            post.stats.views if post.stats else 0,
+            [tag.name for tag in post.tags],
+        )
+        for post in posts
+    ]
+
+
+def load_with_read_model(limit: int) -> list[tuple[Any, ...]]:
+    """
+    Loads a page of posts as read model rows, along with their counts, and reads the fields list
+    views show.
+
+    Args:
+        limit: Number of posts to load.
+
+    Returns:
+        The fields list views show, for each post.
+    """
+    rows = list_posts(limit)
+    counts = load_post_counts([row.id for row in rows])
+
+    return [
+        (
+            row.id,
+            row.title,
+            row.excerpt,
+            row.created,
+            row.author_username,
+            counts.get(row.id, (0, 0))[0],
+            row.tags,
+        )
+        for row in rows
+    ]
+
+
+def measure(
+    load: Callable[[int], list[tuple[Any, ...]]], limit: int, repeat: int
+) -> tuple[float, int]:
+    """
+    Times a loader, and measures its peak memory use in a separate run.
+
+    Args:
+        load: Loader to measure.
+        limit: Number of posts to load per run.
+        repeat: Number of timed runs. The fastest one counts.
+
+    Returns:
+        Rows per second and peak memory use in bytes.
+    """
+    best = float("inf")
+
+    for _ in range(repeat):
+        db.session.remove()
+        gc.collect()
+
+        started = time.perf_counter()
+        rows = load(limit)
+        best = min(best, time.perf_counter() - started)
+
+        assert len(rows) == limit
+
+    db.session.remove()
+    gc.collect()
+
+    tracemalloc.start()
+
+    try:
+        load(limit)
+
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return limit / best, peak
+
+
+@click.command()
+@click.option(
+    "--posts", default=10_000, show_default=True, help="Number of posts per page."
+)
+@click.option(
+    "--repeat", default=5, show_default=True, help="Number of timed runs per loader."
+)
+@click.option(
+    "--database-uri",
+    default=None,
+    help="Database to run against. Defaults to a throwaway SQLite database. The benchmark "
+    "creates tables and posts in it.",
+)
+def main(posts: int, repeat: int, database_uri: Optional[str]) -> None:
+    """
+    Compares loading a page of posts as ORM objects and as read model rows.
+
+    Args:
+        posts: Number of posts per page.
+        repeat: Number of timed runs per loader.
+        database_uri: Database to run against.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": database_uri
+                or f"sqlite:///{Path(directory) / 'bench.sqlite'}",
+                "FRONT_PAGE_REBUILD_DELAY": None,
+                "COUNTER_FLUSH_INTERVAL": None,
+            }
+        )
+
+        with app.app_context():
+            db.create_all()
+
+            seed_database(users=max(posts // 100, 1), posts=posts)
+
+            click.echo(f"{'loader':<12}{'rows/sec':>14}{'peak memory':>16}")
+
+            for name, load in (
+                ("ORM", load_with_orm),
+                ("read model", load_with_read_model),
+            ):
+                rows_per_second, peak = measure(load, posts, repeat)
+
+                click.echo(
+                    f"{name:<12}{rows_per_second:>14,.0f}{peak / 2**20:>13.1f} MiB"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,9 +8,22 @@ from typing import Any, Mapping, Optional
 import dotenv
 from flask import Flask
 
+from .api import bp as api_bp
+from .attachments import bp as attachments_bp, init_app as init_attachments
 from .auth import bp as auth_bp
 from .blog import bp as blog_bp
+from .comments import bp as comments_bp
+from .counters import init_app as init_counters
+from .feeds import bp as feeds_bp, init_app as init_feeds
+from .frontpage import init_app as init_front_page
+from .invalidation import init_app as init_invalidation
+from .jobs import init_app as init_jobs
+from .limiter import init_app as init_limiter
+from .live import init_app as init_live
 from .models import init_app
+from .querycache import init_app as init_query_cache
+from .seed import init_app as init_seed
+from .tracing import init_app as init_tracing, trace_views
 
 
 dotenv_file = dotenv.find_dotenv()
@@ -35,6 +48,12 @@ def create_app(test_config: Optional[Mapping[str, Any]] = None) -> Flask:
         os.environ.get("sqlalchemy_track_modifications", "False").lower() == "true"
     )
 
+    post_partitioning = os.environ.get("POST_PARTITIONING", "False").lower() == "true"
+
+    post_partition_retention_months = os.environ.get("POST_PARTITION_RETENTION_MONTHS")
+
+    metrics_enabled = os.environ.get("METRICS_ENABLED", "False").lower() == "true"
+
     sqlalchemy_database_uri = (
         f"postgresql://{os.environ['POSTGRES_USER']}:"
         f"{os.environ['POSTGRES_PASSWORD']}@{os.environ['POSTGRES_HOST']}:"
@@ -43,8 +62,61 @@ def create_app(test_config: Optional[Mapping[str, Any]] = None) -> Flask:
 
     app.config.from_mapping(
         SECRET_KEY=os.environ["SECRET_KEY"],
+        APPLICATION_ROOT=os.environ.get("APPLICATION_ROOT") or "/",
         SQLALCHEMY_DATABASE_URI=sqlalchemy_database_uri,
         SQLALCHEMY_TRACK_MODIFICATIONS=sqlalchemy_track_modifications,
+        POST_PARTITIONING=post_partitioning,
+        POST_PARTITION_PREMAKE_MONTHS=int(
+            os.environ.get("POST_PARTITION_PREMAKE_MONTHS", "3")
+        ),
+        POST_PARTITION_RETENTION_MONTHS=int(post_partition_retention_months)
+        if post_partition_retention_months
+        else None,
+        POSTS_PER_PAGE=20,
+        FRONT_PAGE_REBUILD_DELAY=0.5,
+        FRONT_PAGE_REBUILD_RETRY_DELAY=5,
+        JOB_LEASE_SECONDS=300,
+        JOB_MAX_ATTEMPTS=5,
+        JOB_RETRY_BACKOFF_SECONDS=2,
+        JOB_RETRY_BACKOFF_MAX_SECONDS=3600,
+        JOB_WORKER_BACKOFF_SECONDS=1,
+        JOB_WORKER_BACKOFF_MAX_SECONDS=60,
+        JOB_FAILED_RETENTION_DAYS=30,
+        JOB_CLEANUP_INTERVAL_SECONDS=3600,
+        INVALIDATION_RECONNECT_DELAY=5,
+        QUERY_CACHE_REGIONS={
+            "post_lists": {"ttl": 30, "max_size": 500},
+            "post_counts": {"ttl": 5, "max_size": 500},
+            "posts": {"ttl": 300, "max_size": 1000},
+            "users": {"ttl": 300, "max_size": 1000},
+        },
+        LIVE_HISTORY_SIZE=1000,
+        LIVE_MAX_PENDING_EVENTS=100,
+        LIVE_HEARTBEAT_SECONDS=15,
+        FEED_SIZE=20,
+        FEED_CACHE_SIZE=1000,
+        FEED_MAX_AGE=60,
+        COUNTER_FLUSH_INTERVAL=float(os.environ.get("COUNTER_FLUSH_INTERVAL", "5")),
+        COUNTER_MAX_PENDING_POSTS=10000,
+        LIMITER_INITIAL_LIMIT=20,
+        LIMITER_MIN_LIMIT=2,
+        LIMITER_MAX_LIMIT=200,
+        LIMITER_LATENCY_TARGET=0.5,
+        LIMITER_BACKOFF=0.9,
+        LIMITER_RETRY_AFTER=1,
+        LIMITER_PRIORITY_SHARES={"anonymous_read": 0.7, "read": 0.85, "write": 1.0},
+        LIMITER_SLOW_ENDPOINTS=("attachments.upload", "auth.login", "auth.register"),
+        METRICS_ENABLED=metrics_enabled,
+        TRACING_EXPORTER=os.environ.get("TRACING_EXPORTER") or None,
+        TRACING_FILE=os.environ.get("TRACING_FILE", "traces.jsonl"),
+        TRACING_SAMPLE_RATE=float(os.environ.get("TRACING_SAMPLE_RATE", "0.01")),
+        TRACING_BATCH_SIZE=512,
+        TRACING_EXPORT_INTERVAL=5,
+        TRACING_MAX_QUEUE_SIZE=10000,
+        ATTACHMENT_STORAGE=None,
+        ATTACHMENT_ROOT=os.environ.get("ATTACHMENT_ROOT") or None,
+        ATTACHMENT_MAX_SIZE=10 * 1024 * 1024,
+        ATTACHMENT_MAX_AGE=365 * 24 * 60 * 60,
     )
 
     if test_config:
@@ -57,11 +129,32 @@ def create_app(test_config: Optional[Mapping[str, Any]] = None) -> Flask:
     except OSError:
         pass
 
+    init_limiter(app)
+    init_tracing(app)
     init_app(app)
+    init_invalidation(app)
+    init_query_cache(app)
+    init_front_page(app)
+    init_jobs(app)
+    init_live(app)
+    init_feeds(app)
+    init_counters(app)
+    init_seed(app)
+    init_attachments(app)
 
     app.register_blueprint(auth_bp)
 
     app.register_blueprint(blog_bp)
     app.add_url_rule("/", endpoint="index")
 
+    app.register_blueprint(comments_bp)
+
+    app.register_blueprint(attachments_bp)
+
+    app.register_blueprint(feeds_bp)
+
+    app.register_blueprint(api_bp)
+
+    trace_views(app, "auth", "blog")
+
     return app
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+JSON API, served from the read model
+"""
+from typing import Any
+
+from flask import Blueprint, abort, current_app, jsonify, request
+from sqlalchemy import select
+from werkzeug import Response
+
+from flaskr.blog import get_before_cursor
+from flaskr.models import Tag, db
+from flaskr.readmodel import PostRow, list_posts, load_post_counts
+
+
+bp = Blueprint("api", __name__, url_prefix="/api")
+
+
+def post_to_json(post: PostRow) -> dict[str, Any]:
+    """
+    Converts a post row to its JSON representation.
+
+    Args:
+        post: Post to convert.
+
+    Returns:
+        JSON serializable post.
+    """
+    return {
+        **post._asdict(),
+        "created": post.created.isoformat(),
+        "tags": list(post.tags),
+    }
+
+
+def counts_to_json(counts: tuple[int, int]) -> dict[str, int]:
+    """
+    Converts the view and like counts of a post to their JSON representation.
+
+    Args:
+        counts: Views and likes of the post.
+
+    Returns:
+        JSON serializable counts.
+    """
+    views, likes = counts
+
+    return {"views": views, "likes": likes}
+
+
+@bp.route("/posts")
+def list_posts_view() -> Response:
+    """
+    Lists posts, newest first, a page at a time. Takes the same before cursor as the index, and
+    optionally the name of a tag to filter by.
+
+    Returns:
+        JSON response with the posts and the cursor of the next page, if there is one.
+    """
+    per_page = current_app.config["POSTS_PER_PAGE"]
+
+    tag_id = None
+    tag_name = request.args.get("tag")
+
+    if tag_name is not None:
+        tag_id = db.session.execute(
+            select(Tag.id).where(Tag.name == tag_name)
+        ).scalar_one_or_none()
+
+        if tag_id is None:
+            abort(404)
+
+    posts = list_posts(per_page + 1, get_before_cursor(), tag_id)
+    counts = load_post_counts([post.id for post in posts[:per_page]])
+
+    return jsonify(
+        posts=[
+            {**post_to_json(post), **counts_to_json(counts.get(post.id, (0, 0)))}
+            for post in posts[:per_page]
+        ],
+        next=posts[per_page - 1].cursor.encode() if len(posts) > per_page else None,
+    )
@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+"""
+Code to handle files attached to posts: streamed uploads, pluggable storage and range-aware
+downloads
+"""
+import hashlib
+import mimetypes
+import os
+import tempfile
+import uuid
+from typing import IO, Optional, Protocol, cast
+
+from flask import (
+    Blueprint,
+    Flask,
+    abort,
+    current_app,
+    flash,
+    g,
+    redirect,
+    request,
+    send_file,
+    url_for,
+)
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from werkzeug import Response
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import parse_form_data
+from werkzeug.utils import secure_filename
+
+from flaskr.auth import login_required
+from flaskr.invalidation import publish
+from flaskr.jobs import job_handler
+from flaskr.models import Attachment, Post, db
+from flaskr.readmodel import get_attachment
+
+
+# Room for the multipart headers and other fields around the file, on top of the file size cap.
+FORM_OVERHEAD = 64 * 1024
+
+bp = Blueprint("attachments", __name__)
+
+
+class StorageBackend(Protocol):
+    """
+    Where attachment contents are kept. Uploads are staged as local files first, so that their
+    size and checksum are known before they are handed to the backend.
+    """
+
+    staging_dir: str
+
+    def save(self, key: str, staged_path: str) -> None:
+        """
+        Stores a staged upload, taking ownership of the staged file.
+
+        Args:
+            key: Storage key of the attachment.
+            staged_path: Path of the staged upload.
+        """
+
+    def delete(self, key: str) -> None:
+        """
+        Removes a stored file, if it exists.
+
+        Args:
+            key: Storage key of the attachment.
+        """
+
+    def serve(
+        self, key: str, mimetype: str, download_name: str, etag: str, inline: bool
+    ) -> Response:
+        """
+        Builds the response for a download of a stored file, honouring Range and conditional
+        request headers.
+
+        Args:
+            key: Storage key of the attachment.
+            mimetype: Content type to serve the file with.
+            download_name: Name to offer the file under.
+            etag: Entity tag of the file.
+            inline: Whether the file may be shown in the browser rather than downloaded.
+
+        Returns:
+            The response.
+        """
+
+
+class LocalStorage:
+    """
+    Keeps attachments as files under a directory on the local filesystem. Downloads are served
+    from the file itself, which lets the WSGI server use sendfile (or X-Sendfile, with
+    USE_X_SENDFILE) for whole files.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.staging_dir = os.path.join(root, "staging")
+
+    def path(self, key: str) -> str:
+        """
+        Gets the path a file is stored at. Files are spread over subdirectories by the start of
+        their key, to keep directories small.
+
+        Args:
+            key: Storage key of the attachment.
+
+        Returns:
+            Path of the file.
+        """
+        return os.path.join(self.root, key[:2], key)
+
+    def save(self, key: str, staged_path: str) -> None:
+        """
+        Moves a staged upload into place. Staging happens on the same filesystem, so this is a
+        rename rather than a copy.
+
+        Args:
+            key: Storage key of the attachment.
+            staged_path: Path of the staged upload.
+        """
+        path = self.path(key)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(staged_path, path)
+
+    def delete(self, key: str) -> None:
+        """
+        Removes a stored file, if it exists.
+
+        Args:
+            key: Storage key of the attachment.
+        """
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def serve(
+        self, key: str, mimetype: str, download_name: str, etag: str, inline: bool
+    ) -> Response:
+        """
+        Builds the response for a download of a stored file, honouring Range and conditional
+        request headers.
+
+        Args:
+            key: Storage key of the attachment.
+            mimetype: Content type to serve the file with.
+            download_name: Name to offer the file under.
+            etag: Entity tag of the file.
+            inline: Whether the file may be shown in the browser rather than downloaded.
+
+        Returns:
+            The response.
+        """
+        try:
+            response = send_file(
+                self.path(key),
+                mimetype=mimetype,
+                as_attachment=not inline,
+                download_name=download_name,
+                conditional=True,
+                etag=etag,
+                max_age=current_app.config["ATTACHMENT_MAX_AGE"],
+            )
+        except FileNotFoundError:
+            # The attachment's row is there, but its file went missing, e.g. it was removed by
+            # hand or the row was restored from a backup.
+            abort(404)
+
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        # Werkzeug only says so when answering a Range request; say it up front so that clients
+        # know they can resume.
+        response.headers.setdefault("Accept-Ranges", "bytes")
+
+        return cast(Response, response)
+
+
+class StagedUpload:
+    """
+    File the form parser streams an upload into, chunk by chunk. Counts and hashes the chunks as
+    they are written, and stops the upload as soon as it goes over the size cap.
+    """
+
+    def __init__(self, directory: str, max_size: int) -> None:
+        os.makedirs(directory, exist_ok=True)
+
+        self._file = tempfile.NamedTemporaryFile(dir=directory, delete=False)
+        self._sha256 = hashlib.sha256()
+        self._max_size = max_size
+        self.path = self._file.name
+        self.size = 0
+
+    @property
+    def sha256(self) -> str:
+        """
+        Checksum of what was written so far.
+
+        Returns:
+            Hex digest.
+        """
+        return self._sha256.hexdigest()
+
+    def write(self, data: bytes) -> int:
+        """
+        Writes a chunk of the upload.
+
+        Args:
+            data: Chunk to write.
+
+        Returns:
+            Number of bytes written.
+        """
+        self.size += len(data)
+
+        if self.size > self._max_size:
+            raise RequestEntityTooLarge()
+
+        self._sha256.update(data)
+
+        return self._file.write(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        """
+        Moves the file position.
+
+        Args:
+            offset: Position to move to, relative to whence.
+            whence: What the offset is relative to.
+
+        Returns:
+            The new position.
+        """
+        return self._file.seek(offset, whence)
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads from the staged file.
+
+        Args:
+            size: Maximum number of bytes to read, or -1 for the rest of the file.
+
+        Returns:
+            Bytes read.
+        """
+        return self._file.read(size)
+
+    def close(self) -> None:
+        """
+        Closes the staged file, keeping it on disk.
+        """
+        self._file.close()
+
+    def discard(self) -> None:
+        """
+        Closes the staged file and removes it, unless it was moved into storage.
+        """
+        self.close()
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def attachment_storage() -> StorageBackend:
+    """
+    Gets the attachment storage of the current app.
+
+    Returns:
+        The app's attachment storage.
+    """
+    return cast(StorageBackend, current_app.extensions["attachment_storage"])
+
+
+def guess_content_type(filename: str) -> str:
+    """
+    Guesses the content type of a file from its name. The type the client sent is not trusted,
+    since it decides how the file is served.
+
+    Args:
+        filename: Name of the file.
+
+    Returns:
+        Content type.
+    """
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def get_post_attachment_keys(post_id: int) -> list[str]:
+    """
+    Lists the storage keys of a post's attachments, e.g. to remove their files once the post is
+    deleted.
+
+    Args:
+        post_id: ID of the post.
+
+    Returns:
+        Storage keys of the post's attachments.
+    """
+    return list(
+        db.session.execute(
+            select(Attachment.storage_key).where(Attachment.post_id == post_id)
+        ).scalars()
+    )
+
+
+def delete_post_attachments(post_id: int) -> None:
+    """
+    Deletes the attachments of a deleted post in the current transaction. Only needed when posts
+    are partitioned, since attachments otherwise go with their post through ON DELETE CASCADE.
+    The stored files are left in place, to be removed with remove_stored_files once the
+    transaction commits.
+
+    Args:
+        post_id: ID of the post.
+    """
+    db.session.execute(
+        delete(Attachment)
+        .where(Attachment.post_id == post_id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+@job_handler("attachments.remove_stored_files")
+def remove_stored_files(keys: list[str]) -> None:
+    """
+    Removes the stored files of deleted attachments. Runs as a job enqueued along with the delete,
+    so that files are only removed once the delete is committed, and removals that fail are
+    retried.
+
+    Args:
+        keys: Storage keys of the attachments.
+    """
+    storage = attachment_storage()
+
+    for key in keys:
+        storage.delete(key)
+
+
+@bp.route("/<int:post_id>/attachments", methods=("POST",))
+@login_required
+def upload(post_id: int) -> Response:
+    """
+    Allows a user to attach a file to one of their posts. The file is streamed to disk as it comes
+    in, rather than read into memory, and rejected as soon as it goes over the size cap.
+
+    Args:
+        post_id: ID of the post to attach the file to.
+
+    Returns:
+        Redirect to the post.
+    """
+    author_id = db.session.execute(
+        select(Post.author_id).where(Post.id == post_id)
+    ).scalar_one_or_none()
+
+    if author_id is None:
+        abort(404)
+
+    if author_id != g.user.id:
+        abort(403)
+
+    # Ends the read transaction, so that no connection is held while the upload streams in.
+    db.session.commit()
+
+    storage = attachment_storage()
+    max_size = current_app.config["ATTACHMENT_MAX_SIZE"]
+
+    staged: list[StagedUpload] = []
+
+    def stream_factory(
+        total_content_length: Optional[int],
+        content_type: Optional[str],
+        filename: Optional[str],
+        content_length: Optional[int] = None,
+    ) -> IO[bytes]:
+        """
+        Stages each file in the form as it is parsed.
+
+        Args:
+            total_content_length: Length of the whole request body, if known.
+            content_type: Content type of the file.
+            filename: Name of the file.
+            content_length: Length of the file, if known.
+
+        Returns:
+            File to stream the upload into.
+        """
+        upload = StagedUpload(storage.staging_dir, max_size)
+        staged.append(upload)
+
+        # Only the file methods the parser uses are implemented.
+        return cast(IO[bytes], upload)
+
+    try:
+        _, _, files = parse_form_data(
+            request.environ,
+            stream_factory=stream_factory,
+            max_content_length=max_size + FORM_OVERHEAD,
+        )
+
+        file = files.get("file")
+
+        if file is None or not file.filename:
+            flash("Choose a file to attach.")
+
+            return redirect(url_for("blog.update", post_id=post_id))
+
+        attach_file(post_id, file.filename, cast(StagedUpload, file.stream))
+    finally:
+        for upload in staged:
+            upload.discard()
+
+    return redirect(url_for("blog.detail", post_id=post_id))
+
+
+def attach_file(post_id: int, filename: str, upload: StagedUpload) -> Attachment:
+    """
+    Moves a staged upload into storage and records it as an attachment of a post. If recording it
+    fails, the stored file is removed again.
+
+    Args:
+        post_id: ID of the post.
+        filename: Name the file was uploaded under.
+        upload: Staged upload.
+
+    Returns:
+        The new attachment.
+    """
+    upload.close()
+
+    filename = secure_filename(filename) or "attachment"
+    key = uuid.uuid4().hex
+
+    storage = attachment_storage()
+    storage.save(key, upload.path)
+
+    attachment = Attachment(
+        post_id=post_id,
+        filename=filename,
+        content_type=guess_content_type(filename),
+        size=upload.size,
+        sha256=upload.sha256,
+        storage_key=key,
+    )
+
+    db.session.add(attachment)
+
+    publish("post", post_id, "attached")
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # The post was deleted while the file was uploading.
+        db.session.rollback()
+        storage.delete(key)
+
+        abort(404)
+    except Exception:
+        db.session.rollback()
+        storage.delete(key)
+
+        raise
+
+    return attachment
+
+
+@bp.route("/attachments/<int:attachment_id>/<path:filename>")
+def download(attachment_id: int, filename: str) -> Response:
+    """
+    Serves an attachment. Images that are safe to show are served inline, anything else as a
+    download. Supports Range requests and conditional requests on the file's checksum.
+
+    Args:
+        attachment_id: ID of the attachment.
+        filename: Name of the attachment, only there to give the URL a readable end.
+
+    Returns:
+        The file.
+    """
+    attachment = get_attachment(attachment_id)
+
+    if attachment is None:
+        abort(404)
+
+    return attachment_storage().serve(
+        attachment.storage_key,
+        mimetype=attachment.content_type,
+        download_name=attachment.filename,
+        etag=attachment.sha256,
+        inline=attachment.inline,
+    )
+
+
+def init_app(app: Flask) -> None:
+    """
+    Sets up the attachment storage for the app. ATTACHMENT_STORAGE can hold any storage backend
+    object; by default files are kept under ATTACHMENT_ROOT, or the instance folder.
+
+    Args:
+        app (): Flask app instance
+    """
+    storage: Optional[StorageBackend] = app.config["ATTACHMENT_STORAGE"]
+
+    if storage is None:
+        storage = LocalStorage(
+            app.config["ATTACHMENT_ROOT"]
+            or os.path.join(app.instance_path, "attachments")
+        )
+
+    app.extensions["attachment_storage"] = storage
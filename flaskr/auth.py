@@ -3,7 +3,8 @@
 Code to handle auth in the project
 """
 import functools
-from typing import Callable, TypeVar, cast
+from collections.abc import Hashable
+from typing import Callable, NamedTuple, Optional, TypeVar, Union, cast
 
 from flask import (
     Blueprint,
@@ -15,16 +16,38 @@ from flask import (
     session,
     url_for,
 )
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 from werkzeug import Response
 
-from flaskr.models import User, db
+from flaskr.invalidation import publish
+from flaskr.models import User, check_password, db
+from flaskr.querycache import query_cache
 from flaskr.types import ViewResponseType
 
 
 bp = Blueprint("auth", __name__, url_prefix="/auth")
 
 
+class CurrentUser(NamedTuple):
+    """
+    The logged-in user, as kept in the global context and the user cache region.
+    """
+
+    id: int
+    username: str
+
+
+class LoginUser(NamedTuple):
+    """
+    What logging in needs to know about a user.
+    """
+
+    id: int
+    username: str
+    password_hash: str
+
+
 @bp.route("/register", methods=("GET", "POST"))
 def register() -> ViewResponseType:
     """
@@ -51,10 +74,14 @@ def register() -> ViewResponseType:
             db.session.add(user)
 
             try:
-                db.session.commit()
+                db.session.flush()
             except IntegrityError:
                 error = f"User {username} is already registered."
             else:
+                publish("user", user.id, "created")
+
+                db.session.commit()
+
                 return redirect(url_for("auth.login"))
 
         flash(error)
@@ -75,21 +102,16 @@ def login() -> ViewResponseType:
         username = request.form["username"]
         password = request.form["password"]
 
-        error = None
-
-        user = User.query.filter_by(username=username).first()
+        user = find_login_user(username)
 
-        if user is None or not user.check_password(password):
-            error = "Incorrect credentials."
-
-        if error is None:
+        if user is not None and check_password(user.password_hash, password):
             session.clear()
 
             session["user_id"] = user.id
 
             return redirect(url_for("index"))
 
-        flash(error)
+        flash("Incorrect credentials.")
 
     return render_template("auth/login.html")
 
@@ -98,13 +120,63 @@ def login() -> ViewResponseType:
 def load_logged_in_user() -> None:
     """
     Grabs the user ID from the session and attempts to load the user into the global context.
+    Users are looked up in the users cache region first, and only loaded from the DB on a miss.
     """
     user_id = session.get("user_id")
 
     if user_id is None:
         g.user = None
     else:
-        g.user = User.query.get(user_id)
+        g.user = load_user(user_id)
+
+
+def find_login_user(username: str) -> Optional[LoginUser]:
+    """
+    Looks up a user by username through the users cache region.
+
+    Args:
+        username: Username to look up.
+
+    Returns:
+        The user, or None if there is no such user.
+    """
+
+    def load() -> Optional[LoginUser]:
+        row = db.session.execute(
+            select(User.id, User.username, User._password).where(
+                User.username == username
+            )
+        ).first()
+
+        return None if row is None else LoginUser(*row)
+
+    def tags(user: Optional[LoginUser]) -> list[Hashable]:
+        return [] if user is None else [("user", user.id)]
+
+    return query_cache("users").get_or_load(("username", username), load, tags=tags)
+
+
+def load_user(user_id: int) -> Optional[CurrentUser]:
+    """
+    Loads a user through the users cache region.
+
+    Args:
+        user_id: ID of the user to load.
+
+    Returns:
+        The user, or None if there is no such user.
+    """
+
+    def load() -> Optional[CurrentUser]:
+        row = db.session.execute(
+            select(User.id, User.username).where(User.id == user_id)
+        ).first()
+
+        return None if row is None else CurrentUser(*row)
+
+    return query_cache("users").get_or_load(
+        ("id", user_id), load, tags=[("user", user_id)]
+    )
 
 
 @bp.route("/logout")
@@ -120,7 +192,8 @@ def logout() -> Response:
     return redirect(url_for("index"))
 
 
-F = TypeVar("F", bound=Callable[..., ViewResponseType])
+# Views that only ever redirect are annotated with werkzeug's Response.
+F = TypeVar("F", bound=Callable[..., Union[ViewResponseType, Response]])
 
 
 def login_required(view: F) -> F:
@@ -136,7 +209,7 @@ def login_required(view: F) -> F:
     """
 
     @functools.wraps(view)
-    def wrapped_view(**kwargs: int) -> ViewResponseType:
+    def wrapped_view(**kwargs: int) -> Union[ViewResponseType, Response]:
         """
         Checks if the user is logged in. If so, calls view with kwargs, otherwise, redirects to the
         login page.
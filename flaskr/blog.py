@@ -2,38 +2,244 @@
 """
 Code to handle blog and posts
 """
+from datetime import datetime
+from http import HTTPStatus
+from typing import Any, Optional, cast
+
 from flask import (
     Blueprint,
     abort,
+    current_app,
     flash,
     g,
+    make_response,
     redirect,
     render_template,
     request,
+    session,
     url_for,
 )
-from sqlalchemy.orm import joinedload
+from sqlalchemy import delete as sql_delete, func, select, update as sql_update
+from sqlalchemy.orm import defer, joinedload, selectinload
+from sqlalchemy.sql.dml import UpdateBase
 from werkzeug import Response
 
+from flaskr.attachments import delete_post_attachments, get_post_attachment_keys
 from flaskr.auth import login_required
-from flaskr.models import Post, db
+from flaskr.comments import delete_post_comments, load_comments
+from flaskr.counters import post_counters
+from flaskr.feeds import record_post_deletion
+from flaskr.frontpage import (
+    front_page_snapshot,
+    load_page_counts,
+    render_posts_page,
+)
+from flaskr.invalidation import publish
+from flaskr.jobs import enqueue
+from flaskr.live import change_stream, stream_events
+from flaskr.models import (
+    Post,
+    PostCursor,
+    Tag,
+    db,
+    derive_body_columns,
+    post_partitioning_enabled,
+)
+from flaskr.querycache import query_cache
+from flaskr.readmodel import EditablePostRow, get_editable_post, load_attachments
+from flaskr.tags import (
+    adjust_post_counts,
+    get_post_tag_ids,
+    parse_tags,
+    set_post_tags,
+)
 from flaskr.types import ViewResponseType
 
 
 bp = Blueprint("blog", __name__)
 
+TAGS_PER_PAGE = 100
+MAX_REMEMBERED_LIKES = 100
+
+
+def get_before_cursor() -> Optional[PostCursor]:
+    """
+    Reads the cursor of the page to show from the query string, aborting if it is invalid.
+
+    Returns:
+        The cursor, or None if the first page was requested.
+    """
+    before = request.args.get("before")
+
+    if before is None:
+        return None
+
+    cursor = PostCursor.decode(before)
+
+    if cursor is None:
+        abort(400)
+
+    return cursor
+
 
 @bp.route("/")
 def index() -> str:
     """
-    Generates the template with the existing posts.
+    Generates the template with the existing posts. The first page comes from the front page
+    snapshot, and anonymous users without pending messages get the snapshot's HTML as is, unless
+    the counts it shows changed.
 
     Returns:
         index template.
     """
-    posts = Post.query.options(joinedload("author"))
+    cursor = get_before_cursor()
+
+    if cursor is not None:
+        page = render_posts_page(cursor)
+
+        return render_template(
+            "blog/index.html", page=page, counts=load_page_counts(page)
+        )
+
+    front_page = front_page_snapshot().get()
+    counts = load_page_counts(front_page.page)
+
+    if g.user is not None or "_flashes" in session:
+        return render_template("blog/index.html", page=front_page.page, counts=counts)
+
+    anonymous_html = front_page.anonymous_html
+
+    if anonymous_html is None or anonymous_html[0] != counts:
+        anonymous_html = front_page.anonymous_html = (
+            counts,
+            render_template("blog/index.html", page=front_page.page, counts=counts),
+        )
+
+    return anonymous_html[1]
+
+
+@bp.route("/<int:post_id>")
+def detail(post_id: int) -> str:
+    """
+    Shows a single post in full.
+
+    Args:
+        post_id: ID of the post to show.
+
+    Returns:
+        post template.
+    """
+    post = Post.query.options(
+        joinedload("author"), joinedload("stats"), selectinload("tags"), defer("body")
+    ).get_or_404(post_id)
+
+    comments = load_comments([post.id]).get(post.id, [])
+    attachments = load_attachments([post.id]).get(post.id, ())
+
+    counters = post_counters()
+    counters.increment(post.id, "views")
+
+    # Counts this process hasn't flushed yet are added in, so viewers see their own view and like.
+    counts = counters.pending(post.id)
+
+    if post.stats is not None:
+        counts.update(views=post.stats.views, likes=post.stats.likes)
+
+    return render_template(
+        "blog/detail.html",
+        post=post,
+        comments=comments,
+        attachments=attachments,
+        counts=counts,
+    )
+
+
+@bp.route("/<int:post_id>/like", methods=("POST",))
+@login_required
+def like(post_id: int) -> Response:
+    """
+    Allows a user to like a post. Likes are counted once per post per session.
 
-    return render_template("blog/index.html", posts=posts)
+    Args:
+        post_id: ID of the post to like.
+
+    Returns:
+        Redirect to the post.
+    """
+    if db.session.execute(select(Post.id).where(Post.id == post_id)).first() is None:
+        abort(404)
+
+    liked_posts = session.get("liked_posts", [])
+
+    if post_id not in liked_posts:
+        post_counters().increment(post_id, "likes")
+
+        # Only the latest likes are remembered, to keep the session cookie small.
+        session["liked_posts"] = [*liked_posts, post_id][-MAX_REMEMBERED_LIKES:]
+
+    return redirect(url_for("blog.detail", post_id=post_id))
+
+
+@bp.route("/tags")
+def tags() -> str:
+    """
+    Lists the most popular tags, along with how many posts have them.
+
+    Returns:
+        tags template.
+    """
+    popular_tags = (
+        Tag.query.filter(Tag.post_count > 0)
+        .order_by(Tag.post_count.desc(), Tag.name)
+        .limit(TAGS_PER_PAGE)
+        .all()
+    )
+
+    return render_template("blog/tags.html", tags=popular_tags)
+
+
+@bp.route("/tags/<path:name>")
+def tagged(name: str) -> str:
+    """
+    Lists the posts with a tag, newest first.
+
+    Args:
+        name: Name of the tag.
+
+    Returns:
+        tagged posts template.
+    """
+    tag = Tag.query.filter_by(name=name).first_or_404()
+
+    page = render_posts_page(get_before_cursor(), tag.id)
+
+    return render_template(
+        "blog/tagged.html", tag=tag, page=page, counts=load_page_counts(page)
+    )
+
+
+@bp.route("/events")
+def events() -> Response:
+    """
+    Streams post changes to the client as server-sent events. Every client in the process is fed
+    from the same change stream, which loads each changed post once, so connected clients don't
+    cost any DB queries.
+
+    Returns:
+        Event stream response.
+    """
+    config = current_app.config
+
+    return Response(
+        stream_events(
+            change_stream(),
+            request.headers.get("Last-Event-ID"),
+            heartbeat=config["LIVE_HEARTBEAT_SECONDS"],
+            max_pending=config["LIVE_MAX_PENDING_EVENTS"],
+        ),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @bp.route("/create", methods=("GET", "POST"))
@@ -59,12 +265,18 @@ def create() -> ViewResponseType:
             flash(error)
         else:
             post = Post(
-                author=g.user,
+                author_id=g.user.id,
                 title=title,
                 body=body,
             )
 
             db.session.add(post)
+            db.session.flush()
+
+            set_post_tags(post.id, parse_tags(request.form.get("tags", "")))
+
+            publish("post", post.id, "created")
+
             db.session.commit()
 
             return redirect(url_for("blog.index"))
@@ -72,6 +284,132 @@ def create() -> ViewResponseType:
     return render_template("blog/create.html")
 
 
+def get_owned_post(post_id: int) -> EditablePostRow:
+    """
+    Loads a post through the posts cache region, making sure it belongs to the current user.
+
+    Args:
+        post_id: ID of the post to load.
+
+    Returns:
+        The requested post.
+    """
+    post = query_cache("posts").get_or_load(
+        post_id, lambda: get_editable_post(post_id), tags=[("post", post_id)]
+    )
+
+    if post is None:
+        abort(404)
+
+    if post.author_id != g.user.id:
+        abort(403)
+
+    return post
+
+
+def execute_owned_write(statement: UpdateBase) -> bool:
+    """
+    Runs a conditional write that targets at most one post. The statement is expected to carry
+    its own ownership (and version) checks in its WHERE clause, so that the check and the write
+    happen in one round trip.
+
+    Args:
+        statement: UPDATE or DELETE statement to run.
+
+    Returns:
+        boolean indicating if a post matched the conditions and was written.
+    """
+    if db.engine.dialect.full_returning:
+        return db.session.execute(statement.returning(Post.id)).first() is not None
+
+    return cast(int, db.session.execute(statement).rowcount) == 1
+
+
+def lock_owned_post(conditions: list[Any]) -> bool:
+    """
+    Locks a post for the rest of the transaction, if it matches the conditions, so that nothing
+    else can write to it, or add to what belongs to it, until the transaction ends.
+
+    Postgres locks the row with SELECT ... FOR UPDATE. SQLite ignores that, and only starts a
+    transaction on the first write, so there the post is locked with an UPDATE that leaves it as
+    it is, which takes SQLite's write lock.
+
+    Args:
+        conditions: Conditions the post has to match, see owned_post_conditions.
+
+    Returns:
+        boolean indicating if a post matched the conditions and was locked.
+    """
+    if db.engine.dialect.name == "postgresql":
+        return (
+            db.session.execute(
+                select(Post.id).where(*conditions).with_for_update()
+            ).first()
+            is not None
+        )
+
+    return execute_owned_write(
+        sql_update(Post)
+        .where(*conditions)
+        .values(version=Post.version)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def get_expected_version() -> Optional[int]:
+    """
+    Reads the post version the submitted form was based on, if the form sent one.
+
+    Returns:
+        The expected post version, or None if the form didn't include it.
+    """
+    return request.form.get("version", type=int)
+
+
+def get_expected_created() -> Optional[datetime]:
+    """
+    Reads the creation time of the post the submitted form was for, if the form sent one.
+
+    Returns:
+        The post's creation time, or None if the form didn't include a valid one.
+    """
+    created = request.form.get("created")
+
+    try:
+        return datetime.fromisoformat(created) if created else None
+    except ValueError:
+        return None
+
+
+def owned_post_conditions(
+    post_id: int, version: Optional[int], created: Optional[datetime]
+) -> list[Any]:
+    """
+    Builds the WHERE conditions that restrict a write to a post owned by the current user and, if
+    given, still at the version the user last saw.
+
+    When posts are partitioned, the post's creation time is added as well so that Postgres only
+    has to look at the partition holding the post.
+
+    Args:
+        post_id: ID of the post to write.
+        version: Version the user's form was based on.
+        created: Creation time of the post, as sent back by the form.
+
+    Returns:
+        Conditions to apply to an UPDATE or DELETE on posts.
+    """
+    conditions = [Post.id == post_id, Post.author_id == g.user.id]
+
+    if version is not None:
+        conditions.append(Post.version == version)
+
+    if created is not None and post_partitioning_enabled():
+        conditions.append(Post.created == created)
+
+    return conditions
+
+
 @bp.route("/<int:post_id>/update", methods=("GET", "POST"))
 @login_required
 def update(post_id: int) -> ViewResponseType:
@@ -82,12 +420,14 @@ def update(post_id: int) -> ViewResponseType:
         Either the post edit template (if first time through, or if there is invalid data in the
         form) or a redirect to the index page (if post edit is successful).
     """
-    post = Post.query.options(joinedload("author")).get_or_404(post_id)
-
-    if post.author.id != g.user.id:
-        abort(403)
+    status = HTTPStatus.OK
 
     if request.method == "POST":
+        if "title" not in request.form or "body" not in request.form:
+            # Answered with a 400 below, like create does, but only once it's clear the post
+            # exists and is the user's.
+            get_owned_post(post_id)
+
         title = request.form["title"]
         body = request.form["body"]
 
@@ -96,18 +436,55 @@ def update(post_id: int) -> ViewResponseType:
         if not title:
             error = "Title is required."
 
-        if error is not None:
-            flash(error)
-        else:
-            post.title = title
-            post.body = body
+        if error is None:
+            statement = (
+                sql_update(Post)
+                .where(
+                    *owned_post_conditions(
+                        post_id, get_expected_version(), get_expected_created()
+                    )
+                )
+                .values(
+                    title=title,
+                    body=body,
+                    **derive_body_columns(body),
+                    updated=func.current_timestamp(),
+                    version=Post.version + 1,
+                )
+                .execution_options(synchronize_session=False)
+            )
 
-            db.session.add(post)
-            db.session.commit()
+            if execute_owned_write(statement):
+                if "tags" in request.form:
+                    set_post_tags(post_id, parse_tags(request.form["tags"]))
 
-            return redirect(url_for("blog.index"))
+                publish("post", post_id, "updated")
+
+                db.session.commit()
+
+                return redirect(url_for("blog.index"))
 
-    return render_template("blog/update.html", post=post)
+            db.session.rollback()
+
+            # The cached post may be the version that just lost, e.g. if the change came from a
+            # process that can't notify this one. Only a missed write pays for reloading it, which
+            # also sorts out 404 vs 403.
+            query_cache("posts").invalidate(("post", post_id))
+
+            get_owned_post(post_id)
+
+            error = "This post was changed since you started editing it."
+            status = HTTPStatus.CONFLICT
+
+        flash(error)
+
+    post = get_owned_post(post_id)
+    attachments = load_attachments([post.id]).get(post.id, ())
+
+    return make_response(
+        render_template("blog/update.html", post=post, attachments=attachments),
+        status,
+    )
 
 
 @bp.route("/<int:post_id>/delete", methods=("POST",))
@@ -117,14 +494,50 @@ def delete(post_id: int) -> Response:
     Allows a user to delete a post.
 
     Returns:
-        Redirect to the index page.
+        Redirect to the index page, or back to the edit page if the post changed in the meantime.
     """
-    post = Post.query.get_or_404(post_id)
+    conditions = owned_post_conditions(
+        post_id, get_expected_version(), get_expected_created()
+    )
 
-    if post.author_id != g.user.id:
-        abort(403)
+    # The post's tags and attachment files can't be found once it is gone, so they are read
+    # first, but only once the post is locked, so that e.g. an update changing its tags can't
+    # slip in between.
+    if lock_owned_post(conditions):
+        tag_ids = get_post_tag_ids(post_id)
+        attachment_keys = get_post_attachment_keys(post_id)
+
+        db.session.execute(
+            sql_delete(Post)
+            .where(*conditions)
+            .execution_options(synchronize_session=False)
+        )
+
+        # Tags, comments and attachments go with the post through ON DELETE CASCADE, except for
+        # comments and attachments of partitioned posts, which have no foreign key to them.
+        adjust_post_counts(tag_ids, -1)
+        record_post_deletion(g.user.id)
+
+        if post_partitioning_enabled():
+            delete_post_comments(post_id)
+            delete_post_attachments(post_id)
+
+        if attachment_keys:
+            # Only run once the delete is committed.
+            enqueue("attachments.remove_stored_files", keys=attachment_keys)
+
+        publish("post", post_id, "deleted")
+
+        db.session.commit()
+
+        return redirect(url_for("blog.index"))
+
+    db.session.rollback()
+
+    query_cache("posts").invalidate(("post", post_id))
+
+    get_owned_post(post_id)
 
-    db.session.delete(post)
-    db.session.commit()
+    flash("This post was changed since you started editing it.")
 
-    return redirect(url_for("blog.index"))
+    return redirect(url_for("blog.update", post_id=post_id))
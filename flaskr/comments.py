@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Code to handle threaded comments on posts
+"""
+from collections import defaultdict
+from typing import Optional
+
+from flask import Blueprint, abort, flash, g, redirect, request, url_for
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import joinedload
+from werkzeug import Response
+
+from flaskr.auth import login_required
+from flaskr.invalidation import publish
+from flaskr.models import Comment, Post, db
+
+
+MAX_COMMENT_LENGTH = 5000
+
+bp = Blueprint("comments", __name__)
+
+
+def comment_path(parent_path: str, comment_id: int) -> str:
+    """
+    Builds the materialized path of a comment.
+
+    Args:
+        parent_path: Path of the comment being replied to, or an empty string for comments on the
+            post itself.
+        comment_id: ID of the comment.
+
+    Returns:
+        Path of the comment.
+    """
+    return f"{parent_path}{comment_id:010d}/"
+
+
+def load_comments(post_ids: list[int]) -> dict[int, list[Comment]]:
+    """
+    Loads the comments of a batch of posts, with their authors, in one query. Each post's comments
+    come out of the (post_id, path) index already in thread order.
+
+    Args:
+        post_ids: IDs of the posts to load comments for.
+
+    Returns:
+        Comments in thread order, by post ID. Posts without comments are left out.
+    """
+    comments: defaultdict[int, list[Comment]] = defaultdict(list)
+
+    if not post_ids:
+        return comments
+
+    for comment in (
+        Comment.query.options(joinedload("author"))
+        .filter(Comment.post_id.in_(post_ids))
+        .order_by(Comment.post_id, Comment.path)
+    ):
+        comments[comment.post_id].append(comment)
+
+    return comments
+
+
+def add_comment(post: Post, author_id: int, body: str, parent_path: str) -> Comment:
+    """
+    Adds a comment to a post in the current transaction, and bumps the post's comment count.
+
+    Args:
+        post: Post being commented on. Only its ID and creation time are used.
+        author_id: ID of the comment's author.
+        body: Text of the comment.
+        parent_path: Path of the comment being replied to, or an empty string for comments on the
+            post itself.
+
+    Returns:
+        The new comment.
+    """
+    comment = Comment(post_id=post.id, author_id=author_id, body=body, path="")
+
+    db.session.add(comment)
+    db.session.flush()
+
+    comment.path = comment_path(parent_path, comment.id)
+
+    db.session.execute(
+        update(Post)
+        # The creation time lets Postgres go straight to the right partition, if posts are
+        # partitioned.
+        .where(Post.id == post.id, Post.created == post.created)
+        .values(comment_count=Post.comment_count + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+    publish("post", post.id, "commented")
+
+    return comment
+
+
+def delete_post_comments(post_id: int) -> None:
+    """
+    Deletes all comments on a deleted post in the current transaction. Only needed when posts are
+    partitioned, since comments otherwise go with their post through ON DELETE CASCADE.
+
+    Args:
+        post_id: ID of the post.
+    """
+    db.session.execute(
+        delete(Comment)
+        .where(Comment.post_id == post_id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+@bp.route("/<int:post_id>/comments", methods=("POST",))
+@login_required
+def create(post_id: int) -> Response:
+    """
+    Allows a user to comment on a post, or to reply to another comment.
+
+    Args:
+        post_id: ID of the post to comment on.
+
+    Returns:
+        Redirect to the post's comments.
+    """
+    post = db.session.execute(
+        select(Post.id, Post.created).where(Post.id == post_id)
+    ).first()
+
+    if post is None:
+        abort(404)
+
+    body = request.form.get("body", "").strip()
+    parent_id = request.form.get("parent_id", type=int)
+
+    error: Optional[str] = None
+
+    if not body:
+        error = "Comment is required."
+    elif len(body) > MAX_COMMENT_LENGTH:
+        error = f"Comments can't be longer than {MAX_COMMENT_LENGTH} characters."
+
+    if error is not None:
+        flash(error)
+    else:
+        parent_path = ""
+
+        if parent_id is not None:
+            parent_path = db.session.execute(
+                select(Comment.path).where(
+                    Comment.id == parent_id, Comment.post_id == post_id
+                )
+            ).scalar_one_or_none()
+
+            if parent_path is None:
+                abort(400)
+
+        add_comment(post, g.user.id, body, parent_path)
+
+        db.session.commit()
+
+    return redirect(f"{url_for('blog.detail', post_id=post_id)}#comments")
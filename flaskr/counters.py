@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+View and like counters for posts, buffered in memory and written to the database in batches
+"""
+import atexit
+import os
+import threading
+from collections import Counter, defaultdict
+from typing import Optional, cast
+
+from flask import Flask, current_app
+from sqlalchemy.sql.dml import Insert
+
+from flaskr.models import PostStats, db, dialect_insert
+
+
+COUNTERS = ("views", "likes")
+
+
+class PostCounters:
+    """
+    Counts views and likes of posts in this process, and adds them to the post_stats table in the
+    background.
+
+    Every flush writes all the counts gathered since the previous one in a single batched upsert,
+    so a popular post costs one row write per flush instead of one per view. Counts are added to
+    what is stored, which lets every process flush its own counts without coordinating with the
+    others. If the process dies, at most one flush interval's worth of counts are lost.
+
+    Flushes don't invalidate anything: list views read counts through the short-lived
+    post_counts cache region, so nothing else has to be dropped or rebuilt as counts change.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        self._app = app
+        self._lock = threading.Lock()
+        self._pending: defaultdict[int, Counter[str]] = defaultdict(Counter)
+        self._flusher_pid: Optional[int] = None
+        self._wake_up = threading.Event()
+
+    def increment(self, post_id: int, counter: str, amount: int = 1) -> None:
+        """
+        Counts a view or like of a post. Starts the flusher thread if this process doesn't have one
+        yet.
+
+        Args:
+            post_id: ID of the post.
+            counter: Name of the counter, one of COUNTERS.
+            amount: Amount to add.
+        """
+        if counter not in COUNTERS:
+            raise ValueError(f"Unknown counter {counter!r}.")
+
+        self.ensure_flushing()
+
+        with self._lock:
+            self._pending[post_id][counter] += amount
+
+            pending_posts = len(self._pending)
+
+        if pending_posts >= self._app.config["COUNTER_MAX_PENDING_POSTS"]:
+            # Flush early, rather than let the buffer (and what a crash would lose) grow.
+            self._wake_up.set()
+
+    def pending(self, post_id: int) -> Counter[str]:
+        """
+        Gets the counts of a post that haven't been flushed yet.
+
+        Args:
+            post_id: ID of the post.
+
+        Returns:
+            Unflushed counts, by counter name.
+        """
+        with self._lock:
+            return Counter(self._pending.get(post_id, {}))
+
+    def flush(self) -> int:
+        """
+        Writes the buffered counts to the database. Needs an app context.
+
+        Returns:
+            Number of posts whose counts were written.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(Counter)
+
+        if not pending:
+            return 0
+
+        table = PostStats.__table__
+
+        insert = dialect_insert(table)
+        statement = cast(
+            Insert,
+            insert.on_conflict_do_update(
+                index_elements=[table.c.post_id],
+                set_={
+                    counter: table.c[counter] + insert.excluded[counter]
+                    for counter in COUNTERS
+                },
+            ),
+        )
+
+        # Sorted, so that processes flushing at the same time lock rows in the same order.
+        rows = [
+            {
+                "post_id": post_id,
+                **{counter: counts[counter] for counter in COUNTERS},
+            }
+            for post_id, counts in sorted(pending.items())
+        ]
+
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(statement, rows)
+        except Exception:
+            # Put the counts back, to be retried with the next flush.
+            with self._lock:
+                for post_id, counts in pending.items():
+                    self._pending[post_id].update(counts)
+
+            raise
+
+        return len(rows)
+
+    def ensure_flushing(self) -> None:
+        """
+        Starts the flusher thread if this process doesn't have one yet, unless the flush interval
+        is set to None. Checks the process ID, so that forked processes start their own thread.
+        """
+        if self._flusher_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+
+            self._flusher_pid = os.getpid()
+
+            # A forked process would otherwise flush its parent's counts again.
+            self._pending.clear()
+
+            if self._app.config["COUNTER_FLUSH_INTERVAL"] is None:
+                return
+
+            threading.Thread(
+                target=self._flush_forever, name="counter-flusher", daemon=True
+            ).start()
+
+            atexit.register(self._flush_in_app_context)
+
+    def _flush_forever(self) -> None:
+        """
+        Flushes the counts every flush interval, or sooner if too many posts have pending counts.
+        """
+        while True:
+            self._wake_up.wait(self._app.config["COUNTER_FLUSH_INTERVAL"])
+            self._wake_up.clear()
+
+            try:
+                self._flush_in_app_context()
+            except Exception:
+                self._app.logger.exception("Failed to flush post counters.")
+
+    def _flush_in_app_context(self) -> None:
+        """
+        Flushes the counts from outside of a request.
+        """
+        with self._app.app_context():
+            self.flush()
+
+
+def post_counters() -> PostCounters:
+    """
+    Gets the post counters of the current app.
+
+    Returns:
+        The app's post counters.
+    """
+    return cast(PostCounters, current_app.extensions["post_counters"])
+
+
+def init_app(app: Flask) -> None:
+    """
+    Sets up the post counters for the app.
+
+    Args:
+        app (): Flask app instance
+    """
+    app.extensions["post_counters"] = PostCounters(app)
@@ -0,0 +1,495 @@
+# -*- coding: utf-8 -*-
+"""
+Atom and RSS feeds of the latest posts, kept in memory and updated as posts change
+"""
+import hashlib
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Any, NamedTuple, Optional, cast
+
+from flask import (
+    Blueprint,
+    Flask,
+    abort,
+    current_app,
+    get_template_attribute,
+    render_template,
+    request,
+)
+from markupsafe import Markup
+from sqlalchemy import func, select
+from werkzeug import Response
+
+from flaskr.invalidation import RESET, ChangeEvent, LocalCache
+from flaskr.models import PostCursor, PostDeletion, User, db, dialect_insert
+from flaskr.readmodel import (
+    FeedPostRow,
+    get_last_post_deletion,
+    list_feed_posts,
+    posts,
+)
+
+
+FEED_FORMATS = {
+    "atom": "application/atom+xml",
+    "rss": "application/rss+xml",
+}
+
+# Shown as the update time of feeds without any posts.
+EPOCH = datetime(1970, 1, 1)
+
+# Post changes that can change what a feed shows.
+FEED_ACTIONS = {"created", "updated", "deleted"}
+
+bp = Blueprint("feeds", __name__, url_prefix="/feeds")
+
+
+@dataclass(frozen=True)
+class FeedEntry:
+    """
+    Post in a feed, already serialized in every feed format.
+    """
+
+    id: int
+    created: datetime
+    updated: datetime
+    serialized: dict[str, Markup]
+
+    @property
+    def cursor(self) -> PostCursor:
+        """
+        Position of the entry's post in the newest-first ordering of posts.
+
+        Returns:
+            Cursor for the post.
+        """
+        return PostCursor(created=self.created, id=self.id)
+
+
+class FeedDocument(NamedTuple):
+    """
+    Feed serialized in one format, along with its validators.
+    """
+
+    body: bytes
+    etag: str
+    last_modified: Optional[datetime]
+
+
+def as_utc(value: datetime) -> datetime:
+    """
+    Marks a timestamp read from the database as UTC, which is what it is stored in.
+
+    Args:
+        value: Naive timestamp.
+
+    Returns:
+        Timezone aware timestamp.
+    """
+    return value.replace(tzinfo=timezone.utc)
+
+
+def rfc3339(value: datetime) -> str:
+    """
+    Formats a timestamp the way Atom expects it.
+
+    Args:
+        value: Naive UTC timestamp.
+
+    Returns:
+        Formatted timestamp.
+    """
+    return as_utc(value).isoformat()
+
+
+def rfc822(value: datetime) -> str:
+    """
+    Formats a timestamp the way RSS expects it.
+
+    Args:
+        value: Naive UTC timestamp.
+
+    Returns:
+        Formatted timestamp.
+    """
+    return format_datetime(as_utc(value))
+
+
+def serialize_entry(post: FeedPostRow) -> FeedEntry:
+    """
+    Serializes a post in every feed format. Needs a request context to build URLs.
+
+    Args:
+        post: Post to serialize.
+
+    Returns:
+        The feed entry.
+    """
+    return FeedEntry(
+        id=post.id,
+        created=post.created,
+        updated=post.updated or post.created,
+        serialized={
+            feed_format: get_template_attribute("feeds/_entries.xml", feed_format)(post)
+            for feed_format in FEED_FORMATS
+        },
+    )
+
+
+class Feed:
+    """
+    Latest posts, or an author's latest posts, as served to feed readers.
+
+    Changes to posts are queued as they come in, and applied the next time the feed is requested:
+    only the posts that changed get loaded and serialized again, and the feed documents are only
+    rebuilt if one of the feed's entries actually changed.
+
+    The feed's validators only depend on what is in the database, so that every process serves
+    the same ones: the ETag is a hash of the entries' IDs and update times, and the update time
+    of the feed is that of its newest entry, or the time a post was last deleted, if that is
+    later. Otherwise, deleting the newest entry would move the update time back.
+    """
+
+    def __init__(self, title: str, author_id: Optional[int] = None) -> None:
+        self.title = title
+        self.author_id = author_id
+        self._lock = threading.Lock()
+        self._entries: Optional[list[FeedEntry]] = None
+        self._deleted_at: Optional[datetime] = None
+        self._documents: dict[str, FeedDocument] = {}
+        self._pending_lock = threading.Lock()
+        self._pending: dict[int, str] = {}
+        self._reload = False
+
+    def handle_change(self, change: ChangeEvent) -> None:
+        """
+        Queues a change to a post, to be applied the next time the feed is requested. A reset has
+        the whole feed loaded again instead.
+
+        Args:
+            change: Change to a post.
+        """
+        if change.action == RESET:
+            with self._pending_lock:
+                self._pending = {}
+                self._reload = True
+
+            return
+
+        if change.action not in FEED_ACTIONS:
+            return
+
+        with self._pending_lock:
+            if self._pending.get(change.id) != "deleted":
+                self._pending[change.id] = change.action
+
+    def document(self, feed_format: str) -> FeedDocument:
+        """
+        Gets the feed serialized in a format, bringing it up to date first. Needs a request
+        context to build URLs.
+
+        Args:
+            feed_format: Format of the feed, one of FEED_FORMATS.
+
+        Returns:
+            The serialized feed.
+        """
+        with self._lock:
+            self._refresh()
+
+            document = self._documents.get(feed_format)
+
+            if document is None:
+                document = self._serialize(feed_format)
+
+                self._documents[feed_format] = document
+
+            return document
+
+    def _load_posts(self, *conditions: Any, limit: int) -> list[FeedEntry]:
+        """
+        Loads and serializes the feed's posts, newest first.
+
+        Args:
+            *conditions: Conditions the posts have to match.
+            limit: Maximum number of posts to load.
+
+        Returns:
+            Entries for the loaded posts.
+        """
+        return [
+            serialize_entry(post)
+            for post in list_feed_posts(
+                *conditions, author_id=self.author_id, limit=limit
+            )
+        ]
+
+    def _refresh(self) -> None:
+        """
+        Applies the queued changes. Loads the whole feed if it hasn't been loaded yet, or was
+        reset.
+        """
+        size = current_app.config["FEED_SIZE"]
+
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            reload, self._reload = self._reload, False
+
+        if self._entries is None or reload:
+            self._set_entries(
+                self._load_posts(limit=size), get_last_post_deletion(self.author_id)
+            )
+
+            return
+
+        if not pending:
+            return
+
+        deleted_at = self._deleted_at
+
+        if "deleted" in pending.values():
+            deleted_at = get_last_post_deletion(self.author_id)
+
+        was_full = len(self._entries) >= size
+        tail = self._entries[-1].cursor if self._entries and was_full else None
+
+        entries = {
+            entry.id: entry
+            for entry in self._entries
+            if pending.get(entry.id) != "deleted"
+        }
+
+        changed_ids = [
+            post_id for post_id, action in pending.items() if action != "deleted"
+        ]
+
+        if changed_ids:
+            for entry in self._load_posts(
+                posts.c.id.in_(changed_ids), limit=len(changed_ids)
+            ):
+                # A full feed can't take posts older than its last entry, since there could be
+                # other posts in between that it doesn't know about.
+                if entry.id in entries or tail is None or entry.cursor >= tail:
+                    entries[entry.id] = entry
+
+        new_entries = sorted(
+            entries.values(), key=lambda entry: entry.cursor, reverse=True
+        )[:size]
+
+        if was_full and new_entries and len(new_entries) < size:
+            new_entries += self._load_posts(
+                new_entries[-1].cursor.comes_before(), limit=size - len(new_entries)
+            )
+        elif was_full and not new_entries:
+            new_entries = self._load_posts(limit=size)
+
+        self._set_entries(new_entries, deleted_at)
+
+    def _set_entries(
+        self, entries: list[FeedEntry], deleted_at: Optional[datetime]
+    ) -> None:
+        """
+        Replaces the feed's entries, dropping the feed documents if anything changed.
+
+        Args:
+            entries: New entries of the feed.
+            deleted_at: Time a post of the feed was last deleted.
+        """
+        if entries == self._entries and deleted_at == self._deleted_at:
+            return
+
+        self._entries = entries
+        self._deleted_at = deleted_at
+        self._documents.clear()
+
+    def _serialize(self, feed_format: str) -> FeedDocument:
+        """
+        Builds the feed document out of the already serialized entries.
+
+        Args:
+            feed_format: Format of the feed, one of FEED_FORMATS.
+
+        Returns:
+            The serialized feed.
+        """
+        entries = self._entries or []
+
+        updated = max(
+            [entry.updated for entry in entries]
+            + ([self._deleted_at] if self._deleted_at else []),
+            default=None,
+        )
+
+        body = render_template(
+            f"feeds/{feed_format}.xml",
+            feed=self,
+            entries=[entry.serialized[feed_format] for entry in entries],
+            updated=updated or EPOCH,
+        ).encode()
+
+        etag = hashlib.sha256(f"{feed_format}:{self.author_id}:{updated}".encode())
+
+        for entry in entries:
+            etag.update(f":{entry.id}@{entry.updated.isoformat()}".encode())
+
+        return FeedDocument(
+            body=body,
+            etag=etag.hexdigest()[:32],
+            last_modified=as_utc(updated) if updated else None,
+        )
+
+
+def record_post_deletion(author_id: int) -> None:
+    """
+    Records in the current transaction that an author deleted a post, which moves the update time
+    of the feeds the post was in forward.
+
+    Args:
+        author_id: ID of the post's author.
+    """
+    insert = dialect_insert(PostDeletion.__table__).values(
+        author_id=author_id, deleted_at=func.current_timestamp()
+    )
+
+    db.session.execute(
+        insert.on_conflict_do_update(
+            index_elements=[PostDeletion.author_id],
+            set_={"deleted_at": insert.excluded.deleted_at},
+        )
+    )
+
+
+class FeedCache:
+    """
+    Holds the feeds served by an app: the global one, and those of recently requested authors.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        self.latest = Feed("Latest posts")
+        self.authors: LocalCache[Feed] = LocalCache(app.config["FEED_CACHE_SIZE"])
+
+    def author_feed(self, author_id: int) -> Optional[Feed]:
+        """
+        Gets the feed of an author's posts.
+
+        Args:
+            author_id: ID of the author.
+
+        Returns:
+            The author's feed, or None if there is no such author.
+        """
+        feed = self.authors.get(author_id)
+
+        if feed is None:
+            username = db.session.execute(
+                select(User.username).where(User.id == author_id)
+            ).scalar_one_or_none()
+
+            if username is None:
+                return None
+
+            feed = Feed(f"Posts by {username}", author_id)
+
+            self.authors.set(author_id, feed)
+
+        return feed
+
+    def handle_change(self, change: ChangeEvent) -> None:
+        """
+        Passes a change to a post on to every feed. Author feeds that the post doesn't belong to
+        find out when they load it.
+
+        Args:
+            change: Change to a post.
+        """
+        self.latest.handle_change(change)
+
+        for feed in self.authors.values():
+            feed.handle_change(change)
+
+
+def feed_cache() -> FeedCache:
+    """
+    Gets the feed cache of the current app.
+
+    Returns:
+        The app's feed cache.
+    """
+    return cast(FeedCache, current_app.extensions["feeds"])
+
+
+def feed_response(feed: Feed, feed_format: str) -> Response:
+    """
+    Serves a feed, or a 304 if the client's copy is still current.
+
+    Args:
+        feed: Feed to serve.
+        feed_format: Format to serve the feed in.
+
+    Returns:
+        Feed response.
+    """
+    if feed_format not in FEED_FORMATS:
+        abort(404)
+
+    document = feed.document(feed_format)
+
+    response = Response(document.body, mimetype=FEED_FORMATS[feed_format])
+    response.set_etag(document.etag)
+    response.last_modified = document.last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config["FEED_MAX_AGE"]
+
+    return response.make_conditional(request)
+
+
+@bp.route("/<feed_format>")
+def latest(feed_format: str) -> Response:
+    """
+    Serves the feed of the latest posts.
+
+    Args:
+        feed_format: Format of the feed: atom or rss.
+
+    Returns:
+        Feed response.
+    """
+    return feed_response(feed_cache().latest, feed_format)
+
+
+@bp.route("/authors/<int:author_id>/<feed_format>")
+def author(author_id: int, feed_format: str) -> Response:
+    """
+    Serves the feed of an author's latest posts.
+
+    Args:
+        author_id: ID of the author.
+        feed_format: Format of the feed: atom or rss.
+
+    Returns:
+        Feed response.
+    """
+    feed = feed_cache().author_feed(author_id)
+
+    if feed is None:
+        abort(404)
+
+    return feed_response(feed, feed_format)
+
+
+def init_app(app: Flask) -> None:
+    """
+    Sets up the feed cache for the app, and has it kept up to date as posts change.
+
+    Args:
+        app (): Flask app instance
+    """
+    cache = FeedCache(app)
+
+    app.extensions["feeds"] = cache
+    app.extensions["invalidation_bus"].subscribe("post", cache.handle_change)
+
+    app.add_template_filter(rfc3339)
+    app.add_template_filter(rfc822)
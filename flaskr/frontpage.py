@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed snapshot of the front page, rebuilt in the background after posts change
+"""
+import threading
+from dataclasses import dataclass
+from typing import Optional, cast
+
+from flask import Flask, current_app, get_template_attribute
+from flask.ctx import RequestContext
+from markupsafe import Markup
+
+from flaskr.invalidation import ChangeEvent
+from flaskr.models import PostCursor
+from flaskr.querycache import query_cache
+from flaskr.readmodel import list_posts, load_attachments, load_post_counts
+
+
+@dataclass(frozen=True)
+class RenderedPost:
+    """
+    Post as shown on list views, with everything that is the same for all users already rendered.
+    """
+
+    id: int
+    author_id: int
+    header: Markup
+    body: Markup
+
+
+@dataclass(frozen=True)
+class PostsPage:
+    """
+    One page of rendered posts.
+    """
+
+    posts: tuple[RenderedPost, ...]
+    next_cursor: Optional[str]
+
+
+def render_posts_page(
+    before: Optional[PostCursor] = None, tag_id: Optional[int] = None
+) -> PostsPage:
+    """
+    Loads and renders a page of posts, newest first. Needs a request context, or an app context
+    with SERVER_NAME set, to build URLs.
+
+    Pages other than the front page are loaded through the post_lists cache region, and dropped
+    from it whenever any post changes. View and like counts are left out of the rendered page,
+    see load_page_counts.
+
+    Args:
+        before: If given, the page starts after the post this cursor points at.
+        tag_id: If given, only posts with this tag are included.
+
+    Returns:
+        The rendered page.
+    """
+    per_page = current_app.config["POSTS_PER_PAGE"]
+
+    if before is None and tag_id is None:
+        # The front page snapshot already holds this one.
+        posts = list_posts(per_page + 1)
+    else:
+        posts = query_cache("post_lists").get_or_load(
+            (per_page, before, tag_id),
+            lambda: list_posts(per_page + 1, before, tag_id),
+            tags=["post"],
+        )
+
+    # Attachments are loaded fresh for every render, in one query for the whole page.
+    attachments = load_attachments([post.id for post in posts[:per_page]])
+
+    render_header = get_template_attribute("blog/_post.html", "header")
+    render_body = get_template_attribute("blog/_post.html", "body")
+
+    return PostsPage(
+        posts=tuple(
+            RenderedPost(
+                id=post.id,
+                author_id=post.author_id,
+                header=render_header(post),
+                body=render_body(post, attachments.get(post.id, ())),
+            )
+            for post in posts[:per_page]
+        ),
+        next_cursor=posts[per_page - 1].cursor.encode()
+        if len(posts) > per_page
+        else None,
+    )
+
+
+def load_page_counts(page: PostsPage) -> dict[int, tuple[int, int]]:
+    """
+    Loads the view and like counts of a page's posts through the post_counts cache region.
+
+    Counts change far more often than posts do, so they are shown when the page is rendered
+    for a request instead of being part of snapshots and cached lists, and can be as old as
+    the region's TTL.
+
+    Args:
+        page: Page of posts.
+
+    Returns:
+        Views and likes, by post ID. Posts that were never counted are left out.
+    """
+    post_ids = tuple(post.id for post in page.posts)
+
+    return query_cache("post_counts").get_or_load(
+        post_ids, lambda: load_post_counts(list(post_ids))
+    )
+
+
+class FrontPage:
+    """
+    Snapshot of the first page of posts.
+    """
+
+    def __init__(self, page: PostsPage) -> None:
+        self.page = page
+
+        # The page as anonymous users see it, along with the counts it shows. It is the same for
+        # all of them, so the first anonymous request fills it in and the rest are served
+        # straight from it, until the counts change.
+        self.anonymous_html: Optional[tuple[dict[int, tuple[int, int]], str]] = None
+
+
+class FrontPageSnapshot:
+    """
+    Holds the current front page snapshot for an app, and rebuilds it when posts change.
+
+    Rebuilds happen in a background thread, a short delay after the first change. Any other
+    changes during that delay are covered by the same rebuild, so a burst of writes only leads to
+    one rebuild. Until the rebuild is done, the previous snapshot keeps being served, and a failed
+    rebuild is retried after FRONT_PAGE_REBUILD_RETRY_DELAY.
+
+    Background rebuilds run in a request context of their own, made up from PREFERRED_URL_SCHEME,
+    SERVER_NAME (or localhost, if unset) and APPLICATION_ROOT, so that they build the same links
+    as requests do.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        self._app = app
+        self._lock = threading.Lock()
+        self._front_page: Optional[FrontPage] = None
+        self._rebuild_timer: Optional[threading.Timer] = None
+        self._generation = 0
+        self._installed_generation = 0
+
+    def get(self) -> FrontPage:
+        """
+        Returns the current snapshot, building it first if there is none yet.
+
+        Returns:
+            The front page snapshot.
+        """
+        front_page = self._front_page
+
+        if front_page is None:
+            front_page = self._build()
+
+        return front_page
+
+    def invalidate(self) -> None:
+        """
+        Schedules a rebuild of the snapshot. If the rebuild delay is set to None, the snapshot is
+        dropped instead, and rebuilt by the next request that needs it.
+        """
+        delay = self._app.config["FRONT_PAGE_REBUILD_DELAY"]
+
+        if delay is None:
+            with self._lock:
+                self._generation += 1
+                self._installed_generation = self._generation
+                self._front_page = None
+
+            return
+
+        self._schedule_rebuild(delay)
+
+    def _schedule_rebuild(self, delay: float) -> None:
+        """
+        Starts the rebuild timer, unless a rebuild is already scheduled.
+
+        Args:
+            delay: Seconds to wait before rebuilding.
+        """
+        with self._lock:
+            if self._rebuild_timer is not None:
+                return
+
+            self._rebuild_timer = threading.Timer(delay, self._rebuild)
+            self._rebuild_timer.daemon = True
+            self._rebuild_timer.start()
+
+    def handle_change(self, change: ChangeEvent) -> None:
+        """
+        Invalidates the snapshot when a post changes.
+
+        Args:
+            change: Change to a post.
+        """
+        self.invalidate()
+
+    def _rebuild(self) -> None:
+        """
+        Rebuilds the snapshot. Runs in the rebuild timer's thread. If the rebuild fails, the
+        current snapshot is kept and another rebuild is scheduled.
+        """
+        with self._lock:
+            self._rebuild_timer = None
+
+        try:
+            with self._rebuild_context():
+                self._build()
+        except Exception:
+            self._app.logger.exception("Failed to rebuild the front page snapshot.")
+
+            self._schedule_rebuild(self._app.config["FRONT_PAGE_REBUILD_RETRY_DELAY"])
+
+    def _rebuild_context(self) -> RequestContext:
+        """
+        Makes up a request context for background rebuilds, for the front page's URL.
+
+        Returns:
+            The request context.
+        """
+        config = self._app.config
+
+        return self._app.test_request_context(
+            base_url=f"{config['PREFERRED_URL_SCHEME']}://"
+            f"{config['SERVER_NAME'] or 'localhost'}{config['APPLICATION_ROOT']}"
+        )
+
+    def _build(self) -> FrontPage:
+        """
+        Builds a new snapshot and installs it, unless a snapshot built later got installed first.
+
+        Returns:
+            The newly built snapshot.
+        """
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+
+        front_page = FrontPage(render_posts_page())
+
+        with self._lock:
+            if generation > self._installed_generation:
+                self._installed_generation = generation
+                self._front_page = front_page
+
+        return front_page
+
+
+def front_page_snapshot() -> FrontPageSnapshot:
+    """
+    Gets the front page snapshot of the current app.
+
+    Returns:
+        The app's front page snapshot.
+    """
+    return cast(FrontPageSnapshot, current_app.extensions["front_page"])
+
+
+def init_app(app: Flask) -> None:
+    """
+    Sets up the front page snapshot for the app, and has it invalidated whenever a post
+    changes.
+
+    Args:
+        app (): Flask app instance
+    """
+    snapshot = FrontPageSnapshot(app)
+
+    app.extensions["front_page"] = snapshot
+
+    app.extensions["invalidation_bus"].subscribe("post", snapshot.handle_change)
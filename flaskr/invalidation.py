@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Bus that tells every process about committed changes, so that they can drop stale cached data
+"""
+import json
+import os
+import selectors
+import threading
+import uuid
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Generic, Hashable, NamedTuple, Optional, TypeVar, cast
+
+from flask import Flask, current_app
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from flaskr.models import db
+
+
+CHANGES_CHANNEL = "flaskr_changes"
+
+# Action of the events dispatched when changes may have been missed, e.g. while the listener was
+# reconnecting. Subscribers drop everything they hold for the entity.
+RESET = "reset"
+
+
+class ChangeEvent(NamedTuple):
+    """
+    Something that changed in the database.
+    """
+
+    entity: str
+    id: int
+    action: str
+
+
+Subscriber = Callable[[ChangeEvent], None]
+
+V = TypeVar("V")
+
+
+class LocalCache(Generic[V]):
+    """
+    Small process-local cache of entities, keyed by ID. Meant to be kept fresh by subscribing its
+    handle_change method to the invalidation bus.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, V] = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        """
+        Looks up a cached entry.
+
+        Args:
+            key: Key of the entry.
+
+        Returns:
+            The cached value, or None if there is none.
+        """
+        with self._lock:
+            return self._entries.get(key)
+
+    def set(self, key: Hashable, value: V) -> None:
+        """
+        Caches a value, evicting the oldest entry if the cache is full.
+
+        Args:
+            key: Key of the entry.
+            value: Value to cache.
+        """
+        with self._lock:
+            self._entries[key] = value
+
+            if len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def evict(self, key: Hashable) -> None:
+        """
+        Drops a cached entry, if there is one.
+
+        Args:
+            key: Key of the entry.
+        """
+        with self._lock:
+            if key in self._entries:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        """
+        Drops all cached entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def values(self) -> list[V]:
+        """
+        Lists the cached values.
+
+        Returns:
+            The cached values, oldest first.
+        """
+        with self._lock:
+            return list(self._entries.values())
+
+    def handle_change(self, change: ChangeEvent) -> None:
+        """
+        Drops the entry of an entity that changed, or all entries on a reset.
+
+        Args:
+            change: Change to the entity.
+        """
+        if change.action == RESET:
+            self.clear()
+        else:
+            self.evict(change.id)
+
+
+class InvalidationBus:
+    """
+    Delivers change events to subscribers in this process.
+
+    Events published in this process are delivered right after the transaction they were
+    published in commits. On Postgres, they are also sent with NOTIFY, and each process runs one
+    listener connection that delivers the events published by other processes. Notifications sent
+    while that connection is down are lost, so every subscriber gets a reset event each time it
+    starts listening.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        self._app = app
+        self._lock = threading.Lock()
+        self._subscribers: defaultdict[str, list[Subscriber]] = defaultdict(list)
+        self._listener: Optional[threading.Thread] = None
+        self._listener_pid: Optional[int] = None
+
+        # Identifies this process, so that the listener can skip events it already delivered.
+        self.origin = uuid.uuid4().hex
+
+    def subscribe(self, entity: str, subscriber: Subscriber) -> None:
+        """
+        Registers a function to call with each change to an entity. Subscribers can be called from
+        the listener thread, so they need to be thread safe.
+
+        Args:
+            entity: Name of the entity to get changes for.
+            subscriber: Function to call with each change event.
+        """
+        with self._lock:
+            self._subscribers[entity].append(subscriber)
+
+    def dispatch(self, change: ChangeEvent) -> None:
+        """
+        Calls the subscribers of the changed entity. A failing subscriber doesn't stop the others
+        from being called.
+
+        Args:
+            change: Change to deliver.
+        """
+        with self._lock:
+            subscribers = list(self._subscribers[change.entity])
+
+        for subscriber in subscribers:
+            try:
+                subscriber(change)
+            except Exception:
+                self._app.logger.exception("Failed to deliver %s.", change)
+
+    def reset(self) -> None:
+        """
+        Sends a reset event to the subscribers of every entity.
+        """
+        with self._lock:
+            entities = list(self._subscribers)
+
+        for entity in entities:
+            self.dispatch(ChangeEvent(entity, 0, RESET))
+
+    def ensure_listening(self) -> None:
+        """
+        Starts the listener thread if this process doesn't have one yet. Checks the process ID, so
+        that processes forked from one that was already listening start their own listener.
+        """
+        if self._listener_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+
+            self._listener_pid = os.getpid()
+
+            # A forked process would otherwise share its parent's origin.
+            self.origin = uuid.uuid4().hex
+
+            engine = db.get_engine(self._app)
+
+            if engine.dialect.name != "postgresql":
+                return
+
+            self._listener = threading.Thread(
+                target=self._listen_forever,
+                args=(engine,),
+                name="invalidation-listener",
+                daemon=True,
+            )
+            self._listener.start()
+
+    def _listen_forever(self, engine: Engine) -> None:
+        """
+        Listens for changes published by other processes, reconnecting if the connection drops.
+
+        Args:
+            engine: Engine to open the listening connection with.
+        """
+        stop = threading.Event()
+
+        while True:
+            try:
+                self._listen(engine)
+            except Exception:
+                self._app.logger.exception(
+                    "Invalidation listener failed, reconnecting."
+                )
+
+            stop.wait(self._app.config["INVALIDATION_RECONNECT_DELAY"])
+
+    def _listen(self, engine: Engine) -> None:
+        """
+        Opens a listening connection and delivers the events that come in on it. Once listening,
+        resets every subscriber, since changes could have been missed before.
+
+        Args:
+            engine: Engine to open the listening connection with.
+        """
+        connection: Any = engine.raw_connection()
+
+        # Keep the connection out of the pool, since it is switched to autocommit
+        connection.detach()
+
+        try:
+            connection.set_session(autocommit=True)
+
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {CHANGES_CHANNEL}")
+
+            self.reset()
+
+            driver_connection = connection.connection
+
+            with selectors.DefaultSelector() as selector:
+                selector.register(driver_connection, selectors.EVENT_READ)
+
+                while True:
+                    selector.select(timeout=60)
+
+                    driver_connection.poll()
+
+                    while driver_connection.notifies:
+                        self._deliver(driver_connection.notifies.pop(0).payload)
+        finally:
+            connection.close()
+
+    def _deliver(self, payload: str) -> None:
+        """
+        Delivers an event that came in through NOTIFY, unless it came from this process.
+
+        Args:
+            payload: Notification payload.
+        """
+        message = json.loads(payload)
+
+        if message["origin"] == self.origin:
+            return
+
+        self.dispatch(ChangeEvent(*message["change"]))
+
+
+def invalidation_bus() -> InvalidationBus:
+    """
+    Gets the invalidation bus of the current app.
+
+    Returns:
+        The app's invalidation bus.
+    """
+    return cast(InvalidationBus, current_app.extensions["invalidation_bus"])
+
+
+def publish(entity: str, entity_id: int, action: str) -> None:
+    """
+    Publishes a change made in the current transaction. Nothing is delivered unless the
+    transaction commits.
+
+    Args:
+        entity: Name of the changed entity.
+        entity_id: ID of the changed entity.
+        action: What happened to the entity, e.g. created, updated or deleted.
+    """
+    change = ChangeEvent(entity, entity_id, action)
+
+    # Makes sure a transaction is in progress, so that a rollback is seen even if nothing else has
+    # been written yet.
+    db.session.connection()
+
+    session = db.session()
+    transaction = session.get_nested_transaction() or session.get_transaction()
+
+    session.info.setdefault("published_changes", []).append((transaction, change))
+
+    if db.engine.dialect.name == "postgresql":
+        # Postgres holds notifications back until the transaction commits.
+        payload = json.dumps({"origin": invalidation_bus().origin, "change": change})
+
+        db.session.execute(func.pg_notify(CHANGES_CHANNEL, payload).select())
+
+
+@event.listens_for(db.session, "after_commit")
+def deliver_published_changes(session: Session) -> None:
+    """
+    Delivers the changes published in a transaction to this process, once it commits.
+
+    Args:
+        session: Session that committed.
+    """
+    published: list[tuple[Any, ChangeEvent]] = session.info.pop("published_changes", [])
+
+    if not published:
+        return
+
+    bus = invalidation_bus()
+
+    for _, change in published:
+        bus.dispatch(change)
+
+
+@event.listens_for(db.session, "after_soft_rollback")
+def drop_published_changes(session: Session, previous_transaction: Any) -> None:
+    """
+    Forgets the changes published in a transaction that was rolled back. If only a savepoint was
+    rolled back, the changes published outside of it are kept.
+
+    Args:
+        session: Session that rolled back.
+        previous_transaction: Transaction that was rolled back.
+    """
+    if not previous_transaction.nested:
+        session.info.pop("published_changes", None)
+
+        return
+
+    session.info["published_changes"] = [
+        (transaction, change)
+        for transaction, change in session.info.get("published_changes", [])
+        if not published_within(transaction, previous_transaction)
+    ]
+
+
+def published_within(transaction: Any, outer: Any) -> bool:
+    """
+    Checks if a transaction is another one, or nested inside of it.
+
+    Args:
+        transaction: Session transaction a change was published in.
+        outer: Session transaction to look for.
+
+    Returns:
+        boolean indicating if the transaction is within the outer one.
+    """
+    while transaction is not None:
+        if transaction is outer:
+            return True
+
+        transaction = transaction.parent
+
+    return False
+
+
+def init_app(app: Flask) -> None:
+    """
+    Sets up the invalidation bus for the app, and makes sure the process is listening for changes
+    before handling requests.
+
+    Args:
+        app (): Flask app instance
+    """
+    bus = InvalidationBus(app)
+
+    app.extensions["invalidation_bus"] = bus
+
+    app.before_request(bus.ensure_listening)
@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""
+Background job queue stored in the app's own database
+"""
+import selectors
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, NamedTuple, Optional, TypeVar, cast
+
+import click
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, delete, func, or_, select, update
+
+from flaskr.models import Job, db
+
+
+JOBS_CHANNEL = "flaskr_jobs"
+
+JobHandler = Callable[..., None]
+
+H = TypeVar("H", bound=JobHandler)
+
+_handlers: dict[str, JobHandler] = {}
+
+
+class ClaimedJob(NamedTuple):
+    """
+    Job claimed by a worker, detached from the session it was claimed in.
+    """
+
+    id: int
+    name: str
+    payload: dict[str, Any]
+    attempts: int
+    claimed_by: str
+
+
+def job_handler(name: str) -> Callable[[H], H]:
+    """
+    Decorator that registers a function as the handler for jobs with the given name. The job's
+    payload is passed to the handler as keyword arguments.
+
+    Args:
+        name: Name of the jobs to handle.
+
+    Returns:
+        Decorator that registers the handler and returns it unchanged.
+    """
+
+    def register(handler: H) -> H:
+        """
+        Registers the handler.
+
+        Args:
+            handler: Function to call for each job.
+
+        Returns:
+            The handler, unchanged.
+        """
+        _handlers[name] = handler
+
+        return handler
+
+    return register
+
+
+def enqueue(name: str, **payload: Any) -> Job:
+    """
+    Adds a job to the current session. It only becomes visible to workers once the session is
+    committed, so jobs enqueued along with a write are only run if the write goes through.
+
+    Args:
+        name: Name of the job, used to find its handler.
+        **payload: Arguments for the handler. Must be JSON serializable.
+
+    Returns:
+        The job.
+    """
+    job = Job(name=name, payload=payload, run_at=datetime.utcnow())
+
+    db.session.add(job)
+
+    if db.engine.dialect.name == "postgresql":
+        # Wakes up idle workers. Postgres only delivers it if the transaction commits.
+        db.session.execute(func.pg_notify(JOBS_CHANNEL, name).select())
+
+    return job
+
+
+def claim_jobs(worker_id: str, limit: int) -> list[ClaimedJob]:
+    """
+    Claims a batch of jobs that are due, so that no other worker picks them up until their lease
+    runs out.
+
+    On Postgres, the jobs are picked with SELECT ... FOR UPDATE SKIP LOCKED, so workers never wait
+    on each other. SQLite ignores the locking clause, but only has one writer at a time; the lease
+    condition is checked again in the UPDATE so a job claimed in the meantime isn't claimed twice.
+
+    Args:
+        worker_id: Unique ID of the claiming worker.
+        limit: Maximum number of jobs to claim.
+
+    Returns:
+        The claimed jobs.
+    """
+    now = datetime.utcnow()
+
+    claimable = and_(
+        Job.failed.is_(False),
+        Job.run_at <= now,
+        or_(Job.locked_until.is_(None), Job.locked_until < now),
+    )
+
+    job_ids = (
+        db.session.execute(
+            select(Job.id)
+            .where(claimable)
+            .order_by(Job.run_at, Job.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        .scalars()
+        .all()
+    )
+
+    if not job_ids:
+        db.session.rollback()
+
+        return []
+
+    db.session.execute(
+        update(Job)
+        .where(Job.id.in_(job_ids), claimable)
+        .values(
+            claimed_by=worker_id,
+            locked_until=now
+            + timedelta(seconds=current_app.config["JOB_LEASE_SECONDS"]),
+            attempts=Job.attempts + 1,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+    jobs = [
+        ClaimedJob(*row)
+        for row in db.session.execute(
+            select(Job.id, Job.name, Job.payload, Job.attempts, Job.claimed_by)
+            .where(Job.id.in_(job_ids), Job.claimed_by == worker_id)
+            .order_by(Job.run_at, Job.id)
+        )
+    ]
+
+    db.session.commit()
+
+    return jobs
+
+
+def retry_delay(attempts: int) -> timedelta:
+    """
+    Works out how long to wait before retrying a job, backing off exponentially.
+
+    Args:
+        attempts: Number of times the job has been attempted so far.
+
+    Returns:
+        Time to wait before the next attempt.
+    """
+    config = current_app.config
+
+    seconds = config["JOB_RETRY_BACKOFF_SECONDS"] * 2 ** (attempts - 1)
+
+    return timedelta(seconds=min(seconds, config["JOB_RETRY_BACKOFF_MAX_SECONDS"]))
+
+
+def run_job(job: ClaimedJob) -> bool:
+    """
+    Runs a claimed job. A job that succeeds is removed from the queue. One that fails is scheduled
+    for a retry, or marked as failed once it has run out of attempts. Either is only recorded
+    while the claim still holds: if the lease ran out and another worker claimed the job, that
+    worker's claim is left alone.
+
+    Args:
+        job: Claimed job to run.
+
+    Returns:
+        boolean indicating if the job succeeded.
+    """
+    job_id, attempts = job.id, job.attempts
+
+    still_claimed = and_(Job.id == job_id, Job.claimed_by == job.claimed_by)
+
+    try:
+        handler = _handlers[job.name]
+
+        handler(**job.payload)
+
+        db.session.execute(
+            delete(Job)
+            .where(still_claimed)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+        return True
+    except Exception:
+        db.session.rollback()
+
+        current_app.logger.exception("Job %s (%s) failed.", job_id, job.name)
+
+        failed = attempts >= current_app.config["JOB_MAX_ATTEMPTS"]
+
+        db.session.execute(
+            update(Job)
+            .where(still_claimed)
+            .values(
+                failed=failed,
+                run_at=datetime.utcnow() + retry_delay(attempts),
+                locked_until=None,
+                claimed_by=None,
+                last_error=traceback.format_exc(),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+        return False
+
+
+def delete_expired_jobs() -> int:
+    """
+    Deletes failed jobs once they have been kept for JOB_FAILED_RETENTION_DAYS since their last
+    attempt. Jobs that succeed are deleted right away, so these are the only ones that pile up.
+
+    Returns:
+        Number of jobs deleted.
+    """
+    cutoff = datetime.utcnow() - timedelta(
+        days=current_app.config["JOB_FAILED_RETENTION_DAYS"]
+    )
+
+    # A failed job's run_at is when it would have been retried, shortly after its last attempt.
+    result = db.session.execute(
+        delete(Job)
+        .where(Job.failed.is_(True), Job.run_at < cutoff)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+    return cast(int, result.rowcount)
+
+
+class JobWaiter:
+    """
+    Waits for jobs to be enqueued. On Postgres, it listens for the notifications sent by enqueue,
+    so idle workers pick up new jobs right away. Elsewhere, it just sleeps for the poll interval.
+    """
+
+    def __init__(self) -> None:
+        self._connection: Any = None
+
+        if db.engine.dialect.name == "postgresql":
+            self._connection = db.engine.raw_connection()
+
+            # Keep the connection out of the pool, since it is switched to autocommit
+            self._connection.detach()
+            self._connection.set_session(autocommit=True)
+
+            with self._connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {JOBS_CHANNEL}")
+
+    def wait(self, timeout: float, stop: threading.Event) -> None:
+        """
+        Waits until jobs might be available, the timeout passes, or the worker is stopped.
+
+        Args:
+            timeout: Maximum number of seconds to wait.
+            stop: Event that is set when the worker should stop.
+        """
+        if self._connection is None:
+            stop.wait(timeout)
+
+            return
+
+        driver_connection = self._connection.connection
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(driver_connection, selectors.EVENT_READ)
+            selector.select(timeout)
+
+        driver_connection.poll()
+        driver_connection.notifies.clear()
+
+    def close(self) -> None:
+        """
+        Closes the listening connection, if there is one.
+        """
+        if self._connection is not None:
+            self._connection.close()
+
+
+def work(
+    app: Flask,
+    batch_size: int,
+    poll_interval: float,
+    stop: threading.Event,
+    burst: bool = False,
+) -> None:
+    """
+    Runs jobs until stopped. Meant to run in its own thread. When the queue is empty, expired
+    failed jobs are deleted, at most once every JOB_CLEANUP_INTERVAL_SECONDS.
+
+    Errors outside of the jobs themselves (e.g. the database going away while claiming jobs or
+    recording a result) don't stop the worker. They are logged, and the worker backs off
+    exponentially, up to JOB_WORKER_BACKOFF_MAX_SECONDS, before trying again.
+
+    Args:
+        app: Flask app instance
+        batch_size: Maximum number of jobs to claim at once.
+        poll_interval: Maximum number of seconds to wait for jobs when the queue is empty.
+        stop: Event that is set when the worker should stop.
+        burst: If True, stop once the queue is empty instead of waiting for more jobs.
+    """
+    worker_id = uuid.uuid4().hex
+
+    with app.app_context():
+        config = app.config
+        waiter: Optional[JobWaiter] = None
+        errors = 0
+        next_cleanup = 0.0
+
+        try:
+            while not stop.is_set():
+                try:
+                    if waiter is None and not burst:
+                        waiter = JobWaiter()
+
+                    jobs = claim_jobs(worker_id, batch_size)
+
+                    for job in jobs:
+                        run_job(job)
+
+                    if jobs:
+                        errors = 0
+
+                        continue
+
+                    if time.monotonic() >= next_cleanup:
+                        delete_expired_jobs()
+
+                        next_cleanup = (
+                            time.monotonic() + config["JOB_CLEANUP_INTERVAL_SECONDS"]
+                        )
+
+                    if waiter is None:
+                        break
+
+                    waiter.wait(poll_interval, stop)
+
+                    errors = 0
+                except Exception:
+                    errors += 1
+
+                    app.logger.exception("Worker %s ran into an error.", worker_id)
+
+                    db.session.remove()
+
+                    if waiter is not None:
+                        close_quietly(waiter)
+                        waiter = None
+
+                    stop.wait(
+                        min(
+                            config["JOB_WORKER_BACKOFF_SECONDS"] * 2 ** (errors - 1),
+                            config["JOB_WORKER_BACKOFF_MAX_SECONDS"],
+                        )
+                    )
+        finally:
+            if waiter is not None:
+                waiter.close()
+
+
+def close_quietly(waiter: JobWaiter) -> None:
+    """
+    Closes a waiter whose connection may already be broken.
+
+    Args:
+        waiter: Waiter to close.
+    """
+    try:
+        waiter.close()
+    except Exception:
+        current_app.logger.debug("Failed to close job waiter.", exc_info=True)
+
+
+@click.command("worker")
+@click.option(
+    "--concurrency",
+    default=1,
+    show_default=True,
+    help="Number of jobs to run at the same time.",
+)
+@click.option(
+    "--batch-size",
+    default=10,
+    show_default=True,
+    help="Maximum number of jobs each worker thread claims at once.",
+)
+@click.option(
+    "--poll-interval",
+    default=1.0,
+    show_default=True,
+    help="Maximum number of seconds to wait between checks when the queue is empty.",
+)
+@click.option(
+    "--burst",
+    is_flag=True,
+    help="Stop once the queue is empty instead of waiting for more jobs.",
+)
+@with_appcontext
+def worker_command(
+    concurrency: int, batch_size: int, poll_interval: float, burst: bool
+) -> None:
+    """
+    Command to run background jobs.
+
+    Args:
+        concurrency: Number of jobs to run at the same time.
+        batch_size: Maximum number of jobs each worker thread claims at once.
+        poll_interval: Maximum number of seconds to wait between checks when the queue is empty.
+        burst: If True, stop once the queue is empty.
+    """
+    app = current_app._get_current_object()  # type: ignore[attr-defined]
+
+    stop = threading.Event()
+
+    threads = [
+        threading.Thread(
+            target=work,
+            args=(app, batch_size, poll_interval, stop, burst),
+            name=f"worker-{number}",
+        )
+        for number in range(concurrency)
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1)
+    except KeyboardInterrupt:
+        click.echo("Stopping workers...")
+
+        stop.set()
+
+        for thread in threads:
+            thread.join()
+
+    click.echo("Workers stopped.")
+
+
+def init_app(app: Flask) -> None:
+    """
+    Adds the CLI command to run background jobs.
+
+    Args:
+        app (): Flask app instance
+    """
+    app.cli.add_command(worker_command)
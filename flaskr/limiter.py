@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive concurrency limits per blueprint, which shed excess requests before they queue up on a
+slow database
+"""
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Iterable
+from typing import Optional, cast
+
+from flask import Flask, Response, abort, current_app, g, request, session
+from werkzeug.exceptions import ServiceUnavailable
+
+
+SAFE_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+# Requests to these endpoints are never limited.
+EXEMPT_ENDPOINTS = frozenset({"static", "metrics"})
+
+
+def request_priority() -> str:
+    """
+    Works out the priority class of the current request. Logged-in users' writes come first, then
+    their reads and anonymous writes (logging in and signing up), then anonymous reads. Each class
+    may only use its share of a blueprint's limit, so the lower ones are shed first as the limit
+    shrinks.
+
+    Returns:
+        Name of the priority class.
+    """
+    logged_in = session.get("user_id") is not None
+
+    if request.method in SAFE_METHODS:
+        return "read" if logged_in else "anonymous_read"
+
+    return "write" if logged_in else "read"
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit that adapts to observed latency, AIMD style: it grows by about one for every
+    limit's worth of fast requests while it is being used, and shrinks by a constant factor when
+    requests get slower than the target latency or fail. Decreases are spaced at least one target
+    latency apart, so that a burst of requests that were all slowed down by the same stall only
+    counts once. Requests that are slow by design only count if they fail.
+    """
+
+    def __init__(
+        self,
+        initial: float,
+        minimum: float,
+        maximum: float,
+        latency_target: float,
+        backoff: float,
+    ) -> None:
+        self.limit = initial
+        self.in_flight = 0
+        self.decreases = 0
+        self._minimum = minimum
+        self._maximum = maximum
+        self._latency_target = latency_target
+        self._backoff = backoff
+        self._last_decrease = float("-inf")
+
+    def try_acquire(self, share: float) -> bool:
+        """
+        Admits a request if the number of requests in flight is under its share of the limit. At
+        least one request is always admitted.
+
+        Args:
+            share: Fraction of the limit the request's priority class may use.
+
+        Returns:
+            boolean indicating if the request was admitted.
+        """
+        if self.in_flight >= max(int(self.limit * share), 1):
+            return False
+
+        self.in_flight += 1
+
+        return True
+
+    def release(self, latency: Optional[float], failed: bool, now: float) -> None:
+        """
+        Records the outcome of an admitted request and adjusts the limit.
+
+        Args:
+            latency: How long the request took, in seconds, or None if the request is slow by
+                design and its latency says nothing about load.
+            failed: Whether the request failed with an unhandled error.
+            now: Monotonic time the request finished at.
+        """
+        in_flight = self.in_flight
+
+        self.in_flight -= 1
+
+        if latency is None and not failed:
+            return
+
+        if failed or (latency is not None and latency > self._latency_target):
+            if now - self._last_decrease >= self._latency_target:
+                self._last_decrease = now
+                self.decreases += 1
+                self.limit = max(self.limit * self._backoff, self._minimum)
+        elif in_flight >= self.limit / 2:
+            # Only grown while at least half used, so that a quiet period doesn't leave a limit
+            # that was never tested.
+            self.limit = min(self.limit + 1 / self.limit, self._maximum)
+
+
+class ConcurrencyLimiter:
+    """
+    Keeps an adaptive limit per blueprint, along with the counts exported as metrics. Limits are
+    per process.
+
+    Endpoints in LIMITER_SLOW_ENDPOINTS, like streamed uploads and password checks, still take a
+    slot, but their latency isn't fed back to the limit, so that they don't shrink it for the
+    rest of their blueprint.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        self._app = app
+        self._lock = threading.Lock()
+        self.limits: dict[str, AdaptiveLimit] = {}
+        self.decisions: defaultdict[tuple[str, str, str], int] = defaultdict(int)
+        self.latency: defaultdict[str, list[float]] = defaultdict(lambda: [0.0, 0])
+
+    def _get_limit(self, group: str) -> AdaptiveLimit:
+        """
+        Gets the limit of a blueprint, setting it up on first use. Needs the lock to be held.
+
+        Args:
+            group: Name of the blueprint.
+
+        Returns:
+            The blueprint's limit.
+        """
+        limit = self.limits.get(group)
+
+        if limit is None:
+            config = self._app.config
+
+            limit = self.limits[group] = AdaptiveLimit(
+                initial=config["LIMITER_INITIAL_LIMIT"],
+                minimum=config["LIMITER_MIN_LIMIT"],
+                maximum=config["LIMITER_MAX_LIMIT"],
+                latency_target=config["LIMITER_LATENCY_TARGET"],
+                backoff=config["LIMITER_BACKOFF"],
+            )
+
+        return limit
+
+    def admit(self) -> None:
+        """
+        Admits the current request, or sheds it with a 503 if its blueprint is at its priority
+        class's share of the limit.
+        """
+        if request.endpoint is None or request.endpoint in EXEMPT_ENDPOINTS:
+            return
+
+        group = request.blueprint or "app"
+        priority = request_priority()
+        share = self._app.config["LIMITER_PRIORITY_SHARES"][priority]
+
+        with self._lock:
+            admitted = self._get_limit(group).try_acquire(share)
+
+            self.decisions[group, priority, "admitted" if admitted else "shed"] += 1
+
+        if not admitted:
+            raise ServiceUnavailable(
+                retry_after=self._app.config["LIMITER_RETRY_AFTER"]
+            )
+
+        g.limiter_admitted = (group, time.monotonic())
+
+    def release(self, error: Optional[BaseException]) -> None:
+        """
+        Releases the current request's slot, if it was admitted, and feeds its latency back to the
+        limit.
+
+        Args:
+            error: Unhandled error the request failed with, if any.
+        """
+        admitted = g.pop("limiter_admitted", None)
+
+        if admitted is None:
+            return
+
+        group, started = admitted
+
+        now = time.monotonic()
+        latency = now - started
+        endpoint = cast(str, request.endpoint)
+
+        slow = endpoint in self._app.config["LIMITER_SLOW_ENDPOINTS"]
+
+        with self._lock:
+            self._get_limit(group).release(
+                None if slow else latency, error is not None, now
+            )
+
+            endpoint_latency = self.latency[endpoint]
+            endpoint_latency[0] += latency
+            endpoint_latency[1] += 1
+
+    def render_metrics(self) -> str:
+        """
+        Renders the limiter's state in the Prometheus text format.
+
+        Returns:
+            Metrics text.
+        """
+        with self._lock:
+            limits = [
+                (group, limit.limit, limit.in_flight, limit.decreases)
+                for group, limit in sorted(self.limits.items())
+            ]
+            decisions = sorted(self.decisions.items())
+            latency = sorted(
+                (endpoint, *sums) for endpoint, sums in self.latency.items()
+            )
+
+        lines = [
+            *metric_family(
+                "flaskr_limiter_limit",
+                "gauge",
+                "Current concurrency limit.",
+                (
+                    f'{{blueprint="{group}"}} {limit:.2f}'
+                    for group, limit, _, _ in limits
+                ),
+            ),
+            *metric_family(
+                "flaskr_limiter_in_flight",
+                "gauge",
+                "Admitted requests being handled.",
+                (
+                    f'{{blueprint="{group}"}} {in_flight}'
+                    for group, _, in_flight, _ in limits
+                ),
+            ),
+            *metric_family(
+                "flaskr_limiter_decreases_total",
+                "counter",
+                "Times the concurrency limit was lowered.",
+                (f'{{blueprint="{group}"}} {count}' for group, _, _, count in limits),
+            ),
+            *metric_family(
+                "flaskr_limiter_requests_total",
+                "counter",
+                "Admission decisions.",
+                (
+                    f'{{blueprint="{group}",priority="{priority}",decision="{decision}"}} '
+                    f"{count}"
+                    for (group, priority, decision), count in decisions
+                ),
+            ),
+            "# HELP flaskr_request_latency_seconds Latency of admitted requests.",
+            "# TYPE flaskr_request_latency_seconds summary",
+        ]
+
+        for endpoint, total, count in latency:
+            lines.append(
+                f'flaskr_request_latency_seconds_sum{{endpoint="{endpoint}"}} {total:.6f}'
+            )
+            lines.append(
+                f'flaskr_request_latency_seconds_count{{endpoint="{endpoint}"}} {count}'
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+def metric_family(
+    name: str, kind: str, description: str, samples: Iterable[str]
+) -> list[str]:
+    """
+    Renders a metric with one sample per label set in the Prometheus text format.
+
+    Args:
+        name: Name of the metric.
+        kind: Type of the metric, e.g. gauge or counter.
+        description: Help text of the metric.
+        samples: Label set and value of each sample.
+
+    Returns:
+        Lines of metrics text.
+    """
+    return [
+        f"# HELP {name} {description}",
+        f"# TYPE {name} {kind}",
+        *(f"{name}{sample}" for sample in samples),
+    ]
+
+
+def concurrency_limiter() -> ConcurrencyLimiter:
+    """
+    Gets the concurrency limiter of the current app.
+
+    Returns:
+        The app's concurrency limiter.
+    """
+    return cast(ConcurrencyLimiter, current_app.extensions["concurrency_limiter"])
+
+
+def metrics() -> Response:
+    """
+    Exports the limiter's decisions and the latency of requests, for Prometheus to scrape. Not
+    found unless METRICS_ENABLED is set, since it is meant to be reached from inside the
+    deployment only.
+
+    Returns:
+        Metrics in the Prometheus text format.
+    """
+    if not current_app.config["METRICS_ENABLED"]:
+        abort(404)
+
+    return Response(
+        concurrency_limiter().render_metrics(),
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
+def init_app(app: Flask) -> None:
+    """
+    Sets up the concurrency limiter for the app and adds the metrics endpoint. Needs to run before
+    anything else (tracing included) registers before request functions, so that requests are
+    admitted before any other work is done for them.
+
+    Args:
+        app (): Flask app instance
+    """
+    limiter = ConcurrencyLimiter(app)
+
+    app.extensions["concurrency_limiter"] = limiter
+
+    app.before_request(limiter.admit)
+    app.teardown_request(limiter.release)
+
+    app.add_url_rule("/metrics", "metrics", metrics)
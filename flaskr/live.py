@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Live stream of post changes, served to clients as server-sent events
+"""
+import json
+import threading
+import uuid
+from collections import deque
+from collections.abc import Callable, Iterator
+from typing import Any, NamedTuple, Optional, cast
+
+from flask import Flask, current_app
+
+from flaskr.invalidation import RESET, ChangeEvent
+from flaskr.models import db
+from flaskr.readmodel import get_listed_post
+
+
+# Post changes clients are sent, besides resets. Others (e.g. a comment being added) only matter
+# to the pages that show them.
+STREAMED_ACTIONS = frozenset({"created", "updated", "deleted"})
+
+PostLoader = Callable[[int], Optional[dict[str, Any]]]
+
+
+class StreamEvent(NamedTuple):
+    """
+    Change, numbered in the order this process received it, with the data clients are sent.
+    """
+
+    sequence: int
+    change: ChangeEvent
+    data: dict[str, Any]
+
+
+class ChangeStream:
+    """
+    Process-wide stream of post changes that all connected clients read from.
+
+    Changes come in once per process, through the invalidation bus. They are kept in one bounded
+    history shared by all clients, and each client only keeps track of the last event it was sent.
+    An idle client is a thread (or greenlet) waiting on a shared condition, nothing more. The post
+    a change is about is loaded once, when the change comes in, and sent to every client as is.
+    """
+
+    def __init__(
+        self, history_size: int, load_post: Optional[PostLoader] = None
+    ) -> None:
+        self._load_post = load_post
+        self._condition = threading.Condition()
+        self._history: deque[StreamEvent] = deque(maxlen=history_size)
+        self._last_sequence = 0
+
+        # Event IDs are only meaningful to the process that handed them out, so they include an
+        # ID for this process (and this run of it).
+        self.stream_id = uuid.uuid4().hex[:12]
+
+    def handle_change(self, change: ChangeEvent) -> None:
+        """
+        Adds a change to the stream and wakes up waiting clients. Only changes in STREAMED_ACTIONS
+        (and resets) are streamed.
+
+        Args:
+            change: Change to a post.
+        """
+        if change.action == RESET:
+            data: dict[str, Any] = {}
+        elif change.action in STREAMED_ACTIONS:
+            data = {"id": change.id, "action": change.action}
+
+            if change.action != "deleted" and self._load_post is not None:
+                data["post"] = self._load_post(change.id)
+        else:
+            return
+
+        with self._condition:
+            self._last_sequence += 1
+            self._history.append(StreamEvent(self._last_sequence, change, data))
+            self._condition.notify_all()
+
+    def event_id(self, sequence: int) -> str:
+        """
+        Builds the ID sent to clients for an event.
+
+        Args:
+            sequence: Sequence number of the event.
+
+        Returns:
+            Event ID.
+        """
+        return f"{self.stream_id}-{sequence}"
+
+    @property
+    def last_sequence(self) -> int:
+        """
+        Sequence number of the latest event.
+
+        Returns:
+            Sequence number.
+        """
+        with self._condition:
+            return self._last_sequence
+
+    def resume_after(self, last_event_id: str) -> Optional[int]:
+        """
+        Works out where a reconnecting client left off.
+
+        Args:
+            last_event_id: ID of the last event the client got.
+
+        Returns:
+            Sequence number of the last event the client got, or None if the client can't be
+            resumed, because the ID came from a different process, or the events the client missed
+            are no longer in the history.
+        """
+        stream_id, _, sequence = last_event_id.rpartition("-")
+
+        if stream_id != self.stream_id or not sequence.isdigit():
+            return None
+
+        with self._condition:
+            oldest = self._history[0].sequence if self._history else 1
+
+            if not oldest - 1 <= int(sequence) <= self._last_sequence:
+                return None
+
+        return int(sequence)
+
+    def wait_for_events(
+        self, after: int, timeout: float, max_pending: int
+    ) -> Optional[list[StreamEvent]]:
+        """
+        Waits for events newer than the ones a client already got.
+
+        Args:
+            after: Sequence number of the last event the client got.
+            timeout: Maximum number of seconds to wait.
+            max_pending: Maximum number of events the client is allowed to fall behind by.
+
+        Returns:
+            The new events (empty if the timeout passed first), or None if the client fell too far
+            behind.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._last_sequence > after, timeout)
+
+            if self._last_sequence - after > max_pending:
+                return None
+
+            if self._history and self._history[0].sequence > after + 1:
+                return None
+
+            return [event for event in self._history if event.sequence > after]
+
+
+def format_event(event_id: str, event_type: str, data: object) -> str:
+    """
+    Formats an event for the text/event-stream format.
+
+    Args:
+        event_id: ID of the event.
+        event_type: Type of the event.
+        data: JSON serializable event data.
+
+    Returns:
+        The formatted event.
+    """
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_events(
+    stream: ChangeStream,
+    last_event_id: Optional[str],
+    heartbeat: float,
+    max_pending: int,
+) -> Iterator[str]:
+    """
+    Generates the server-sent events for one client.
+
+    A client that comes back with the ID of the last event it got is sent the events it missed. If
+    that isn't possible, it gets a reset event, telling it to reload instead. So does every client
+    when the invalidation bus resets, since changes could have been missed. A client that falls
+    more than max_pending events behind (because it isn't reading fast enough) is sent a reset
+    event and disconnected.
+
+    Args:
+        stream: Stream to read from.
+        last_event_id: ID of the last event the client got, if it is reconnecting.
+        heartbeat: Number of seconds after which to send a comment if there are no events, to keep
+            the connection open.
+        max_pending: Maximum number of events the client can fall behind by.
+
+    Returns:
+        Generator of formatted events.
+    """
+    after = stream.last_sequence
+
+    yield f"retry: {int(heartbeat * 1000)}\n\n"
+
+    if last_event_id:
+        resumed_after = stream.resume_after(last_event_id)
+
+        if resumed_after is None:
+            yield format_event(stream.event_id(after), "reset", {})
+        else:
+            after = resumed_after
+
+    while True:
+        events = stream.wait_for_events(after, heartbeat, max_pending)
+
+        if events is None:
+            yield format_event(stream.event_id(stream.last_sequence), "reset", {})
+
+            return
+
+        if not events:
+            yield ": keep-alive\n\n"
+
+            continue
+
+        for event in events:
+            yield format_event(
+                stream.event_id(event.sequence),
+                "reset" if event.change.action == RESET else event.change.entity,
+                event.data,
+            )
+
+        after = events[-1].sequence
+
+
+def load_post_data(app: Flask, post_id: int) -> Optional[dict[str, Any]]:
+    """
+    Loads what clients are sent about a created or updated post: the post as the API lists it.
+    Changes are delivered while the session that made them is committing, or on the bus
+    listener's thread, so this uses a connection of its own.
+
+    Args:
+        app: Flask app instance
+        post_id: ID of the post.
+
+    Returns:
+        JSON serializable post, or None if it is gone already.
+    """
+    # Imported here, since the API imports the blog, which imports the live stream.
+    from flaskr.api import post_to_json
+
+    with db.get_engine(app).connect() as connection:
+        post = get_listed_post(connection, post_id)
+
+    return None if post is None else post_to_json(post)
+
+
+def change_stream() -> ChangeStream:
+    """
+    Gets the change stream of the current app.
+
+    Returns:
+        The app's change stream.
+    """
+    return cast(ChangeStream, current_app.extensions["change_stream"])
+
+
+def init_app(app: Flask) -> None:
+    """
+    Sets up the change stream for the app, fed by post changes from the invalidation bus.
+
+    Args:
+        app (): Flask app instance
+    """
+    stream = ChangeStream(
+        app.config["LIVE_HISTORY_SIZE"],
+        load_post=lambda post_id: load_post_data(app, post_id),
+    )
+
+    app.extensions["change_stream"] = stream
+    app.extensions["invalidation_bus"].subscribe("post", stream.handle_change)
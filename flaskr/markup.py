@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of user-written Markdown into HTML that is safe to show on the site
+"""
+import html
+from typing import cast
+
+import bleach
+import markdown
+
+
+# Bump whenever a change here would render existing posts differently, then run
+# `flask rerender-posts` to bring stored HTML up to date.
+RENDERER_VERSION = 1
+
+ALLOWED_TAGS = [
+    "a",
+    "abbr",
+    "blockquote",
+    "br",
+    "code",
+    "em",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "hr",
+    "img",
+    "li",
+    "ol",
+    "p",
+    "pre",
+    "strong",
+    "table",
+    "tbody",
+    "td",
+    "th",
+    "thead",
+    "tr",
+    "ul",
+]
+
+ALLOWED_ATTRIBUTES = {
+    "a": ["href", "title"],
+    "abbr": ["title"],
+    "img": ["alt", "src", "title"],
+}
+
+ALLOWED_PROTOCOLS = ["http", "https", "mailto"]
+
+
+def render_markdown(text: str) -> str:
+    """
+    Renders Markdown and strips anything that isn't on the allow list.
+
+    Args:
+        text: Markdown to render.
+
+    Returns:
+        Sanitized HTML.
+    """
+    rendered = markdown.markdown(text, extensions=["fenced_code", "tables"])
+
+    return cast(
+        str,
+        bleach.clean(
+            rendered,
+            tags=ALLOWED_TAGS,
+            attributes=ALLOWED_ATTRIBUTES,
+            protocols=ALLOWED_PROTOCOLS,
+            strip=True,
+        ),
+    )
+
+
+def html_to_text(value: str) -> str:
+    """
+    Drops all markup from rendered HTML, leaving only the text a reader would see.
+
+    Args:
+        value: HTML to convert.
+
+    Returns:
+        Plain, unescaped text.
+    """
+    return html.unescape(cast(str, bleach.clean(value, tags=[], strip=True)))
@@ -2,18 +2,134 @@
 """
 Database models for app
 """
-from typing import cast
+import sqlite3
+from collections.abc import Iterator
+from contextlib import closing, contextmanager
+from datetime import date, datetime
+from typing import Any, NamedTuple, Optional, Union, cast
 
 import click
 from flask import Flask, current_app
 from flask.cli import with_appcontext
 from flask_sqlalchemy import DefaultMeta, SQLAlchemy
+from sqlalchemy import (
+    MetaData,
+    Table,
+    and_,
+    bindparam,
+    event,
+    func,
+    or_,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.sqlite import DATETIME as SQLiteDateTime
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import validates
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from flaskr.markup import RENDERER_VERSION, html_to_text, render_markdown
+from flaskr.partitioning import (
+    add_months,
+    create_default_partition,
+    create_month_partitions,
+    detach_month_partitions,
+    month_start,
+    partitioned_metadata,
+)
+from flaskr.tracing import start_span
+
 
 db = SQLAlchemy()
 BaseModel: DefaultMeta = db.Model
 
+EXCERPT_LENGTH = 300
+
+# SQLite's CURRENT_TIMESTAMP has no fractional seconds. Storing datetimes set from python the same
+# way keeps all the text values in the column (and bound parameters) comparable with each other.
+Timestamp = db.DateTime().with_variant(
+    SQLiteDateTime(
+        storage_format="%(year)04d-%(month)02d-%(day)02d "
+        "%(hour)02d:%(minute)02d:%(second)02d"
+    ),
+    "sqlite",
+)
+
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection: Any, connection_record: Any) -> None:
+    """
+    Makes SQLite enforce foreign keys, which it only does when asked to on each connection, so
+    that deletes cascade the same way they do on Postgres.
+
+    Args:
+        dbapi_connection: Connection that was just opened.
+        connection_record: Pool record of the connection.
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        with closing(dbapi_connection.cursor()) as cursor:
+            cursor.execute("PRAGMA foreign_keys=ON")
+
+
+def make_excerpt(body: str) -> str:
+    """
+    Builds the short version of a post body shown on list views. Cuts at a word boundary when
+    possible.
+
+    Args:
+        body: Full post body, as plain text.
+
+    Returns:
+        The body itself if it is short enough, otherwise its start followed by an ellipsis.
+    """
+    body = " ".join(body.split())
+
+    if len(body) <= EXCERPT_LENGTH:
+        return body
+
+    excerpt = body[:EXCERPT_LENGTH]
+
+    if not body[EXCERPT_LENGTH].isspace() and " " in excerpt:
+        excerpt = excerpt.rsplit(" ", 1)[0]
+
+    return f"{excerpt.rstrip()}…"
+
+
+def derive_body_columns(body: str) -> dict[str, Any]:
+    """
+    Computes everything stored alongside a post body, so that reads never have to render anything.
+
+    Args:
+        body: Post body, as Markdown.
+
+    Returns:
+        Column values to write along with the body.
+    """
+    body_html = render_markdown(body)
+
+    return {
+        "excerpt": make_excerpt(html_to_text(body_html)),
+        "body_html": body_html,
+        "renderer_version": RENDERER_VERSION,
+    }
+
+
+def check_password(password_hash: str, value: str) -> bool:
+    """
+    Checks a password against a stored hash. Hashing is slow on purpose, so it is timed as a span.
+
+    Args:
+        password_hash: Stored password hash.
+        value: Password to check.
+
+    Returns:
+        boolean indicating if the password matches the hash.
+    """
+    with start_span("check_password"):
+        return check_password_hash(password_hash, value)
+
 
 class User(BaseModel):
     """
@@ -54,7 +170,36 @@ class User(BaseModel):
         Returns:
             boolean indicating if the stored password matches the input password.
         """
-        return check_password_hash(self._password, value)
+        return check_password(self._password, value)
+
+
+class Tag(BaseModel):
+    """
+    Label that posts can be filed under
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.Text, unique=True, nullable=False)
+
+    # Kept up to date by the writes that tag and untag posts, so showing how popular a tag is never
+    # needs counting.
+    post_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Each row carries a copy of its post's creation time, so that the posts with a tag can be paged
+# through newest first straight from the (tag_id, post_created, post_id) index.
+post_tag = db.Table(
+    "post_tag",
+    db.Column(
+        "post_id",
+        db.Integer,
+        db.ForeignKey("post.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    db.Column("tag_id", db.Integer, db.ForeignKey("tag.id"), primary_key=True),
+    db.Column("post_created", Timestamp, nullable=False),
+    db.Index("ix_post_tag_tag_id_post_created", "tag_id", "post_created", "post_id"),
+)
 
 
 class Post(BaseModel):
@@ -67,10 +212,226 @@ class Post(BaseModel):
     author = db.relationship("User", backref="posts", lazy=True)
     title = db.Column(db.Text, nullable=False)
     body = db.Column(db.Text, nullable=False)
+    excerpt = db.Column(db.Text, nullable=False)
+    body_html = db.Column(db.Text, nullable=False)
+    renderer_version = db.Column(db.Integer, nullable=False)
     created = db.Column(
-        db.DateTime, nullable=False, server_default=db.text("CURRENT_TIMESTAMP")
+        Timestamp, nullable=False, server_default=db.text("CURRENT_TIMESTAMP")
+    )
+    updated = db.Column(Timestamp)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    comment_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default=db.text("0")
+    )
+
+    # Read only, counts are written in batches by flaskr.counters.
+    stats = db.relationship(
+        "PostStats",
+        primaryjoin="Post.id == foreign(PostStats.post_id)",
+        uselist=False,
+        lazy=True,
+        viewonly=True,
+    )
+
+    # Read only, tags are written through flaskr.tags so that tag counts stay in sync.
+    tags = db.relationship(
+        "Tag", secondary=post_tag, lazy=True, order_by=Tag.name, viewonly=True
     )
 
+    __table_args__ = (
+        db.Index("ix_post_created_id", "created", "id"),
+        db.Index("ix_post_author_id_created_id", "author_id", "created", "id"),
+    )
+    __mapper_args__ = {"version_id_col": version}
+
+    @validates("body")
+    def validate_body(self, key: str, value: str) -> str:
+        """
+        Keeps the derived columns in sync whenever the body is set through the ORM.
+
+        Args:
+            key: Name of the attribute being set.
+            value: New body.
+
+        Returns:
+            The body, unchanged.
+        """
+        for column, derived_value in derive_body_columns(value).items():
+            setattr(self, column, derived_value)
+
+        return value
+
+
+class PostStats(BaseModel):
+    """
+    View and like counts of a post, kept apart from the post so that counting never locks it
+    """
+
+    __tablename__ = "post_stats"
+
+    # Not a foreign key, since counts are flushed in the background and can land after their post
+    # was deleted.
+    post_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    views = db.Column(db.Integer, nullable=False, default=0)
+    likes = db.Column(db.Integer, nullable=False, default=0)
+
+
+class PostDeletion(BaseModel):
+    """
+    When an author last deleted a post, kept so that feeds can tell they changed once the post is
+    gone
+    """
+
+    __tablename__ = "post_deletion"
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey("user.id", ondelete="CASCADE"),
+        primary_key=True,
+        autoincrement=False,
+    )
+    deleted_at = db.Column(Timestamp, nullable=False)
+
+
+class Comment(BaseModel):
+    """
+    Comment on a post, possibly in reply to another comment
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(
+        db.Integer, db.ForeignKey("post.id", ondelete="CASCADE"), nullable=False
+    )
+    author_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    author = db.relationship("User", lazy=True)
+    body = db.Column(db.Text, nullable=False)
+    created = db.Column(
+        Timestamp, nullable=False, server_default=db.text("CURRENT_TIMESTAMP")
+    )
+
+    # Materialized path: the zero padded IDs of the comment's ancestors and of the comment itself,
+    # each followed by a slash. Ordering a post's comments by path lists every thread depth first,
+    # and a thread is the range of paths starting with its root's path.
+    path = db.Column(db.Text, nullable=False)
+
+    __table_args__ = (db.Index("ix_comment_post_id_path", "post_id", "path"),)
+
+    @property
+    def depth(self) -> int:
+        """
+        How deep in its thread the comment is.
+
+        Returns:
+            0 for comments on the post itself, 1 for replies to those, and so on.
+        """
+        return cast(int, self.path.count("/") - 1)
+
+
+class Attachment(BaseModel):
+    """
+    File attached to a post. The contents live in the attachment storage, under the storage key.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(
+        db.Integer, db.ForeignKey("post.id", ondelete="CASCADE"), nullable=False
+    )
+    filename = db.Column(db.Text, nullable=False)
+    content_type = db.Column(db.Text, nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    sha256 = db.Column(db.Text, nullable=False)
+    storage_key = db.Column(db.Text, unique=True, nullable=False)
+    created = db.Column(
+        Timestamp, nullable=False, server_default=db.text("CURRENT_TIMESTAMP")
+    )
+
+    __table_args__ = (db.Index("ix_attachment_post_id", "post_id"),)
+
+
+class Job(BaseModel):
+    """
+    Deferred work, waiting for (or being done by) a worker
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.Text, nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+    failed = db.Column(db.Boolean, nullable=False, default=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(Timestamp, nullable=False)
+    locked_until = db.Column(Timestamp)
+    claimed_by = db.Column(db.Text)
+    last_error = db.Column(db.Text)
+    created = db.Column(
+        Timestamp, nullable=False, server_default=db.text("CURRENT_TIMESTAMP")
+    )
+
+    __table_args__ = (db.Index("ix_job_failed_run_at", "failed", "run_at"),)
+
+
+# Tables holding rows that belong to a post, in a post_id column.
+POST_DEPENDENT_TABLES = ("post_tag", "comment", "attachment", "post_stats")
+
+
+class PostCursor(NamedTuple):
+    """
+    Position of a post in the newest-first ordering of posts, used for keyset pagination.
+    """
+
+    created: datetime
+    id: int
+
+    @classmethod
+    def decode(cls, value: str) -> Optional["PostCursor"]:
+        """
+        Parses a cursor that was sent back by a client.
+
+        Args:
+            value: Encoded cursor.
+
+        Returns:
+            The cursor, or None if the value isn't a valid cursor.
+        """
+        created, _, post_id = value.rpartition("_")
+
+        try:
+            return cls(created=datetime.fromisoformat(created), id=int(post_id))
+        except ValueError:
+            return None
+
+    def comes_before(self, created: Any = None, post_id: Any = None) -> Any:
+        """
+        Builds the condition that matches the posts listed after this cursor, newest first.
+
+        Args:
+            created: Column holding the creation time to compare. Defaults to the post's.
+            post_id: Column holding the post ID to compare. Defaults to the post's.
+
+        Returns:
+            SQL condition.
+        """
+        created = Post.__table__.c.created if created is None else created
+        post_id = Post.__table__.c.id if post_id is None else post_id
+
+        return and_(
+            # Redundant with the condition below, but it is what lets the database range scan
+            # the created index (and prune partitions when posts are partitioned).
+            created <= self.created,
+            or_(
+                created < self.created,
+                and_(created == self.created, post_id < self.id),
+            ),
+        )
+
+    def encode(self) -> str:
+        """
+        Turns the cursor into a string that can be sent to clients.
+
+        Returns:
+            Encoded cursor.
+        """
+        return f"{self.created.isoformat()}_{self.id}"
+
 
 @click.command("init-db")
 @with_appcontext
@@ -79,11 +440,284 @@ def init_db_command() -> None:
     Command to create new tables.
     """
     with current_app.app_context():
-        db.create_all()
+        if post_partitioning_enabled():
+            partitioned_post_metadata().create_all(db.engine)
+
+            maintain_post_partitions(
+                premake_months=current_app.config["POST_PARTITION_PREMAKE_MONTHS"],
+                retention_months=None,
+            )
+        else:
+            db.create_all()
 
     click.echo("Initialized the database.")
 
 
+def post_partitioning_enabled() -> bool:
+    """
+    Checks if the post table is (or should be) partitioned by month. Partitioning is opt-in, and
+    only available on Postgres.
+
+    Returns:
+        boolean indicating if posts are partitioned.
+    """
+    return bool(current_app.config.get("POST_PARTITIONING")) and (
+        db.engine.dialect.name == "postgresql"
+    )
+
+
+def partitioned_post_metadata() -> MetaData:
+    """
+    Copies the metadata with the post table partitioned by month of creation. Post tags keep a
+    foreign key to their post, since they carry a copy of its creation time.
+
+    Returns:
+        Copied metadata.
+    """
+    return partitioned_metadata(
+        db.metadata, "post", "created", key_copies={"post_tag": "post_created"}
+    )
+
+
+def archive_post_dependents(connection: Connection, partition_name: str) -> None:
+    """
+    Moves the rows that belong to the posts of a partition about to be detached (their tags,
+    comments, attachments and counts) into tables named after the partition, and takes the posts
+    out of their tags' post counts. Attachment files stay in storage, listed by the archived rows.
+
+    Args:
+        connection: Connection to run the moves on.
+        partition_name: Name of the partition.
+    """
+    post_ids = f'SELECT id FROM "{partition_name}"'
+
+    connection.execute(
+        text(
+            "UPDATE tag SET post_count = tag.post_count - counts.posts "
+            "FROM (SELECT tag_id, count(*) AS posts FROM post_tag "
+            f"WHERE post_id IN ({post_ids}) GROUP BY tag_id) AS counts "
+            "WHERE tag.id = counts.tag_id"
+        )
+    )
+
+    for table_name in POST_DEPENDENT_TABLES:
+        archive_name = f"{partition_name}_{table_name}"
+
+        connection.execute(
+            text(f'CREATE TABLE IF NOT EXISTS "{archive_name}" (LIKE "{table_name}")')
+        )
+        connection.execute(
+            text(
+                f'INSERT INTO "{archive_name}" '
+                f'SELECT * FROM "{table_name}" WHERE post_id IN ({post_ids})'
+            )
+        )
+        connection.execute(
+            text(f'DELETE FROM "{table_name}" WHERE post_id IN ({post_ids})')
+        )
+
+
+@contextmanager
+def setting_post_tags_aside(
+    connection: Connection, partition_name: str
+) -> Iterator[None]:
+    """
+    Takes the tags of the posts of a partition out of the way while the posts are moved, so that
+    deleting the posts doesn't cascade to them, and puts them back afterwards. Tag post counts
+    are left alone, since the posts keep their tags.
+
+    Args:
+        connection: Connection to run the moves on.
+        partition_name: Name of the partition the posts are moved out of.
+    """
+    aside_name = f"{partition_name}_post_tag_aside"
+
+    connection.execute(
+        text(
+            f'CREATE TEMPORARY TABLE "{aside_name}" AS SELECT * FROM post_tag '
+            f'WHERE post_id IN (SELECT id FROM "{partition_name}")'
+        )
+    )
+    connection.execute(
+        text(
+            f'DELETE FROM post_tag WHERE post_id IN (SELECT post_id FROM "{aside_name}")'
+        )
+    )
+
+    yield
+
+    connection.execute(text(f'INSERT INTO post_tag SELECT * FROM "{aside_name}"'))
+    connection.execute(text(f'DROP TABLE "{aside_name}"'))
+
+
+def dialect_insert(table: Table) -> Union[postgresql.Insert, sqlite.Insert]:
+    """
+    Builds an INSERT for the database in use that supports ON CONFLICT clauses.
+
+    Args:
+        table: Table to insert into.
+
+    Returns:
+        The INSERT statement.
+    """
+    if db.engine.dialect.name == "postgresql":
+        return cast(postgresql.Insert, postgresql.insert(table))
+
+    return cast(sqlite.Insert, sqlite.insert(table))
+
+
+def maintain_post_partitions(
+    premake_months: int, retention_months: Optional[int]
+) -> tuple[list[str], list[str]]:
+    """
+    Creates post partitions for the current and upcoming months, and detaches partitions that are
+    past retention. Posts that landed in the default partition move into the partitions created
+    for their months. What belongs to the posts of a detached partition is archived along with it.
+
+    Args:
+        premake_months: Number of months after the current one to create partitions for.
+        retention_months: Number of months before the current one to keep attached. If None,
+            nothing gets detached.
+
+    Returns:
+        Names of the created partitions and names of the detached partitions.
+    """
+    current_month = month_start(date.today())
+
+    with db.engine.begin() as connection:
+        create_default_partition(connection, "post")
+
+        created = create_month_partitions(
+            connection,
+            "post",
+            current_month,
+            premake_months + 1,
+            while_emptying_default=setting_post_tags_aside,
+        )
+
+        detached = []
+
+        if retention_months is not None:
+            detached = detach_month_partitions(
+                connection,
+                "post",
+                add_months(current_month, -retention_months),
+                before_detach=archive_post_dependents,
+            )
+
+    return created, detached
+
+
+@click.command("rerender-posts")
+@click.option(
+    "--batch-size",
+    default=500,
+    show_default=True,
+    help="Number of posts to re-render per transaction.",
+)
+@with_appcontext
+def rerender_posts_command(batch_size: int) -> None:
+    """
+    Command to re-render posts whose stored HTML came from an older renderer version. Each
+    re-rendered post counts as updated, so that caches and feeds pick up the new HTML.
+
+    Args:
+        batch_size: Number of posts to re-render per transaction.
+    """
+    # Imported here, since the invalidation bus imports the models.
+    from flaskr.invalidation import publish
+
+    post_table = Post.__table__
+
+    statement = (
+        update(post_table)
+        .where(post_table.c.id == bindparam("post_id"))
+        .values(
+            excerpt=bindparam("excerpt"),
+            body_html=bindparam("body_html"),
+            renderer_version=bindparam("renderer_version"),
+            # The version is left alone, so that nobody editing a post loses their changes.
+            updated=func.current_timestamp(),
+        )
+    )
+
+    last_id = 0
+    rerendered = 0
+
+    while True:
+        batch = db.session.execute(
+            select(Post.id, Post.body)
+            .where(Post.renderer_version != RENDERER_VERSION, Post.id > last_id)
+            .order_by(Post.id)
+            .limit(batch_size)
+        ).all()
+
+        if not batch:
+            break
+
+        db.session.execute(
+            statement,
+            [{"post_id": post.id, **derive_body_columns(post.body)} for post in batch],
+        )
+
+        for post in batch:
+            publish("post", post.id, "updated")
+
+        db.session.commit()
+
+        last_id = batch[-1].id
+        rerendered += len(batch)
+
+    click.echo(f"Re-rendered {rerendered} posts.")
+
+
+@click.command("maintain-post-partitions")
+@click.option(
+    "--premake",
+    type=int,
+    default=None,
+    help="Number of upcoming months to create partitions for. Defaults to "
+    "POST_PARTITION_PREMAKE_MONTHS.",
+)
+@click.option(
+    "--retain",
+    type=int,
+    default=None,
+    help="Number of past months to keep attached. Defaults to "
+    "POST_PARTITION_RETENTION_MONTHS, which keeps everything if unset.",
+)
+@with_appcontext
+def maintain_post_partitions_command(
+    premake: Optional[int], retain: Optional[int]
+) -> None:
+    """
+    Command to create upcoming post partitions and detach old ones. Meant to be run on a schedule
+    (e.g. daily).
+
+    Args:
+        premake: Number of upcoming months to create partitions for.
+        retain: Number of past months to keep attached.
+    """
+    if not post_partitioning_enabled():
+        click.echo("Post partitioning is not enabled.")
+
+        return
+
+    config = current_app.config
+
+    created, detached = maintain_post_partitions(
+        premake_months=config["POST_PARTITION_PREMAKE_MONTHS"]
+        if premake is None
+        else premake,
+        retention_months=config["POST_PARTITION_RETENTION_MONTHS"]
+        if retain is None
+        else retain,
+    )
+
+    click.echo(f"Created partitions: {', '.join(created) or 'none'}.")
+    click.echo(f"Detached partitions: {', '.join(detached) or 'none'}.")
+
+
 def init_app(app: Flask) -> None:
     """
     Sets up the app to close the DB when tearing down, and adds the CLI command to initialize the
@@ -95,3 +729,5 @@ def init_app(app: Flask) -> None:
     db.init_app(app)
 
     app.cli.add_command(init_db_command)
+    app.cli.add_command(rerender_posts_command)
+    app.cli.add_command(maintain_post_partitions_command)
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for declarative range partitioning of tables by month on Postgres
+"""
+import re
+from contextlib import AbstractContextManager, nullcontext
+from datetime import date, datetime
+from collections.abc import Callable, Mapping
+from typing import Optional, Union
+
+from sqlalchemy import (
+    ForeignKeyConstraint,
+    MetaData,
+    PrimaryKeyConstraint,
+    Table,
+    text,
+)
+from sqlalchemy.engine import Connection
+
+
+DEFAULT_PARTITION_SUFFIX = "default"
+
+
+def month_start(value: Union[date, datetime]) -> date:
+    """
+    Finds the first day of the month a date falls in.
+
+    Args:
+        value: Date (or datetime) to look at.
+
+    Returns:
+        First day of the month.
+    """
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    """
+    Moves the first day of a month forwards (or backwards) by a number of months.
+
+    Args:
+        month: First day of the month to start from.
+        months: Number of months to move by. Can be negative.
+
+    Returns:
+        First day of the resulting month.
+    """
+    index = month.year * 12 + month.month - 1 + months
+
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def month_partition_name(table_name: str, month: date) -> str:
+    """
+    Builds the name of the partition holding a given month of a table.
+
+    Args:
+        table_name: Name of the partitioned table.
+        month: First day of the month the partition holds.
+
+    Returns:
+        Partition name.
+    """
+    return f"{table_name}_p{month.year:04d}_{month.month:02d}"
+
+
+def parse_month_partition_name(table_name: str, partition_name: str) -> Optional[date]:
+    """
+    Works out which month a partition holds from its name.
+
+    Args:
+        table_name: Name of the partitioned table.
+        partition_name: Name of the partition.
+
+    Returns:
+        First day of the month the partition holds, or None if the name isn't a month partition
+        of the table.
+    """
+    match = re.fullmatch(
+        rf"{re.escape(table_name)}_p(\d{{4}})_(\d{{2}})", partition_name
+    )
+
+    if match is None:
+        return None
+
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def partitioned_metadata(
+    metadata: MetaData,
+    table_name: str,
+    column_name: str,
+    key_copies: Optional[Mapping[str, str]] = None,
+) -> MetaData:
+    """
+    Copies the metadata, turning one table into a table partitioned by range on one of its
+    columns. The ORM keeps using the original metadata, this copy is only used to emit DDL.
+
+    Postgres requires the partition key to be part of the primary key, so it gets added to it.
+    Since that means the original primary key alone is no longer backed by a unique constraint,
+    foreign keys pointing at the partitioned table have to include the partition key too. Tables
+    that keep a copy of it get such a composite foreign key, the others are left without one.
+
+    Args:
+        metadata: Metadata to copy.
+        table_name: Name of the table to partition.
+        column_name: Name of the column to partition by.
+        key_copies: Columns holding a copy of the partition key, by the name of the table they
+            are in.
+
+    Returns:
+        Copied metadata.
+    """
+    key_copies = key_copies or {}
+
+    copy = MetaData()
+
+    for table in metadata.sorted_tables:
+        table.to_metadata(copy)
+
+    partitioned: Table = copy.tables[table_name]
+    partition_key = partitioned.c[column_name]
+
+    primary_key_columns = list(partitioned.primary_key.columns)
+
+    for column in primary_key_columns:
+        column.autoincrement = True
+
+    partition_key.primary_key = True
+    partitioned.append_constraint(
+        PrimaryKeyConstraint(*primary_key_columns, partition_key)
+    )
+    partitioned.dialect_kwargs["postgresql_partition_by"] = f"RANGE ({column_name})"
+
+    for table in copy.tables.values():
+        for constraint in list(table.foreign_key_constraints):
+            if constraint.referred_table is not partitioned:
+                continue
+
+            drop_foreign_key(table, constraint)
+
+            key_copy = key_copies.get(table.name)
+
+            if key_copy is None:
+                continue
+
+            table.append_constraint(
+                ForeignKeyConstraint(
+                    [*constraint.column_keys, key_copy],
+                    [
+                        *(element.column for element in constraint.elements),
+                        partition_key,
+                    ],
+                    ondelete=constraint.ondelete,
+                    onupdate=constraint.onupdate,
+                )
+            )
+
+    return copy
+
+
+def drop_foreign_key(table: Table, constraint: ForeignKeyConstraint) -> None:
+    """
+    Removes a foreign key constraint from a table, along with the foreign keys it put on the
+    table's columns.
+
+    Args:
+        table: Table the constraint is on.
+        constraint: Constraint to remove.
+    """
+    table.constraints.discard(constraint)
+
+    for element in constraint.elements:
+        table.foreign_keys.discard(element)
+
+        if element.parent is not None:
+            element.parent.foreign_keys.discard(element)
+
+
+def create_default_partition(connection: Connection, table_name: str) -> None:
+    """
+    Creates the partition that catches rows no month partition covers, so that writes never fail
+    because maintenance fell behind.
+
+    Args:
+        connection: Connection to run DDL on.
+        table_name: Name of the partitioned table.
+    """
+    connection.execute(
+        text(
+            f'CREATE TABLE IF NOT EXISTS "{table_name}_{DEFAULT_PARTITION_SUFFIX}" '
+            f'PARTITION OF "{table_name}" DEFAULT'
+        )
+    )
+
+
+def list_partitions(connection: Connection, table_name: str) -> list[str]:
+    """
+    Lists the partitions currently attached to a table.
+
+    Args:
+        connection: Connection to query with.
+        table_name: Name of the partitioned table.
+
+    Returns:
+        Names of the attached partitions.
+    """
+    return list(
+        connection.execute(
+            text(
+                "SELECT child.relname FROM pg_inherits "
+                "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+                "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+                "WHERE parent.relname = :table_name "
+                "ORDER BY child.relname"
+            ),
+            {"table_name": table_name},
+        ).scalars()
+    )
+
+
+def create_month_partitions(
+    connection: Connection,
+    table_name: str,
+    first_month: date,
+    months: int,
+    while_emptying_default: Optional[
+        Callable[[Connection, str], AbstractContextManager[None]]
+    ] = None,
+) -> list[str]:
+    """
+    Makes sure month partitions exist for a run of months. Postgres won't create a partition for
+    a month the default partition already holds rows for, so whatever the default partition
+    holds is taken out of it first, and put back through the table once the partitions are
+    created; rows for the new months land in their partitions that way.
+
+    Args:
+        connection: Connection to run DDL on.
+        table_name: Name of the partitioned table.
+        first_month: First day of the first month to cover.
+        months: Number of months to cover, starting with the first one.
+        while_emptying_default: Called with the connection and the name of the default
+            partition, gives a context manager that is entered before the default partition is
+            emptied and left after its rows are put back, e.g. to set rows that refer to them
+            aside, so that cascading deletes leave them alone.
+
+    Returns:
+        Names of the partitions that had to be created.
+    """
+    existing = set(list_partitions(connection, table_name))
+    missing = [
+        add_months(first_month, offset)
+        for offset in range(months)
+        if month_partition_name(table_name, add_months(first_month, offset))
+        not in existing
+    ]
+
+    if not missing:
+        return []
+
+    default_name = f"{table_name}_{DEFAULT_PARTITION_SUFFIX}"
+
+    if (
+        default_name in existing
+        and connection.execute(
+            text(f'SELECT EXISTS (SELECT FROM "{default_name}")')
+        ).scalar_one()
+    ):
+        emptying = (
+            nullcontext()
+            if while_emptying_default is None
+            else while_emptying_default(connection, default_name)
+        )
+
+        with emptying:
+            moved_name = f"{default_name}_moved"
+
+            connection.execute(
+                text(f'CREATE TEMPORARY TABLE "{moved_name}" (LIKE "{default_name}")')
+            )
+            connection.execute(
+                text(
+                    f'WITH moved AS (DELETE FROM "{default_name}" RETURNING *) '
+                    f'INSERT INTO "{moved_name}" SELECT * FROM moved'
+                )
+            )
+
+            created = add_month_partitions(connection, table_name, missing)
+
+            connection.execute(
+                text(f'INSERT INTO "{table_name}" SELECT * FROM "{moved_name}"')
+            )
+            connection.execute(text(f'DROP TABLE "{moved_name}"'))
+
+        return created
+
+    return add_month_partitions(connection, table_name, missing)
+
+
+def add_month_partitions(
+    connection: Connection, table_name: str, months: list[date]
+) -> list[str]:
+    """
+    Creates month partitions, which must not exist yet.
+
+    Args:
+        connection: Connection to run DDL on.
+        table_name: Name of the partitioned table.
+        months: First days of the months to create partitions for.
+
+    Returns:
+        Names of the created partitions.
+    """
+    created = []
+
+    for month in months:
+        name = month_partition_name(table_name, month)
+
+        connection.execute(
+            text(
+                f'CREATE TABLE "{name}" PARTITION OF "{table_name}" '
+                f"FOR VALUES FROM ('{month.isoformat()}') "
+                f"TO ('{add_months(month, 1).isoformat()}')"
+            )
+        )
+
+        created.append(name)
+
+    return created
+
+
+def detach_month_partitions(
+    connection: Connection,
+    table_name: str,
+    before: date,
+    before_detach: Optional[Callable[[Connection, str], None]] = None,
+) -> list[str]:
+    """
+    Detaches the month partitions holding only rows older than a cut off. The detached tables are
+    kept as they are, ready to be archived or dropped.
+
+    Args:
+        connection: Connection to run DDL on.
+        table_name: Name of the partitioned table.
+        before: First day of the oldest month to keep attached.
+        before_detach: Called with the connection and the name of each partition right before
+            it is detached, e.g. to move rows that refer to it out of the way.
+
+    Returns:
+        Names of the partitions that were detached.
+    """
+    detached = []
+
+    for name in list_partitions(connection, table_name):
+        month = parse_month_partition_name(table_name, name)
+
+        if month is None or month >= before:
+            continue
+
+        if before_detach is not None:
+            before_detach(connection, name)
+
+        connection.execute(
+            text(f'ALTER TABLE "{table_name}" DETACH PARTITION "{name}"')
+        )
+
+        detached.append(name)
+
+    return detached
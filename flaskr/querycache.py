@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Process-local cache regions for query results, invalidated by tag through the invalidation bus
+"""
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from collections.abc import Hashable, Iterable
+from typing import Any, Callable, Generic, NamedTuple, Optional, TypeVar, Union, cast
+
+from flask import Flask, current_app
+
+from flaskr.invalidation import RESET, ChangeEvent
+
+
+# Entities whose changes drop the cached results tagged with them.
+INVALIDATING_ENTITIES = ("post", "user")
+
+V = TypeVar("V")
+
+
+class CacheEntry(NamedTuple):
+    """
+    Cached query result.
+    """
+
+    value: Any
+    expires: float
+    tags: tuple[Hashable, ...]
+
+
+class Flight(Generic[V]):
+    """
+    Load of a key that is in progress. Requests for the same key wait for it instead of running
+    the query again.
+    """
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.value: Optional[V] = None
+        self.error: Optional[BaseException] = None
+
+
+class CacheRegion:
+    """
+    Size-bounded LRU cache of query results with a time to live, shared by the threads of a
+    process.
+
+    Entries carry tags, e.g. ("post", 3) for results that depend on post 3 or "post" for results
+    that depend on any post, and are dropped when one of their tags is invalidated. Concurrent
+    misses on the same key are coalesced, so that an expired hot key costs one query rather than
+    one per waiting request.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: float,
+        max_size: int,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.name = name
+        self._ttl = ttl
+        self._max_size = max_size
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, CacheEntry] = OrderedDict()
+        self._tagged_keys: defaultdict[Hashable, set[Hashable]] = defaultdict(set)
+        self._flights: dict[Hashable, Flight[Any]] = {}
+
+        # Bumped by every invalidation, so that loads that were running meanwhile, and might
+        # have read the old data, don't get cached.
+        self._generation = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def get_or_load(
+        self,
+        key: Hashable,
+        load: Callable[[], V],
+        tags: Union[Iterable[Hashable], Callable[[V], Iterable[Hashable]]] = (),
+    ) -> V:
+        """
+        Gets a cached result, or loads and caches it on a miss. If another thread is already
+        loading the key, waits for its result instead.
+
+        None results aren't cached, so that something that doesn't exist yet is found as soon as
+        it does.
+
+        Args:
+            key: Key of the result.
+            load: Function that runs the query. It should return plain values rather than ORM
+                objects, since results are shared between sessions.
+            tags: Tags to file the result under, for invalidation, or a function that gets them
+                from the result.
+
+        Returns:
+            The result.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                if entry.expires > self._clock():
+                    self._entries.move_to_end(key)
+
+                    return cast(V, entry.value)
+
+                self._remove(key)
+
+            flight = self._flights.get(key)
+
+            if flight is not None:
+                leader = False
+            else:
+                leader = True
+                flight = self._flights[key] = Flight()
+                generation = self._generation
+
+        if not leader:
+            flight.done.wait()
+
+            if flight.error is not None:
+                raise flight.error
+
+            return cast(V, flight.value)
+
+        try:
+            flight.value = value = load()
+        except BaseException as error:
+            flight.error = error
+
+            raise
+        else:
+            with self._lock:
+                if value is not None and generation == self._generation:
+                    self._store(
+                        key, value, tuple(tags(value) if callable(tags) else tags)
+                    )
+
+            return value
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+            flight.done.set()
+
+    def invalidate(self, *tags: Hashable) -> None:
+        """
+        Drops the entries filed under any of the tags.
+
+        Args:
+            *tags: Tags to invalidate.
+        """
+        with self._lock:
+            self._generation += 1
+
+            for tag in tags:
+                for key in list(self._tagged_keys.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self) -> None:
+        """
+        Drops all entries.
+        """
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._tagged_keys.clear()
+
+    def _store(self, key: Hashable, value: Any, tags: tuple[Hashable, ...]) -> None:
+        """
+        Caches a result, evicting the least recently used entry if the region is full. Needs the
+        lock to be held.
+
+        Args:
+            key: Key of the result.
+            value: Result to cache.
+            tags: Tags to file the result under.
+        """
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = CacheEntry(value, self._clock() + self._ttl, tags)
+
+        for tag in tags:
+            self._tagged_keys[tag].add(key)
+
+        if len(self._entries) > self._max_size:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: Hashable) -> None:
+        """
+        Drops an entry and unfiles it from its tags. Needs the lock to be held.
+
+        Args:
+            key: Key of the entry.
+        """
+        entry = self._entries.pop(key)
+
+        for tag in entry.tags:
+            keys = self._tagged_keys[tag]
+            keys.discard(key)
+
+            if not keys:
+                del self._tagged_keys[tag]
+
+
+class QueryCache:
+    """
+    The cache regions of an app.
+    """
+
+    def __init__(self, regions: dict[str, CacheRegion]) -> None:
+        self.regions = regions
+
+    def handle_change(self, change: ChangeEvent) -> None:
+        """
+        Drops the results that depend on a changed entity, in every region. A reset drops
+        everything, since not every result is tagged with the entity as a whole.
+
+        Args:
+            change: Change to the entity.
+        """
+        for region in self.regions.values():
+            if change.action == RESET:
+                region.clear()
+            else:
+                region.invalidate(change.entity, (change.entity, change.id))
+
+
+def query_cache(name: str) -> CacheRegion:
+    """
+    Gets a cache region of the current app.
+
+    Args:
+        name: Name of the region, as configured in QUERY_CACHE_REGIONS.
+
+    Returns:
+        The cache region.
+    """
+    return cast(QueryCache, current_app.extensions["query_cache"]).regions[name]
+
+
+def init_app(app: Flask) -> None:
+    """
+    Sets up the cache regions configured in QUERY_CACHE_REGIONS, and has their entries dropped
+    whenever the entities they are tagged with change.
+
+    Args:
+        app (): Flask app instance
+    """
+    cache = QueryCache(
+        {
+            name: CacheRegion(name, settings["ttl"], settings["max_size"])
+            for name, settings in app.config["QUERY_CACHE_REGIONS"].items()
+        }
+    )
+
+    app.extensions["query_cache"] = cache
+
+    for entity in INVALIDATING_ENTITIES:
+        app.extensions["invalidation_bus"].subscribe(entity, cache.handle_change)
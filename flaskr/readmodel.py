@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+Read model for list views, attachments and the edit form: column-only selects that return plain
+immutable rows instead of ORM objects
+"""
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, NamedTuple, Optional, cast
+
+from sqlalchemy import and_, func, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import Select
+
+from flaskr.models import (
+    Attachment,
+    Post,
+    PostCursor,
+    PostDeletion,
+    PostStats,
+    Tag,
+    User,
+    db,
+    post_tag,
+)
+
+
+# Core tables rather than ORM entities, so that selects skip the ORM's loading machinery.
+posts = Post.__table__
+users = User.__table__
+post_stats = PostStats.__table__
+post_deletions = PostDeletion.__table__
+tags = Tag.__table__
+attachments = Attachment.__table__
+
+# Content types that are safe to show in the page and to serve inline. Anything else is served
+# as a download, so that e.g. an uploaded HTML or SVG file can't run scripts on the site.
+INLINE_CONTENT_TYPES = frozenset({"image/gif", "image/jpeg", "image/png", "image/webp"})
+
+
+class PostRow(NamedTuple):
+    """
+    Post as shown on list views.
+    """
+
+    id: int
+    title: str
+    excerpt: str
+    created: datetime
+    author_id: int
+    author_username: str
+    comment_count: int
+    tags: tuple[str, ...] = ()
+
+    @property
+    def cursor(self) -> PostCursor:
+        """
+        Position of the post in the newest-first ordering of posts.
+
+        Returns:
+            Cursor for the post.
+        """
+        return PostCursor(created=self.created, id=self.id)
+
+
+class FeedPostRow(NamedTuple):
+    """
+    Post as shown in feeds.
+    """
+
+    id: int
+    title: str
+    excerpt: str
+    body_html: str
+    created: datetime
+    updated: Optional[datetime]
+    author_username: str
+
+    @property
+    def cursor(self) -> PostCursor:
+        """
+        Position of the post in the newest-first ordering of posts.
+
+        Returns:
+            Cursor for the post.
+        """
+        return PostCursor(created=self.created, id=self.id)
+
+
+class AttachmentRow(NamedTuple):
+    """
+    File attached to a post.
+    """
+
+    id: int
+    post_id: int
+    filename: str
+    content_type: str
+    size: int
+    sha256: str
+    storage_key: str
+
+    @property
+    def inline(self) -> bool:
+        """
+        Whether the file can be shown in the page.
+
+        Returns:
+            boolean indicating if the file is an image that is safe to show inline.
+        """
+        return self.content_type in INLINE_CONTENT_TYPES
+
+
+attachment_columns = [attachments.c[field] for field in AttachmentRow._fields]
+
+
+class EditablePostRow(NamedTuple):
+    """
+    Post as shown on the edit form.
+    """
+
+    id: int
+    author_id: int
+    title: str
+    body: str
+    version: int
+    created: datetime
+    tags: tuple[str, ...] = ()
+
+
+def load_tag_names(post_ids: list[int]) -> dict[int, tuple[str, ...]]:
+    """
+    Loads the tag names of a batch of posts in one query.
+
+    Args:
+        post_ids: IDs of the posts.
+
+    Returns:
+        Sorted tag names, by post ID. Posts without tags are left out.
+    """
+    names: defaultdict[int, list[str]] = defaultdict(list)
+
+    if not post_ids:
+        return {}
+
+    for post_id, name in db.session.execute(
+        select(post_tag.c.post_id, tags.c.name)
+        .join(tags, tags.c.id == post_tag.c.tag_id)
+        .where(post_tag.c.post_id.in_(post_ids))
+        .order_by(post_tag.c.post_id, tags.c.name)
+    ):
+        names[post_id].append(name)
+
+    return {post_id: tuple(post_names) for post_id, post_names in names.items()}
+
+
+def load_attachments(post_ids: list[int]) -> dict[int, tuple[AttachmentRow, ...]]:
+    """
+    Loads the attachments of a batch of posts in one query.
+
+    Args:
+        post_ids: IDs of the posts.
+
+    Returns:
+        Attachments in upload order, by post ID. Posts without attachments are left out.
+    """
+    post_attachments: defaultdict[int, list[AttachmentRow]] = defaultdict(list)
+
+    if not post_ids:
+        return {}
+
+    for row in db.session.execute(
+        select(*attachment_columns)
+        .where(attachments.c.post_id.in_(post_ids))
+        .order_by(attachments.c.post_id, attachments.c.id)
+    ):
+        post_attachments[row.post_id].append(AttachmentRow(*row))
+
+    return {post_id: tuple(rows) for post_id, rows in post_attachments.items()}
+
+
+def load_post_counts(post_ids: list[int]) -> dict[int, tuple[int, int]]:
+    """
+    Loads the view and like counts of a batch of posts in one query.
+
+    Args:
+        post_ids: IDs of the posts.
+
+    Returns:
+        Views and likes, by post ID. Posts that were never counted are left out.
+    """
+    if not post_ids:
+        return {}
+
+    return {
+        row.post_id: (row.views, row.likes)
+        for row in db.session.execute(
+            select(post_stats.c.post_id, post_stats.c.views, post_stats.c.likes).where(
+                post_stats.c.post_id.in_(post_ids)
+            )
+        )
+    }
+
+
+def listed_posts_select() -> Select:
+    """
+    Builds the select of the columns of a PostRow, except for the tags.
+
+    Returns:
+        The select, for all posts.
+    """
+    return select(
+        posts.c.id,
+        posts.c.title,
+        posts.c.excerpt,
+        posts.c.created,
+        posts.c.author_id,
+        users.c.username,
+        posts.c.comment_count,
+    ).join(users, users.c.id == posts.c.author_id)
+
+
+def list_posts(
+    limit: int, before: Optional[PostCursor] = None, tag_id: Optional[int] = None
+) -> list[PostRow]:
+    """
+    Loads a page of posts for list views, newest first, with their authors, comment counts and
+    tags. Takes two queries: one for the posts, and one for the tags of the whole page. View and
+    like counts are left out, see load_post_counts.
+
+    Args:
+        limit: Maximum number of posts to load.
+        before: If given, only posts that come after this cursor are loaded.
+        tag_id: If given, only posts with this tag are loaded.
+
+    Returns:
+        The posts.
+    """
+    statement = listed_posts_select()
+
+    created, post_id = posts.c.created, posts.c.id
+
+    if tag_id is not None:
+        # Page through the tag's rows in the association table instead, which are indexed in
+        # the order posts are listed in.
+        created, post_id = post_tag.c.post_created, post_tag.c.post_id
+
+        statement = statement.join(
+            post_tag,
+            and_(
+                post_tag.c.post_id == posts.c.id,
+                post_tag.c.post_created == posts.c.created,
+            ),
+        ).where(post_tag.c.tag_id == tag_id)
+
+    if before is not None:
+        statement = statement.where(before.comes_before(created, post_id))
+
+    rows = db.session.execute(
+        statement.order_by(created.desc(), post_id.desc()).limit(limit)
+    ).all()
+
+    tag_names = load_tag_names([row[0] for row in rows])
+
+    return [PostRow._make((*row, tag_names.get(row[0], ()))) for row in rows]
+
+
+def get_listed_post(connection: Connection, post_id: int) -> Optional[PostRow]:
+    """
+    Loads a post the way list_posts does. Runs on the given connection rather than the session, so
+    that it can be used while the session is committing.
+
+    Args:
+        connection: Connection to query with.
+        post_id: ID of the post.
+
+    Returns:
+        The post, or None if there is no such post.
+    """
+    row = connection.execute(
+        listed_posts_select().where(posts.c.id == post_id)
+    ).one_or_none()
+
+    if row is None:
+        return None
+
+    tag_names = connection.execute(
+        select(tags.c.name)
+        .join(post_tag, post_tag.c.tag_id == tags.c.id)
+        .where(post_tag.c.post_id == post_id)
+        .order_by(tags.c.name)
+    ).scalars()
+
+    return PostRow._make((*row, tuple(tag_names)))
+
+
+def list_feed_posts(
+    *conditions: Any, author_id: Optional[int] = None, limit: int
+) -> list[FeedPostRow]:
+    """
+    Loads posts for a feed, newest first.
+
+    Args:
+        *conditions: Conditions the posts have to match.
+        author_id: If given, only posts by this author are loaded.
+        limit: Maximum number of posts to load.
+
+    Returns:
+        The posts.
+    """
+    statement = (
+        select(
+            posts.c.id,
+            posts.c.title,
+            posts.c.excerpt,
+            posts.c.body_html,
+            posts.c.created,
+            posts.c.updated,
+            users.c.username,
+        )
+        .join(users, users.c.id == posts.c.author_id)
+        .where(*conditions)
+    )
+
+    if author_id is not None:
+        statement = statement.where(posts.c.author_id == author_id)
+
+    return [
+        FeedPostRow(*row)
+        for row in db.session.execute(
+            statement.order_by(posts.c.created.desc(), posts.c.id.desc()).limit(limit)
+        )
+    ]
+
+
+def get_last_post_deletion(author_id: Optional[int] = None) -> Optional[datetime]:
+    """
+    Looks up when a post was last deleted.
+
+    Args:
+        author_id: If given, only posts by this author are considered.
+
+    Returns:
+        Time of the last deletion, or None if no post was ever deleted.
+    """
+    statement = select(func.max(post_deletions.c.deleted_at))
+
+    if author_id is not None:
+        statement = statement.where(post_deletions.c.author_id == author_id)
+
+    return cast(Optional[datetime], db.session.execute(statement).scalar())
+
+
+def get_editable_post(post_id: int) -> Optional[EditablePostRow]:
+    """
+    Loads a post for the edit form.
+
+    Args:
+        post_id: ID of the post.
+
+    Returns:
+        The post, or None if there is no such post.
+    """
+    row = db.session.execute(
+        select(
+            posts.c.id,
+            posts.c.author_id,
+            posts.c.title,
+            posts.c.body,
+            posts.c.version,
+            posts.c.created,
+        ).where(posts.c.id == post_id)
+    ).first()
+
+    if row is None:
+        return None
+
+    return EditablePostRow._make((*row, load_tag_names([post_id]).get(post_id, ())))
+
+
+def get_attachment(attachment_id: int) -> Optional[AttachmentRow]:
+    """
+    Loads an attachment.
+
+    Args:
+        attachment_id: ID of the attachment.
+
+    Returns:
+        The attachment, or None if there is no such attachment.
+    """
+    row = db.session.execute(
+        select(*attachment_columns).where(attachments.c.id == attachment_id)
+    ).first()
+
+    return None if row is None else AttachmentRow(*row)
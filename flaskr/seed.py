@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk seeding of the database with generated users and posts, for development and benchmarks
+"""
+import random
+import time
+from collections.abc import Iterator
+from datetime import datetime, timedelta
+from typing import Any, NamedTuple
+
+import click
+from flask import Flask
+from flask.cli import with_appcontext
+from sqlalchemy import func, insert, select, text
+from werkzeug.security import generate_password_hash
+
+from flaskr.models import Post, User, db, derive_body_columns
+
+
+WORDS = (
+    "able about account after again air answer area back bank base bird black body book "
+    "bread call care carry case cause center change city class clear close cloud color common "
+    "copy corner country course cover cross current dark data day deep design detail dog door "
+    "draw dream drive early earth east easy edge energy even event every eye face fact fall "
+    "farm field figure fine fire fish floor flower fly food force forest form free friend "
+    "front game garden glass gold good grass great green ground group grow half hand happy "
+    "hard heart heat help high hill hold home hope horse hour house idea island joy keep kind "
+    "king land large late laugh learn light line list little long machine main map mark "
+    "market matter middle mind moon morning mountain music name nature near night north note "
+    "number ocean office open order page paper park part party path pattern people piece place "
+    "plan plant point power press product quick quiet rain reach read ready record red river "
+    "road rock room round rule run safe salt sand school science sea season second seed shape "
+    "ship short side sign simple size sky sleep slow small snow song sound south space spring "
+    "square stand star start step stone story street strong summer sun system table tall "
+    "team test thought time today town track tree true turn type under unit valley view "
+    "voice walk warm watch water wave week west wheel white wide wind window winter wood word "
+    "work world year young"
+).split()
+
+# Rendering Markdown is by far the slowest part of making a post, so posts share a pool of bodies
+# that are each rendered once.
+BODY_VARIANTS = 200
+
+
+class SeedResult(NamedTuple):
+    """
+    What a seeding run added to the database.
+    """
+
+    users: int
+    posts: int
+
+
+def make_sentence(rng: random.Random, min_words: int, max_words: int) -> str:
+    """
+    Makes up a sentence.
+
+    Args:
+        rng: Random number generator to draw words with.
+        min_words: Minimum number of words.
+        max_words: Maximum number of words.
+
+    Returns:
+        Capitalized sentence, without punctuation at the end.
+    """
+    words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+
+    return " ".join(words).capitalize()
+
+
+def make_body(rng: random.Random) -> str:
+    """
+    Makes up a post body of a few Markdown paragraphs.
+
+    Args:
+        rng: Random number generator to draw words with.
+
+    Returns:
+        Post body.
+    """
+    paragraphs = []
+
+    for _ in range(rng.randint(1, 4)):
+        sentences = [make_sentence(rng, 4, 16) for _ in range(rng.randint(2, 6))]
+
+        paragraphs.append(". ".join(sentences) + ".")
+
+    if rng.random() < 0.3:
+        paragraphs.append(f"**{make_sentence(rng, 2, 5)}**")
+
+    return "\n\n".join(paragraphs)
+
+
+def batches(
+    rows: Iterator[dict[str, Any]], size: int
+) -> Iterator[list[dict[str, Any]]]:
+    """
+    Groups rows into lists of a fixed size (except for the last one).
+
+    Args:
+        rows: Rows to group.
+        size: Number of rows per batch.
+
+    Returns:
+        Generator of batches.
+    """
+    batch = []
+
+    for row in rows:
+        batch.append(row)
+
+        if len(batch) == size:
+            yield batch
+
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def seed_database(
+    users: int,
+    posts: int,
+    seed: int = 0,
+    password: str = "password",
+    batch_size: int = 5000,
+    start: datetime = datetime(2020, 1, 1),
+    days: int = 730,
+) -> SeedResult:
+    """
+    Adds generated users and posts to the database with batched Core inserts. The same seed always
+    generates the same data. Needs an app context.
+
+    All users share the same password, which is only hashed once.
+
+    Args:
+        users: Number of users to add.
+        posts: Number of posts to add, spread randomly over the new users.
+        seed: Seed for the random number generator.
+        password: Password of every new user.
+        batch_size: Number of rows per INSERT.
+        start: Earliest post creation time.
+        days: Number of days after the start to spread post creation times over.
+
+    Returns:
+        Number of users and posts added.
+    """
+    rng = random.Random(seed)
+
+    password_hash = generate_password_hash(password)
+
+    user_table = User.__table__
+
+    with db.engine.begin() as connection:
+        # Users get explicit IDs, so that posts can be assigned to them without reading them back.
+        first_user_id = (
+            connection.execute(select(func.max(user_table.c.id))).scalar() or 0
+        ) + 1
+
+        user_rows = (
+            {"id": user_id, "username": f"user{user_id}", "password": password_hash}
+            for user_id in range(first_user_id, first_user_id + users)
+        )
+
+        for batch in batches(user_rows, batch_size):
+            connection.execute(insert(user_table), batch)
+
+        if users and db.engine.dialect.name == "postgresql":
+            # Move the ID sequence past the explicit IDs, so that sign ups keep working.
+            connection.execute(
+                text(
+                    "SELECT setval(pg_get_serial_sequence('\"user\"', 'id'), "
+                    '(SELECT max(id) FROM "user"))'
+                )
+            )
+
+    bodies = []
+
+    for _ in range(BODY_VARIANTS if posts else 0):
+        body = make_body(rng)
+
+        bodies.append({"body": body, **derive_body_columns(body)})
+
+    seconds = days * 24 * 60 * 60
+
+    post_rows = (
+        {
+            "author_id": rng.randrange(first_user_id, first_user_id + users),
+            "title": make_sentence(rng, 2, 8),
+            "created": start + timedelta(seconds=rng.randrange(seconds)),
+            **rng.choice(bodies),
+        }
+        for _ in range(posts if users else 0)
+    )
+
+    for batch in batches(post_rows, batch_size):
+        with db.engine.begin() as connection:
+            connection.execute(insert(Post.__table__), batch)
+
+    return SeedResult(users=users, posts=posts if users else 0)
+
+
+@click.command("seed-db")
+@click.option(
+    "--users", default=1000, show_default=True, help="Number of users to add."
+)
+@click.option(
+    "--posts", default=10_000, show_default=True, help="Number of posts to add."
+)
+@click.option(
+    "--seed",
+    default=0,
+    show_default=True,
+    help="Random seed. The same seed always generates the same data.",
+)
+@click.option(
+    "--password",
+    default="password",
+    show_default=True,
+    help="Password of every added user.",
+)
+@click.option(
+    "--batch-size",
+    default=5000,
+    show_default=True,
+    help="Number of rows per INSERT.",
+)
+@with_appcontext
+def seed_db_command(
+    users: int, posts: int, seed: int, password: str, batch_size: int
+) -> None:
+    """
+    Command to fill the database with generated users and posts.
+
+    Args:
+        users: Number of users to add.
+        posts: Number of posts to add.
+        seed: Random seed.
+        password: Password of every added user.
+        batch_size: Number of rows per INSERT.
+    """
+    started = time.perf_counter()
+
+    result = seed_database(
+        users, posts, seed=seed, password=password, batch_size=batch_size
+    )
+
+    click.echo(
+        f"Added {result.users} users and {result.posts} posts in "
+        f"{time.perf_counter() - started:.1f}s."
+    )
+
+
+def init_app(app: Flask) -> None:
+    """
+    Adds the CLI command to seed the database.
+
+    Args:
+        app (): Flask app instance
+    """
+    app.cli.add_command(seed_db_command)
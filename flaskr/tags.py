@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Writes that tag and untag posts, keeping each tag's post count in sync
+"""
+from sqlalchemy import delete, insert, select, update
+
+from flaskr.models import Post, Tag, db, dialect_insert, post_tag
+
+
+MAX_TAGS = 10
+MAX_TAG_LENGTH = 50
+
+
+def parse_tags(value: str) -> list[str]:
+    """
+    Turns the comma separated tags typed into a form into tag names. Names are lower cased, with
+    runs of whitespace collapsed, and duplicates are dropped.
+
+    Args:
+        value: Comma separated tags.
+
+    Returns:
+        Tag names, in the order they were given, at most MAX_TAGS of them.
+    """
+    names: list[str] = []
+
+    for name in value.split(","):
+        name = " ".join(name.split()).lower()[:MAX_TAG_LENGTH]
+
+        if name and name not in names:
+            names.append(name)
+
+    return names[:MAX_TAGS]
+
+
+def get_tag_ids(names: list[str]) -> list[int]:
+    """
+    Looks up the IDs of tags, creating the ones that don't exist yet. Safe to run concurrently
+    with other requests creating the same tags.
+
+    Args:
+        names: Names of the tags.
+
+    Returns:
+        IDs of the tags.
+    """
+    if not names:
+        return []
+
+    db.session.execute(
+        dialect_insert(Tag.__table__).on_conflict_do_nothing(),
+        [{"name": name, "post_count": 0} for name in sorted(names)],
+    )
+
+    return list(db.session.execute(select(Tag.id).where(Tag.name.in_(names))).scalars())
+
+
+def adjust_post_counts(tag_ids: list[int], delta: int) -> None:
+    """
+    Adds to (or subtracts from) the post counts of tags.
+
+    Args:
+        tag_ids: IDs of the tags to adjust.
+        delta: Amount to add to each count.
+    """
+    if not tag_ids:
+        return
+
+    db.session.execute(
+        # Sorted, so that concurrent writes lock tag rows in the same order.
+        update(Tag)
+        .where(Tag.id.in_(sorted(tag_ids)))
+        .values(post_count=Tag.post_count + delta)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def set_post_tags(post_id: int, names: list[str]) -> None:
+    """
+    Replaces the tags of a post. Only the tags that were added or removed are written, and their
+    post counts adjusted, in the current transaction.
+
+    Args:
+        post_id: ID of the post, which has to be flushed already.
+        names: Names of the tags the post should have.
+    """
+    current = set(
+        db.session.execute(
+            select(post_tag.c.tag_id).where(post_tag.c.post_id == post_id)
+        ).scalars()
+    )
+    wanted = set(get_tag_ids(names))
+
+    removed = sorted(current - wanted)
+    added = sorted(wanted - current)
+
+    if removed:
+        db.session.execute(
+            delete(post_tag).where(
+                post_tag.c.post_id == post_id, post_tag.c.tag_id.in_(removed)
+            )
+        )
+
+    if added:
+        created = db.session.execute(
+            select(Post.created).where(Post.id == post_id)
+        ).scalar_one()
+
+        db.session.execute(
+            insert(post_tag),
+            [
+                {"post_id": post_id, "tag_id": tag_id, "post_created": created}
+                for tag_id in added
+            ],
+        )
+
+    adjust_post_counts(removed, -1)
+    adjust_post_counts(added, 1)
+
+
+def get_post_tag_ids(post_id: int) -> list[int]:
+    """
+    Lists the tags of a post, e.g. to take it out of their post counts once it is deleted.
+
+    Args:
+        post_id: ID of the post.
+
+    Returns:
+        IDs of the post's tags.
+    """
+    return list(
+        db.session.execute(
+            select(post_tag.c.tag_id).where(post_tag.c.post_id == post_id)
+        ).scalars()
+    )
@@ -0,0 +1,698 @@
+# -*- coding: utf-8 -*-
+"""
+Request tracing: spans for requests, views, template rendering, password checks and SQL
+statements, exported in batches from a background thread
+"""
+import atexit
+import functools
+import json
+import os
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+from collections import deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Any, Callable, NamedTuple, Optional, Protocol, cast
+
+from flask import Flask, Response, current_app, g, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from flaskr.types import ViewResponseType
+
+
+TRACEPARENT_PATTERN = re.compile(
+    r"^00-(?P<trace_id>[0-9a-f]{32})-(?P<span_id>[0-9a-f]{16})-(?P<flags>[0-9a-f]{2})$"
+)
+
+SAMPLED_FLAG = 0x01
+
+# Long statements (e.g. bulk inserts) are cut short, to keep spans small.
+MAX_STATEMENT_LENGTH = 1000
+
+
+class Span:
+    """
+    Timed operation within a trace. Spans of traces that aren't sampled are only kept for the
+    request itself, so that its trace context can still be passed on, and are never exported.
+    """
+
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "sampled",
+        "attributes",
+        "error",
+        "start",
+        "end",
+        "_started",
+        "_on_end",
+    )
+
+    def __init__(
+        self,
+        trace_id: str,
+        parent_id: Optional[str],
+        name: str,
+        sampled: bool,
+        on_end: Callable[["Span"], None],
+        attributes: Optional[dict[str, Any]] = None,
+    ) -> None:
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.sampled = sampled
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self._started = time.perf_counter()
+        self._on_end = on_end
+
+    def child(self, name: str, attributes: Optional[dict[str, Any]] = None) -> "Span":
+        """
+        Starts a span within this one.
+
+        Args:
+            name: Name of the operation.
+            attributes: Details of the operation.
+
+        Returns:
+            The new span.
+        """
+        return Span(
+            self.trace_id, self.span_id, name, self.sampled, self._on_end, attributes
+        )
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """
+        Ends the span and hands it over for export, if it is sampled.
+
+        Args:
+            error: Error the operation failed with, if any.
+        """
+        self.end = self.start + time.perf_counter() - self._started
+
+        if error is not None:
+            self.error = repr(error)
+
+        if self.sampled:
+            self._on_end(self)
+
+    @property
+    def traceparent(self) -> str:
+        """
+        Trace context of the span, as a W3C traceparent header value.
+
+        Returns:
+            traceparent header value.
+        """
+        return f"00-{self.trace_id}-{self.span_id}-{SAMPLED_FLAG if self.sampled else 0:02x}"
+
+    def to_json(self) -> dict[str, Any]:
+        """
+        Converts the span to its exported representation.
+
+        Returns:
+            JSON serializable span.
+        """
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+@contextmanager
+def start_span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """
+    Times an operation as a span within the current one. Does next to nothing if there is no
+    current span or its trace isn't sampled, so it is cheap to leave in hot code.
+
+    Args:
+        name: Name of the operation.
+        **attributes: Details of the operation.
+
+    Returns:
+        Context manager that yields the span, or None if the operation isn't traced.
+    """
+    parent = current_span.get()
+
+    if parent is None or not parent.sampled:
+        yield None
+
+        return
+
+    span = parent.child(name, attributes)
+    token = current_span.set(span)
+
+    try:
+        yield span
+    except BaseException as error:
+        span.error = repr(error)
+
+        raise
+    finally:
+        current_span.reset(token)
+        span.finish()
+
+
+class TraceParent(NamedTuple):
+    """
+    Trace context received from the caller.
+    """
+
+    trace_id: str
+    span_id: str
+    sampled: bool
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[TraceParent]:
+    """
+    Parses a W3C traceparent header.
+
+    Args:
+        value: Header value.
+
+    Returns:
+        The trace context, or None if the header is missing or invalid.
+    """
+    match = TRACEPARENT_PATTERN.match(value or "")
+
+    if match is None:
+        return None
+
+    trace_id, span_id, flags = match.groups()
+
+    if int(trace_id, 16) == 0 or int(span_id, 16) == 0:
+        return None
+
+    return TraceParent(trace_id, span_id, bool(int(flags, 16) & SAMPLED_FLAG))
+
+
+def current_traceparent() -> Optional[str]:
+    """
+    Gets the traceparent header to send along with outgoing calls, so that their spans join the
+    current trace.
+
+    Returns:
+        traceparent header value, or None if nothing is being traced.
+    """
+    span = current_span.get()
+
+    return None if span is None else span.traceparent
+
+
+class SpanExporter(Protocol):
+    """
+    Destination for finished spans.
+    """
+
+    def export(self, spans: list[dict[str, Any]]) -> None:
+        """
+        Sends a batch of spans on.
+
+        Args:
+            spans: Spans to export.
+        """
+
+
+class JsonFileExporter:
+    """
+    Appends spans to a file, one JSON object per line.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: list[dict[str, Any]]) -> None:
+        """
+        Appends a batch of spans to the file.
+
+        Args:
+            spans: Spans to export.
+        """
+        lines = "".join(json.dumps(span) + "\n" for span in spans)
+
+        with self._lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(lines)
+
+
+class MemoryExporter:
+    """
+    Keeps the latest spans in memory, standing in for a local collector during development and
+    tests.
+    """
+
+    def __init__(self, max_spans: int = 10000) -> None:
+        self.spans: deque[dict[str, Any]] = deque(maxlen=max_spans)
+
+    def export(self, spans: list[dict[str, Any]]) -> None:
+        """
+        Adds a batch of spans to the kept ones.
+
+        Args:
+            spans: Spans to export.
+        """
+        self.spans.extend(spans)
+
+
+class BatchSpanProcessor:
+    """
+    Queues finished spans and exports them in batches from a background thread, so that requests
+    never wait on the exporter. Spans that don't fit in the queue are dropped and counted.
+    """
+
+    def __init__(self, app: Flask, exporter: SpanExporter) -> None:
+        self._app = app
+        self._exporter = exporter
+        self._queue: queue.Queue[Span] = queue.Queue(
+            app.config["TRACING_MAX_QUEUE_SIZE"]
+        )
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        self._exporter_pid: Optional[int] = None
+        self.dropped = 0
+
+    def on_end(self, span: Span) -> None:
+        """
+        Queues a finished span for export.
+
+        Args:
+            span: Finished span.
+        """
+        self.ensure_exporting()
+
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def ensure_exporting(self) -> None:
+        """
+        Starts the exporter thread if this process doesn't have one yet, unless the export
+        interval is set to None. Checks the process ID, so that forked processes start their own
+        thread.
+        """
+        if self._exporter_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._exporter_pid == os.getpid():
+                return
+
+            self._exporter_pid = os.getpid()
+
+            if self._app.config["TRACING_EXPORT_INTERVAL"] is None:
+                return
+
+            threading.Thread(
+                target=self._export_forever, name="span-exporter", daemon=True
+            ).start()
+
+            atexit.register(self.flush)
+
+    def flush(self) -> int:
+        """
+        Exports all queued spans right away.
+
+        Returns:
+            Number of spans exported.
+        """
+        exported = 0
+
+        while True:
+            batch = self._take_batch(timeout=None)
+
+            if not batch:
+                return exported
+
+            self._export(batch)
+
+            exported += len(batch)
+
+    def _export_forever(self) -> None:
+        """
+        Exports a batch whenever it is full, or the export interval has passed since its first
+        span came in.
+        """
+        while True:
+            batch = self._take_batch(
+                timeout=self._app.config["TRACING_EXPORT_INTERVAL"]
+            )
+
+            if batch:
+                self._export(batch)
+
+    def _take_batch(self, timeout: Optional[float]) -> list[Span]:
+        """
+        Takes up to a batch's worth of spans off the queue.
+
+        Args:
+            timeout: Seconds to wait for the batch to fill up, after its first span. If None,
+                only takes spans that are already queued.
+
+        Returns:
+            The spans.
+        """
+        batch_size = self._app.config["TRACING_BATCH_SIZE"]
+
+        try:
+            batch = [
+                self._queue.get(timeout=timeout)
+                if timeout
+                else self._queue.get_nowait()
+            ]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + (timeout or 0)
+
+        while len(batch) < batch_size:
+            remaining = deadline - time.monotonic()
+
+            try:
+                batch.append(
+                    self._queue.get(timeout=remaining)
+                    if remaining > 0
+                    else self._queue.get_nowait()
+                )
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _export(self, batch: list[Span]) -> None:
+        """
+        Hands a batch of spans to the exporter. A failing exporter only loses the batch.
+
+        Args:
+            batch: Spans to export.
+        """
+        try:
+            with self._export_lock:
+                self._exporter.export([span.to_json() for span in batch])
+        except Exception:
+            self._app.logger.exception("Failed to export %s spans.", len(batch))
+
+
+class Tracer:
+    """
+    Starts a trace for each request, and feeds finished spans to the batch processor.
+    """
+
+    def __init__(self, app: Flask, exporter: SpanExporter) -> None:
+        self._app = app
+        self.processor = BatchSpanProcessor(app, exporter)
+
+    def start_request_span(self) -> None:
+        """
+        Starts the span of the current request. Continues the caller's trace if the request has a
+        valid traceparent header, and follows the caller's sampling decision in that case.
+        """
+        parent = parse_traceparent(request.headers.get("traceparent"))
+
+        if parent is None:
+            trace_id = secrets.token_hex(16)
+            parent_id = None
+            sampled = random.random() < self._app.config["TRACING_SAMPLE_RATE"]
+        else:
+            trace_id, parent_id, sampled = parent
+
+        rule = request.url_rule
+
+        span = Span(
+            trace_id,
+            parent_id,
+            f"{request.method} {rule.rule if rule else 'unmatched'}",
+            sampled,
+            self.processor.on_end,
+            {"http.method": request.method, "http.target": request.full_path},
+        )
+
+        g.tracing = (span, current_span.set(span))
+
+    def end_request_span(self, error: Optional[BaseException]) -> None:
+        """
+        Ends the span of the current request.
+
+        Args:
+            error: Unhandled error the request failed with, if any.
+        """
+        tracing: Optional[tuple[Span, Token[Optional[Span]]]] = g.pop("tracing", None)
+
+        if tracing is None:
+            return
+
+        span, token = tracing
+
+        current_span.reset(token)
+        span.finish(error)
+
+    def add_trace_response(self, response: Response) -> Response:
+        """
+        Records the response status on the request span, and tells the caller which trace the
+        request ended up in.
+
+        Args:
+            response: Response to the request.
+
+        Returns:
+            The response.
+        """
+        span = current_span.get()
+
+        if span is not None:
+            span.attributes["http.status_code"] = response.status_code
+            response.headers["traceresponse"] = span.traceparent
+
+        return response
+
+
+class TracedTemplate(Template):
+    """
+    Template that times its rendering as a span.
+    """
+
+    def render(self, *args: Any, **kwargs: Any) -> str:
+        """
+        Renders the template.
+
+        Args:
+            *args: Template context.
+            **kwargs: Template context.
+
+        Returns:
+            Rendered template.
+        """
+        with start_span(f"render {self.name}"):
+            return super().render(*args, **kwargs)
+
+
+def traced_view(
+    endpoint: str, view: Callable[..., ViewResponseType]
+) -> Callable[..., ViewResponseType]:
+    """
+    Wraps a view function so that it runs in a span.
+
+    Args:
+        endpoint: Endpoint of the view.
+        view: View function.
+
+    Returns:
+        Wrapped view function.
+    """
+
+    @functools.wraps(view)
+    def wrapped_view(**kwargs: Any) -> ViewResponseType:
+        """
+        Calls the view in a span.
+
+        Args:
+            **kwargs (): kwargs for view.
+
+        Returns:
+            Return value of the view.
+        """
+        with start_span(f"view {endpoint}"):
+            return view(**kwargs)
+
+    return wrapped_view
+
+
+def trace_views(app: Flask, *blueprints: str) -> None:
+    """
+    Has the views of blueprints run in spans, if tracing is enabled. Needs to run after the
+    blueprints are registered.
+
+    Args:
+        app (): Flask app instance
+        *blueprints: Names of the blueprints.
+    """
+    if "tracer" not in app.extensions:
+        return
+
+    for endpoint, view in list(app.view_functions.items()):
+        if endpoint.partition(".")[0] in blueprints:
+            app.view_functions[endpoint] = traced_view(endpoint, view)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement_span(
+    connection: Any,
+    cursor: Any,
+    statement: str,
+    parameters: Any,
+    context: Any,
+    executemany: bool,
+) -> None:
+    """
+    Starts a span for a SQL statement, if the current trace is sampled.
+
+    Args:
+        connection: Connection running the statement.
+        cursor: DBAPI cursor, unused.
+        statement: SQL of the statement.
+        parameters: Parameters of the statement, unused.
+        context: Execution context, where the span is kept until the statement is done.
+        executemany: Whether the statement runs for many sets of parameters.
+    """
+    parent = current_span.get()
+
+    if parent is None or not parent.sampled:
+        return
+
+    context.tracing_span = parent.child(
+        "sql",
+        {
+            "db.system": connection.dialect.name,
+            "db.statement": statement[:MAX_STATEMENT_LENGTH],
+            "db.executemany": executemany,
+        },
+    )
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_statement_span(
+    connection: Any,
+    cursor: Any,
+    statement: str,
+    parameters: Any,
+    context: Any,
+    executemany: bool,
+) -> None:
+    """
+    Ends the span of a SQL statement.
+
+    Args:
+        connection: Connection that ran the statement, unused.
+        cursor: DBAPI cursor, unused.
+        statement: SQL of the statement, unused.
+        parameters: Parameters of the statement, unused.
+        context: Execution context the span was kept in.
+        executemany: Whether the statement ran for many sets of parameters, unused.
+    """
+    span: Optional[Span] = getattr(context, "tracing_span", None)
+
+    if span is not None:
+        del context.tracing_span
+
+        span.finish()
+
+
+@event.listens_for(Engine, "handle_error")
+def end_failed_statement_span(exception_context: Any) -> None:
+    """
+    Ends the span of a SQL statement that failed.
+
+    Args:
+        exception_context: Details of the failure.
+    """
+    context = exception_context.execution_context
+    span: Optional[Span] = getattr(context, "tracing_span", None)
+
+    if span is not None:
+        del context.tracing_span
+
+        span.finish(exception_context.original_exception)
+
+
+def tracer() -> Tracer:
+    """
+    Gets the tracer of the current app.
+
+    Returns:
+        The app's tracer.
+    """
+    return cast(Tracer, current_app.extensions["tracer"])
+
+
+def make_exporter(app: Flask) -> Optional[SpanExporter]:
+    """
+    Sets up the exporter named in TRACING_EXPORTER. The setting can also hold an exporter
+    object, to plug in another destination.
+
+    Args:
+        app (): Flask app instance
+
+    Returns:
+        The exporter, or None if tracing is off.
+    """
+    exporter = app.config["TRACING_EXPORTER"]
+
+    if exporter == "json":
+        return JsonFileExporter(
+            os.path.join(app.instance_path, app.config["TRACING_FILE"])
+        )
+
+    if exporter == "memory":
+        return MemoryExporter()
+
+    if isinstance(exporter, str):
+        raise ValueError(f"Unknown tracing exporter {exporter!r}.")
+
+    return cast(Optional[SpanExporter], exporter)
+
+
+def init_app(app: Flask) -> None:
+    """
+    Sets up tracing for the app, unless no exporter is configured. Needs to run right after the
+    concurrency limiter is set up, and before anything else registers request hooks, so that the
+    request span covers all the work done for admitted requests. Shed requests get no span, they
+    are only counted by the limiter.
+
+    Args:
+        app (): Flask app instance
+    """
+    exporter = make_exporter(app)
+
+    if exporter is None:
+        return
+
+    tracer = Tracer(app, exporter)
+
+    app.extensions["tracer"] = tracer
+
+    app.before_request(tracer.start_request_span)
+    app.after_request(tracer.add_trace_response)
+    app.teardown_request(tracer.end_request_span)
+
+    app.jinja_env.template_class = TracedTemplate
@@ -12,7 +12,9 @@ from flask_sqlalchemy import SQLAlchemy
 from werkzeug import Response
 
 from flaskr import create_app
-from flaskr.models import db as _db
+from flaskr.models import Post, db as _db
+from flaskr.seed import SeedResult, seed_database
+from tests.helpers import create_post, create_user
 
 
 @pytest.fixture
@@ -29,6 +31,9 @@ def app(tmp_path_factory: TempPathFactory) -> Iterable[Flask]:
         {
             "TESTING": True,
             "SQLALCHEMY_DATABASE_URI": f"sqlite:////{db_path}",
+            "FRONT_PAGE_REBUILD_DELAY": None,
+            "COUNTER_FLUSH_INTERVAL": None,
+            "ATTACHMENT_ROOT": str(tmp_path_factory.mktemp("attachments")),
         }
     )
 
@@ -60,6 +65,41 @@ def db(app: Flask) -> Iterable[SQLAlchemy]:
     _db.drop_all()
 
 
+@pytest.fixture
+def seeded(db: SQLAlchemy) -> SeedResult:
+    """
+    Fills the database with a small generated dataset, the same one every time. All seeded users
+    have the password "password".
+
+    Args:
+        db: db ready for use
+
+    Returns:
+        Number of users and posts added.
+    """
+    return seed_database(users=20, posts=200, batch_size=50)
+
+
+@pytest.fixture
+def post(db: SQLAlchemy) -> Post:
+    """
+    Creates a post with ID 1, by a new user whose password is "password".
+
+    Args:
+        db: db ready for use
+
+    Returns:
+        The post.
+    """
+    author, _ = create_user(password="password")
+
+    post = create_post(author)
+
+    db.session.commit()
+
+    return post
+
+
 @pytest.fixture
 def client(app: Flask) -> Iterable[FlaskClient]:
     """
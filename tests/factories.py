@@ -5,7 +5,7 @@ Factories for models
 import factory
 from factory.alchemy import SQLAlchemyModelFactory
 
-from flaskr.models import User, db
+from flaskr.models import Post, User, db
 
 
 class BaseFactory(SQLAlchemyModelFactory):
@@ -36,3 +36,20 @@ class UserFactory(BaseFactory):
 
     id = factory.Sequence(lambda n: n)
     username = factory.Faker("user_name")
+
+
+class PostFactory(BaseFactory):
+    """
+    Factory for creating posts.
+    """
+
+    class Meta:
+        """
+        Set necessary attributes for factory.
+        """
+
+        model = Post
+
+    author = factory.SubFactory(UserFactory, password=factory.Faker("password"))
+    title = factory.Faker("sentence")
+    body = factory.Faker("paragraph")
@@ -2,12 +2,12 @@
 """
 Helpers for tests
 """
-from typing import Optional
+from typing import Any, Optional, cast
 
 from faker import Faker
 
-from flaskr.models import User
-from tests.factories import UserFactory
+from flaskr.models import Post, User
+from tests.factories import PostFactory, UserFactory
 
 
 fake = Faker()
@@ -32,3 +32,20 @@ def create_user(
     user = UserFactory(username=username, password=password)
 
     return user, password
+
+
+def create_post(author: Optional[User] = None, **fields: Any) -> Post:
+    """
+    Creates a post to use in tests. It is added to the session, but not committed.
+
+    Args:
+        author (): Optional author, a new user by default
+        **fields (): Optional values of other post fields
+
+    Returns:
+        The created post.
+    """
+    if author is not None:
+        fields["author"] = author
+
+    return cast(Post, PostFactory(**fields))
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for post attachments
+"""
+import hashlib
+import io
+import os
+from http import HTTPStatus
+from typing import Any, cast
+
+from flask import Flask
+from flask.testing import FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from werkzeug import Response
+
+from flaskr.attachments import LocalStorage, attachment_storage
+from flaskr.jobs import claim_jobs, run_job
+from flaskr.models import Attachment, Post
+from flaskr.readmodel import load_attachments
+from tests.conftest import AuthActions
+from tests.helpers import create_user
+
+
+def upload(client: FlaskClient, post_id: int, data: bytes, filename: str) -> Response:
+    """
+    Uploads a file as an attachment of a post.
+
+    Args:
+        client: Client to upload with.
+        post_id: ID of the post.
+        data: Contents of the file.
+        filename: Name of the file.
+
+    Returns:
+        Response to the upload.
+    """
+    return client.post(
+        f"/{post_id}/attachments",
+        data={"file": (io.BytesIO(data), filename)},
+        content_type="multipart/form-data",
+    )
+
+
+def staged_files() -> list[str]:
+    """
+    Lists the uploads left in the staging directory.
+
+    Returns:
+        Names of the staged files.
+    """
+    return os.listdir(attachment_storage().staging_dir)
+
+
+def test_upload_is_stored_with_size_and_checksum(
+    post: Post, client: FlaskClient, auth: AuthActions
+) -> None:
+    auth.login(username=post.author.username, password="password")
+
+    data = os.urandom(200_000)
+
+    response = upload(client, 1, data, "../photo.png")
+
+    assert response.headers["Location"].endswith("/1")
+
+    attachment = Attachment.query.one()
+
+    assert attachment.filename == "photo.png"
+    assert attachment.content_type == "image/png"
+    assert attachment.size == len(data)
+    assert attachment.sha256 == hashlib.sha256(data).hexdigest()
+
+    storage = attachment_storage()
+
+    assert isinstance(storage, LocalStorage)
+
+    with open(storage.path(attachment.storage_key), "rb") as file:
+        assert file.read() == data
+
+    assert staged_files() == []
+
+
+def test_uploads_over_the_size_cap_are_rejected(
+    app: Flask, post: Post, client: FlaskClient, auth: AuthActions
+) -> None:
+    app.config["ATTACHMENT_MAX_SIZE"] = 1000
+
+    auth.login(username=post.author.username, password="password")
+
+    response = upload(client, 1, b"x" * 1001, "big.bin")
+
+    assert response.status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    assert Attachment.query.count() == 0
+    assert staged_files() == []
+
+
+def test_only_the_author_can_attach_files(
+    post: Post, client: FlaskClient, auth: AuthActions
+) -> None:
+    auth.login(username=post.author.username, password="password")
+
+    other, password = create_user()
+
+    auth.login(username=other.username, password=password)
+
+    assert upload(client, 1, b"data", "a.txt").status_code == HTTPStatus.FORBIDDEN
+    assert upload(client, 2, b"data", "a.txt").status_code == HTTPStatus.NOT_FOUND
+    assert Attachment.query.count() == 0
+
+
+def test_upload_without_a_file_is_rejected(
+    post: Post, client: FlaskClient, auth: AuthActions
+) -> None:
+    auth.login(username=post.author.username, password="password")
+
+    response = client.post(
+        "/1/attachments", data={}, content_type="multipart/form-data"
+    )
+
+    assert response.headers["Location"].endswith("/1/update")
+    assert Attachment.query.count() == 0
+
+
+def test_downloads_support_ranges_and_conditional_requests(
+    post: Post, client: FlaskClient, auth: AuthActions
+) -> None:
+    auth.login(username=post.author.username, password="password")
+
+    data = bytes(range(256)) * 4
+
+    upload(client, 1, data, "data.bin")
+
+    url = "/attachments/1/data.bin"
+
+    response = client.get(url)
+
+    assert response.data == data
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["Content-Disposition"].startswith("attachment")
+    assert response.headers["X-Content-Type-Options"] == "nosniff"
+
+    etag = response.headers["ETag"]
+
+    assert etag == f'"{hashlib.sha256(data).hexdigest()}"'
+
+    partial = client.get(url, headers={"Range": "bytes=10-19"})
+
+    assert partial.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert partial.data == data[10:20]
+    assert partial.headers["Content-Range"] == f"bytes 10-19/{len(data)}"
+
+    cached = client.get(url, headers={"If-None-Match": etag})
+
+    assert cached.status_code == HTTPStatus.NOT_MODIFIED
+    assert client.get("/attachments/2/x").status_code == HTTPStatus.NOT_FOUND
+
+
+def test_images_are_shown_inline(
+    post: Post, client: FlaskClient, auth: AuthActions
+) -> None:
+    auth.login(username=post.author.username, password="password")
+
+    upload(client, 1, b"not really a png", "picture.png")
+    upload(client, 1, b"<script></script>", "page.html")
+
+    assert (
+        client.get("/attachments/1/picture.png")
+        .headers["Content-Disposition"]
+        .startswith("inline")
+    )
+    assert (
+        client.get("/attachments/2/page.html")
+        .headers["Content-Disposition"]
+        .startswith("attachment")
+    )
+
+    detail = client.get("/1").data
+
+    assert b'<img class="attachment" alt="picture.png"' in detail
+    assert b'alt="page.html"' not in detail
+    assert b"page.html</a>" in detail
+
+
+def test_index_lists_attachments(
+    post: Post, client: FlaskClient, auth: AuthActions
+) -> None:
+    auth.login(username=post.author.username, password="password")
+
+    upload(client, 1, b"notes", "notes.txt")
+
+    assert b"notes.txt</a>" in client.get("/").data
+
+
+def test_attachments_of_a_page_load_in_one_query(
+    db: SQLAlchemy, post: Post, client: FlaskClient, auth: AuthActions
+) -> None:
+    auth.login(username=post.author.username, password="password")
+    client.post("/create", data={"title": "second", "body": ""})
+
+    for post_id in (1, 1, 2):
+        upload(client, post_id, b"data", f"file{post_id}.txt")
+
+    statements: list[str] = []
+
+    def record(*args: Any) -> None:
+        statements.append(args[2])
+
+    event.listen(db.engine, "before_cursor_execute", record)
+
+    try:
+        attachments = load_attachments([1, 2, 3])
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+    assert len(statements) == 1
+    assert {post_id: len(rows) for post_id, rows in attachments.items()} == {
+        1: 2,
+        2: 1,
+    }
+
+
+def test_deleting_a_post_removes_its_attachments(
+    post: Post, client: FlaskClient, auth: AuthActions
+) -> None:
+    auth.login(username=post.author.username, password="password")
+
+    upload(client, 1, b"data", "a.txt")
+
+    storage = cast(LocalStorage, attachment_storage())
+    path = storage.path(Attachment.query.one().storage_key)
+
+    client.post("/1/delete")
+
+    assert Post.query.count() == 0
+    assert Attachment.query.count() == 0
+
+    # The files are removed by a job.
+    assert os.path.exists(path)
+
+    (job,) = claim_jobs("worker", 1)
+
+    assert job.name == "attachments.remove_stored_files"
+    assert run_job(job)
+    assert not os.path.exists(path)
+
+
+def test_attachments_with_missing_files_are_not_found(
+    post: Post, client: FlaskClient, auth: AuthActions
+) -> None:
+    auth.login(username=post.author.username, password="password")
+
+    upload(client, 1, b"data", "a.txt")
+
+    storage = cast(LocalStorage, attachment_storage())
+
+    os.remove(storage.path(Attachment.query.one().storage_key))
+
+    assert client.get("/attachments/1/a.txt").status_code == HTTPStatus.NOT_FOUND
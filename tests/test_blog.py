@@ -2,6 +2,7 @@
 """
 Tests for blog functionality
 """
+from datetime import datetime
 from http import HTTPStatus
 
 import pytest
@@ -9,6 +10,8 @@ from faker import Faker
 from flask import Flask
 from flask.testing import FlaskClient
 from flask_sqlalchemy import SQLAlchemy
+from pytest_mock import MockerFixture
+from sqlalchemy import event
 from werkzeug import Response
 
 from flaskr.models import Post
@@ -128,6 +131,18 @@ def test_author_required(
     assert b'href="/1/update"' not in client.get("/").data
 
 
+@pytest.mark.parametrize("path", ("/create", "/1/update"))
+def test_forms_without_a_title_are_bad_requests(
+    app: Flask, post: Post, client: FlaskClient, auth: AuthActions, path: str
+) -> None:
+    # Debug mode raises missing form keys instead of answering them.
+    app.config["TRAP_BAD_REQUEST_ERRORS"] = False
+
+    auth.login(username=post.author.username, password="password")
+
+    assert client.post(path, data={"body": ""}).status_code == HTTPStatus.BAD_REQUEST
+
+
 @pytest.mark.parametrize(
     "path",
     (
@@ -234,3 +249,190 @@ def test_can_delete_a_post(
         post = Post.query.get(1)
 
         assert post is None
+
+
+def test_update_bumps_post_version(
+    faker: Faker, db: SQLAlchemy, client: FlaskClient, auth: AuthActions, app: Flask
+) -> None:
+    user, password = create_user()
+
+    post = Post(title=faker.sentence(), body=faker.paragraph(), author=user)
+
+    db.session.add(post)
+    db.session.commit()
+
+    auth.login(username=user.username, password=password)
+
+    assert b'name="version" value="1"' in client.get("/1/update").data
+
+    client.post("/1/update", data={"title": "new", "body": "", "version": "1"})
+
+    with app.app_context():
+        post = Post.query.get(1)
+
+        assert post.title == "new"
+        assert post.version == 2
+
+
+def test_update_with_stale_version_is_rejected(
+    faker: Faker, db: SQLAlchemy, client: FlaskClient, auth: AuthActions, app: Flask
+) -> None:
+    user, password = create_user()
+
+    original_title = faker.sentence()
+
+    post = Post(title=original_title, body=faker.paragraph(), author=user)
+
+    db.session.add(post)
+    db.session.commit()
+
+    auth.login(username=user.username, password=password)
+
+    response = client.post(
+        "/1/update", data={"title": "new", "body": "", "version": "0"}
+    )
+
+    assert response.status_code == HTTPStatus.CONFLICT
+    assert b"This post was changed since you started editing it." in response.data
+
+    with app.app_context():
+        post = Post.query.get(1)
+
+        assert post.title == original_title
+        assert post.version == 1
+
+
+def test_delete_with_stale_version_is_rejected(
+    faker: Faker, db: SQLAlchemy, client: FlaskClient, auth: AuthActions, app: Flask
+) -> None:
+    user, password = create_user()
+
+    post = Post(title=faker.sentence(), body=faker.paragraph(), author=user)
+
+    db.session.add(post)
+    db.session.commit()
+
+    auth.login(username=user.username, password=password)
+
+    response = client.post("/1/delete", data={"version": "0"})
+
+    assert response.headers["Location"] == "http://localhost/1/update"
+
+    with app.app_context():
+        assert Post.query.get(1) is not None
+
+
+def test_missed_delete_only_runs_the_conditional_lock(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions, mocker: MockerFixture
+) -> None:
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/create", data={"title": "post", "body": "", "tags": "a"})
+    client.post("/1/comments", data={"body": "first"})
+
+    execute = mocker.Mock()
+
+    event.listen(db.engine, "before_cursor_execute", execute)
+
+    try:
+        client.post("/1/delete", data={"version": "42"})
+    finally:
+        event.remove(db.engine, "before_cursor_execute", execute)
+
+    writes = [
+        call.args[2].split()[0]
+        for call in execute.call_args_list
+        if not call.args[2].lstrip().startswith("SELECT")
+    ]
+
+    # SQLite locks the post with an UPDATE that leaves it as it is.
+    assert writes == ["UPDATE"]
+
+
+def test_index_shows_excerpt_of_long_posts(
+    faker: Faker, client: FlaskClient, db: SQLAlchemy
+) -> None:
+    user, _ = create_user()
+
+    body = " ".join(faker.paragraphs(nb=20))
+
+    post = Post(title=faker.sentence(), body=body, author=user)
+
+    db.session.add(post)
+    db.session.commit()
+
+    response = client.get("/")
+
+    assert post.excerpt.encode() in response.data
+    assert body.encode() not in response.data
+    assert b'href="/1">Read more</a>' in response.data
+
+
+def test_detail_page_shows_full_post(
+    faker: Faker, client: FlaskClient, db: SQLAlchemy
+) -> None:
+    user, _ = create_user()
+
+    post = Post(
+        title=faker.sentence(), body=" ".join(faker.paragraphs(nb=20)), author=user
+    )
+
+    db.session.add(post)
+    db.session.commit()
+
+    response = client.get("/1")
+
+    assert_post_is_in_response(post, response)
+
+    assert client.get("/2").status_code == HTTPStatus.NOT_FOUND
+
+
+def test_update_refreshes_excerpt(
+    faker: Faker, db: SQLAlchemy, client: FlaskClient, auth: AuthActions, app: Flask
+) -> None:
+    user, password = create_user()
+
+    post = Post(title=faker.sentence(), body=faker.paragraph(), author=user)
+
+    db.session.add(post)
+    db.session.commit()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/1/update", data={"title": "new", "body": "  new body "})
+
+    with app.app_context():
+        assert Post.query.get(1).excerpt == "new body"
+
+
+def test_detail_page_shows_rendered_markdown(
+    faker: Faker, client: FlaskClient, db: SQLAlchemy
+) -> None:
+    user, _ = create_user()
+
+    post = Post(title=faker.sentence(), body="# Heading\n\n*text*", author=user)
+
+    db.session.add(post)
+    db.session.commit()
+
+    response = client.get("/1")
+
+    assert b"<h1>Heading</h1>\n<p><em>text</em></p>" in response.data
+
+
+def test_index_shows_newest_posts_first(
+    faker: Faker, client: FlaskClient, db: SQLAlchemy
+) -> None:
+    user, _ = create_user()
+
+    older = Post(title="older", body="", author=user, created=datetime(2022, 1, 1))
+    newer = Post(title="newer", body="", author=user, created=datetime(2022, 2, 1))
+
+    db.session.add_all([older, newer])
+    db.session.commit()
+
+    response = client.get("/")
+
+    assert response.data.index(b"newer") < response.data.index(b"older")
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for comments on posts
+"""
+from http import HTTPStatus
+
+from flask.testing import FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+
+from flaskr.comments import comment_path, load_comments
+from flaskr.models import Comment, Post
+from tests.conftest import AuthActions
+from tests.helpers import create_post, create_user
+
+
+def test_comment_paths_sort_replies_after_their_parent() -> None:
+    first = comment_path("", 2)
+    reply = comment_path(first, 10)
+    second = comment_path("", 3)
+
+    assert sorted([second, reply, first]) == [first, reply, second]
+
+
+def test_can_comment_on_a_post(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    create_post()
+    db.session.commit()
+
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    response = client.post("/1/comments", data={"body": "Nice post!"})
+
+    assert response.headers["Location"] == "http://localhost/1#comments"
+
+    comment = Comment.query.one()
+
+    assert comment.body == "Nice post!"
+    assert comment.depth == 0
+    assert Post.query.get(1).comment_count == 1
+
+
+def test_replies_are_threaded_under_their_parent(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    create_post()
+    db.session.commit()
+
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/1/comments", data={"body": "first comment"})
+    client.post("/1/comments", data={"body": "second comment"})
+    client.post("/1/comments", data={"body": "reply comment", "parent_id": "1"})
+
+    comments = load_comments([1])[1]
+
+    assert [comment.body for comment in comments] == [
+        "first comment",
+        "reply comment",
+        "second comment",
+    ]
+    assert [comment.depth for comment in comments] == [0, 1, 0]
+    assert Post.query.get(1).comment_count == 3
+
+    response = client.get("/1")
+
+    assert b"3 comments" in response.data
+    assert response.data.index(b"reply comment") < response.data.index(
+        b"second comment"
+    )
+
+
+def test_reply_to_comment_on_another_post_is_rejected(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    create_post()
+    create_post()
+    db.session.commit()
+
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/1/comments", data={"body": "first"})
+
+    response = client.post("/2/comments", data={"body": "reply", "parent_id": "1"})
+
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+def test_empty_comments_are_rejected(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    create_post()
+    db.session.commit()
+
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    response = client.post("/1/comments", data={"body": " "}, follow_redirects=True)
+
+    assert b"Comment is required." in response.data
+    assert Comment.query.count() == 0
+
+
+def test_commenting_requires_login(db: SQLAlchemy, client: FlaskClient) -> None:
+    response = client.post("/1/comments", data={"body": "hi"})
+
+    assert response.headers["Location"] == "http://localhost/auth/login"
+
+
+def test_commenting_on_missing_post_is_not_found(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    assert client.post("/1/comments", data={"body": "hi"}).status_code == 404
+
+
+def test_index_shows_comment_counts(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    create_post()
+    db.session.commit()
+
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/1/comments", data={"body": "first"})
+
+    assert b"1 comment<" in client.get("/").data
+
+
+def test_deleting_a_post_deletes_its_comments(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    create_post(user)
+    db.session.commit()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/1/comments", data={"body": "first"})
+    client.post("/1/delete")
+
+    assert Comment.query.count() == 0
+
+
+def test_missed_delete_keeps_comments(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    create_post(user)
+    db.session.commit()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/1/comments", data={"body": "first"})
+    client.post("/1/delete", data={"version": "42"})
+
+    assert Comment.query.count() == 1
+
+
+def test_load_comments_batches_posts(db: SQLAlchemy) -> None:
+    user, _ = create_user()
+
+    posts = [create_post(), create_post(), create_post()]
+
+    db.session.flush()
+
+    for post in posts[:2]:
+        comment = Comment(post_id=post.id, author=user, body="hi", path="")
+
+        db.session.add(comment)
+        db.session.flush()
+
+        comment.path = comment_path("", comment.id)
+
+    db.session.commit()
+
+    comments = load_comments([post.id for post in posts])
+
+    assert sorted(comments) == [posts[0].id, posts[1].id]
+    assert load_comments([]) == {}
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for post view and like counters
+"""
+import time
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+from pytest_mock import MockerFixture
+
+from flaskr.counters import post_counters
+from flaskr.frontpage import FrontPageSnapshot
+from flaskr.querycache import query_cache
+from flaskr.models import Post, PostStats
+from tests.conftest import AuthActions
+from tests.helpers import create_user
+
+
+def get_stats(post_id: int) -> tuple[int, int]:
+    """
+    Reads the stored counts of a post.
+
+    Args:
+        post_id: ID of the post.
+
+    Returns:
+        Views and likes of the post.
+    """
+    stats = PostStats.query.get(post_id)
+
+    return stats.views, stats.likes
+
+
+def test_flush_adds_counts_in_one_batch(db: SQLAlchemy) -> None:
+    counters = post_counters()
+
+    counters.increment(1, "views")
+    counters.increment(1, "views")
+    counters.increment(2, "likes")
+
+    assert counters.flush() == 2
+    assert get_stats(1) == (2, 0)
+    assert get_stats(2) == (0, 1)
+
+    counters.increment(1, "views", 3)
+
+    assert counters.flush() == 1
+    assert get_stats(1) == (5, 0)
+
+
+def test_flush_without_counts_does_nothing(db: SQLAlchemy) -> None:
+    assert post_counters().flush() == 0
+
+
+def test_unknown_counter_is_rejected(app: Flask) -> None:
+    with pytest.raises(ValueError):
+        post_counters().increment(1, "shares")
+
+
+def test_failed_flush_keeps_counts(db: SQLAlchemy, mocker: MockerFixture) -> None:
+    counters = post_counters()
+
+    counters.increment(1, "views")
+
+    fake_db = mocker.patch("flaskr.counters.db")
+    fake_db.engine.begin.side_effect = RuntimeError("database is down")
+
+    with pytest.raises(RuntimeError):
+        counters.flush()
+
+    assert counters.pending(1)["views"] == 1
+
+
+def test_counts_are_flushed_in_the_background(db: SQLAlchemy, app: Flask) -> None:
+    app.config["COUNTER_FLUSH_INTERVAL"] = 0.01
+
+    post_counters().increment(1, "views")
+
+    deadline = time.monotonic() + 5
+
+    while PostStats.query.get(1) is None and time.monotonic() < deadline:
+        db.session.rollback()
+        time.sleep(0.01)
+
+    assert get_stats(1) == (1, 0)
+
+
+def test_viewing_a_post_counts_a_view(post: Post, client: FlaskClient) -> None:
+    client.get("/1")
+
+    response = client.get("/1")
+
+    # Unflushed counts are shown too.
+    assert b"2 views" in response.data
+    assert post_counters().pending(1)["views"] == 2
+
+
+def test_likes_are_counted_once_per_session(
+    post: Post, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    response = client.post("/1/like")
+
+    assert response.headers["Location"] == "http://localhost/1"
+
+    client.post("/1/like")
+
+    assert post_counters().pending(1)["likes"] == 1
+
+
+def test_liking_requires_login(post: Post, client: FlaskClient) -> None:
+    response = client.post("/1/like")
+
+    assert response.headers["Location"] == "http://localhost/auth/login"
+
+
+def test_liking_missing_post_is_not_found(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    assert client.post("/1/like").status_code == 404
+
+
+def test_index_shows_flushed_counts(post: Post, client: FlaskClient) -> None:
+    assert b"0 views" in client.get("/").data
+
+    counters = post_counters()
+
+    counters.increment(1, "views", 3)
+    counters.increment(1, "likes")
+    counters.flush()
+
+    assert b"0 views" in client.get("/").data
+
+    # Counts are cached for a few seconds.
+    query_cache("post_counts").clear()
+
+    response = client.get("/")
+
+    assert b"3 views" in response.data
+    assert b"1 like<" in response.data
+
+
+def test_flush_leaves_cached_pages_alone(
+    post: Post, client: FlaskClient, mocker: MockerFixture
+) -> None:
+    client.get("/")
+
+    invalidate = mocker.spy(FrontPageSnapshot, "invalidate")
+
+    counters = post_counters()
+
+    counters.increment(1, "views")
+    counters.flush()
+
+    invalidate.assert_not_called()
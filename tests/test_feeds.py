@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for Atom and RSS feeds
+"""
+from datetime import datetime, timezone
+from http import HTTPStatus
+from xml.etree import ElementTree
+
+from flask import Flask
+from flask.testing import FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+from pytest_mock import MockerFixture
+
+from flaskr.feeds import Feed, rfc822, rfc3339
+from flaskr.invalidation import ChangeEvent
+from flaskr.models import Post, User
+from tests.conftest import AuthActions
+from tests.helpers import create_user
+
+
+ATOM = "{http://www.w3.org/2005/Atom}"
+
+
+def atom_titles(client: FlaskClient, path: str = "/feeds/atom") -> list[str]:
+    """
+    Fetches an Atom feed and lists the titles of its entries.
+
+    Args:
+        client: Client to fetch the feed with.
+        path: Path of the feed.
+
+    Returns:
+        Entry titles, in feed order.
+    """
+    response = client.get(path)
+
+    assert response.status_code == HTTPStatus.OK
+
+    root = ElementTree.fromstring(response.data)
+
+    return [entry.findtext(f"{ATOM}title", "") for entry in root.iter(f"{ATOM}entry")]
+
+
+def add_posts(user: User, *days: int) -> list[Post]:
+    """
+    Adds posts created on the given days of January 2022, titled after their day.
+
+    Args:
+        user: Author of the posts.
+        *days: Days to create posts on.
+
+    Returns:
+        The posts.
+    """
+    return [
+        Post(title=f"day {day}", body="", author=user, created=datetime(2022, 1, day))
+        for day in days
+    ]
+
+
+def test_timestamps_are_formatted_as_utc() -> None:
+    value = datetime(2022, 1, 2, 3, 4, 5)
+
+    assert rfc3339(value) == "2022-01-02T03:04:05+00:00"
+    assert rfc822(value) == "Sun, 02 Jan 2022 03:04:05 +0000"
+
+
+def test_atom_feed_lists_latest_posts(
+    db: SQLAlchemy, client: FlaskClient, app: Flask
+) -> None:
+    app.config["FEED_SIZE"] = 2
+
+    user, _ = create_user()
+
+    db.session.add_all(add_posts(user, 1, 2, 3))
+    db.session.commit()
+
+    response = client.get("/feeds/atom")
+
+    assert response.mimetype == "application/atom+xml"
+    assert atom_titles(client) == ["day 3", "day 2"]
+
+
+def test_rss_feed_lists_latest_posts(db: SQLAlchemy, client: FlaskClient) -> None:
+    user, _ = create_user()
+
+    db.session.add_all(add_posts(user, 1, 2))
+    db.session.commit()
+
+    response = client.get("/feeds/rss")
+
+    assert response.mimetype == "application/rss+xml"
+
+    root = ElementTree.fromstring(response.data)
+
+    assert [item.findtext("title") for item in root.iter("item")] == ["day 2", "day 1"]
+    assert root.findtext("channel/lastBuildDate") == "Sun, 02 Jan 2022 00:00:00 +0000"
+
+
+def test_unknown_feed_format_is_not_found(db: SQLAlchemy, client: FlaskClient) -> None:
+    assert client.get("/feeds/json").status_code == HTTPStatus.NOT_FOUND
+
+
+def test_unchanged_feed_is_not_modified(db: SQLAlchemy, client: FlaskClient) -> None:
+    user, _ = create_user()
+
+    db.session.add_all(add_posts(user, 1))
+    db.session.commit()
+
+    response = client.get("/feeds/atom")
+
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+
+    assert last_modified == "Sat, 01 Jan 2022 00:00:00 GMT"
+
+    by_etag = client.get("/feeds/atom", headers={"If-None-Match": etag})
+    by_date = client.get("/feeds/atom", headers={"If-Modified-Since": last_modified})
+
+    assert by_etag.status_code == HTTPStatus.NOT_MODIFIED
+    assert by_date.status_code == HTTPStatus.NOT_MODIFIED
+
+
+def test_deleting_the_newest_post_moves_validators_forward(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    db.session.add_all(add_posts(user, 1, 2))
+    db.session.commit()
+
+    response = client.get("/feeds/atom")
+
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+
+    assert last_modified == "Sun, 02 Jan 2022 00:00:00 GMT"
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/2/delete")
+
+    by_etag = client.get("/feeds/atom", headers={"If-None-Match": etag})
+    by_date = client.get("/feeds/atom", headers={"If-Modified-Since": last_modified})
+
+    assert by_etag.status_code == HTTPStatus.OK
+    assert by_date.status_code == HTTPStatus.OK
+    assert by_date.last_modified is not None
+    assert by_date.last_modified > datetime(2022, 1, 2, tzinfo=timezone.utc)
+
+
+def test_feeds_of_different_processes_share_validators(
+    app: Flask, db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    db.session.add_all(add_posts(user, 1, 2))
+    db.session.commit()
+
+    # One feed was loaded before the change and told about it, the other is loaded afterwards,
+    # as by a process that started later.
+    told = Feed("Latest posts")
+
+    with app.test_request_context():
+        stale = told.document("atom")
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/2/delete")
+
+    told.handle_change(ChangeEvent("post", 2, "deleted"))
+
+    with app.test_request_context():
+        documents = [told.document("atom"), Feed("Latest posts").document("atom")]
+
+    assert documents[0].etag == documents[1].etag != stale.etag
+    assert documents[0].last_modified == documents[1].last_modified
+    assert documents[0].last_modified is not None
+    assert documents[0].last_modified > datetime(2022, 1, 2, tzinfo=timezone.utc)
+
+
+def test_feed_follows_post_changes(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions, app: Flask
+) -> None:
+    app.config["FEED_SIZE"] = 2
+
+    user, password = create_user()
+
+    db.session.add_all(add_posts(user, 1, 2))
+    db.session.commit()
+
+    etag = client.get("/feeds/atom").headers["ETag"]
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/create", data={"title": "new", "body": ""})
+
+    assert atom_titles(client) == ["new", "day 2"]
+    assert (
+        client.get("/feeds/atom", headers={"If-None-Match": etag}).status_code
+        == HTTPStatus.OK
+    )
+
+    client.post("/2/update", data={"title": "edited", "body": ""})
+
+    assert atom_titles(client) == ["new", "edited"]
+
+    client.post("/3/delete")
+
+    # The feed is refilled from the database once it is no longer full.
+    assert atom_titles(client) == ["edited", "day 1"]
+
+
+def test_unrelated_changes_keep_the_feed_document(
+    db: SQLAlchemy, client: FlaskClient, app: Flask, mocker: MockerFixture
+) -> None:
+    app.config["FEED_SIZE"] = 2
+
+    user, _ = create_user()
+
+    db.session.add_all(add_posts(user, 1, 2, 3))
+    db.session.commit()
+
+    atom_titles(client)
+
+    serialize = mocker.spy(Feed, "_serialize")
+
+    feed = app.extensions["feeds"].latest
+
+    # Comments don't show in feeds, and the post of day 1 is too old to make it into a full feed.
+    feed.handle_change(ChangeEvent("post", 3, "commented"))
+    feed.handle_change(ChangeEvent("post", 1, "updated"))
+
+    assert atom_titles(client) == ["day 3", "day 2"]
+
+    serialize.assert_not_called()
+
+
+def test_author_feed_only_lists_the_authors_posts(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    author, password = create_user()
+    other, _ = create_user()
+
+    db.session.add_all([*add_posts(author, 1), *add_posts(other, 2)])
+    db.session.commit()
+
+    path = f"/feeds/authors/{author.id}/atom"
+
+    assert atom_titles(client, path) == ["day 1"]
+
+    auth.login(username=author.username, password=password)
+
+    client.post("/create", data={"title": "new", "body": ""})
+
+    assert atom_titles(client, path) == ["new", "day 1"]
+
+
+def test_feed_of_unknown_author_is_not_found(
+    db: SQLAlchemy, client: FlaskClient
+) -> None:
+    assert client.get("/feeds/authors/42/atom").status_code == HTTPStatus.NOT_FOUND
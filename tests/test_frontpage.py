@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the front page snapshot
+"""
+import threading
+import time
+
+from faker import Faker
+from flask import Flask
+from flask.testing import FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+from pytest_mock import MockerFixture
+
+from flaskr.frontpage import FrontPageSnapshot, PostsPage, front_page_snapshot
+from flaskr.models import Post
+from tests.conftest import AuthActions
+from tests.helpers import create_user
+
+
+def test_anonymous_users_are_served_the_snapshot(
+    faker: Faker, client: FlaskClient, db: SQLAlchemy
+) -> None:
+    user, _ = create_user()
+
+    db.session.add(Post(title="first", body=faker.paragraph(), author=user))
+    db.session.commit()
+
+    assert b"first" in client.get("/").data
+
+    # Written behind the snapshot's back, so it isn't invalidated
+    db.session.add(Post(title="second", body=faker.paragraph(), author=user))
+    db.session.commit()
+
+    assert b"second" not in client.get("/").data
+
+    front_page_snapshot().invalidate()
+
+    assert b"second" in client.get("/").data
+
+
+def test_writes_invalidate_the_snapshot(
+    client: FlaskClient, db: SQLAlchemy, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    assert b"created" not in client.get("/").data
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/create", data={"title": "created", "body": ""})
+
+    assert b"created" in client.get("/").data
+
+
+def test_logged_in_users_get_personalized_snapshot(
+    faker: Faker, client: FlaskClient, db: SQLAlchemy, auth: AuthActions
+) -> None:
+    author, password = create_user()
+    other_user, _ = create_user()
+
+    db.session.add(Post(title=faker.sentence(), body="", author=author))
+    db.session.add(Post(title=faker.sentence(), body="", author=other_user))
+    db.session.commit()
+
+    # Build the snapshot as an anonymous user
+    assert b"Edit" not in client.get("/").data
+
+    auth.login(username=author.username, password=password)
+
+    response = client.get("/")
+
+    assert b"Log Out" in response.data
+    assert b'href="/1/update"' in response.data
+    assert b'href="/2/update"' not in response.data
+
+
+def test_older_posts_are_paginated(
+    faker: Faker, app: Flask, client: FlaskClient, db: SQLAlchemy
+) -> None:
+    app.config["POSTS_PER_PAGE"] = 2
+
+    user, _ = create_user()
+
+    for number in range(3):
+        db.session.add(Post(title=f"post number {number}", body="", author=user))
+
+    db.session.commit()
+
+    response = client.get("/")
+
+    assert b"post number 2" in response.data
+    assert b"post number 1" in response.data
+    assert b"post number 0" not in response.data
+    assert b"Older posts" in response.data
+
+    older_link = response.data.split(b'class="older" href="')[1].split(b'"')[0]
+
+    response = client.get(older_link.decode().replace("&amp;", "&"))
+
+    assert b"post number 1" not in response.data
+    assert b"post number 0" in response.data
+    assert b"Older posts" not in response.data
+
+
+def test_invalid_cursor_is_rejected(client: FlaskClient) -> None:
+    assert client.get("/?before=nope").status_code == 400
+
+
+def test_bursts_of_invalidations_cause_one_rebuild(
+    app: Flask, mocker: MockerFixture
+) -> None:
+    app.config["FRONT_PAGE_REBUILD_DELAY"] = 0.05
+
+    rebuilt = threading.Event()
+
+    def fake_render_posts_page() -> PostsPage:
+        rebuilt.set()
+
+        return PostsPage(posts=(), next_cursor=None)
+
+    render_posts_page = mocker.patch(
+        "flaskr.frontpage.render_posts_page", side_effect=fake_render_posts_page
+    )
+
+    snapshot = FrontPageSnapshot(app)
+
+    for _ in range(10):
+        snapshot.invalidate()
+
+    assert rebuilt.wait(timeout=5)
+
+    # Give any extra rebuilds a chance to happen
+    time.sleep(0.2)
+
+    render_posts_page.assert_called_once()
+
+
+def test_failed_rebuilds_keep_the_snapshot_and_are_retried(
+    app: Flask, mocker: MockerFixture
+) -> None:
+    app.config["FRONT_PAGE_REBUILD_DELAY"] = 0.01
+    app.config["FRONT_PAGE_REBUILD_RETRY_DELAY"] = 0.01
+
+    rebuilt = threading.Event()
+    page = PostsPage(posts=(), next_cursor=None)
+
+    def fake_render_posts_page() -> PostsPage:
+        if render_posts_page.call_count == 2:
+            raise RuntimeError("database went away")
+
+        if render_posts_page.call_count == 3:
+            rebuilt.set()
+
+        return page
+
+    render_posts_page = mocker.patch(
+        "flaskr.frontpage.render_posts_page", side_effect=fake_render_posts_page
+    )
+
+    snapshot = FrontPageSnapshot(app)
+    stale = snapshot.get()
+
+    snapshot.invalidate()
+
+    assert rebuilt.wait(timeout=5)
+    assert render_posts_page.call_count == 3
+
+    # Rebuilds install the new snapshot after rendering it.
+    time.sleep(0.05)
+
+    assert snapshot.get() is not stale
+
+
+def test_background_rebuilds_link_under_the_application_root(
+    app: Flask, client: FlaskClient, db: SQLAlchemy
+) -> None:
+    app.config["FRONT_PAGE_REBUILD_DELAY"] = 0.01
+    app.config["APPLICATION_ROOT"] = "/blog"
+
+    snapshot = front_page_snapshot()
+    snapshot.get()
+
+    user, _ = create_user()
+
+    db.session.add(Post(title="first", body="", author=user))
+    db.session.commit()
+
+    snapshot.invalidate()
+
+    for _ in range(500):
+        front_page = snapshot.get()
+
+        if front_page.page.posts:
+            break
+
+        time.sleep(0.01)
+
+    assert 'href="/blog/1"' in front_page.page.posts[0].header
+
+
+def test_snapshot_is_rebuilt_in_the_background_without_a_server_name(
+    app: Flask, db: SQLAlchemy, mocker: MockerFixture
+) -> None:
+    app.config["FRONT_PAGE_REBUILD_DELAY"] = 0.1
+
+    snapshot = FrontPageSnapshot(app)
+    stale = snapshot.get()
+
+    build = mocker.spy(snapshot, "_build")
+
+    snapshot.invalidate()
+
+    # The stale snapshot is served until the rebuild is done, instead of being dropped.
+    assert snapshot.get() is stale
+
+    for _ in range(500):
+        if snapshot.get() is not stale:
+            break
+
+        time.sleep(0.01)
+
+    assert snapshot.get() is not stale
+    build.assert_called_once()
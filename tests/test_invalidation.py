@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the invalidation bus
+"""
+import json
+
+import pytest
+
+from flask import Flask
+from flask.testing import FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+from pytest_mock import MockerFixture
+
+from flaskr.auth import CurrentUser, load_user
+from flaskr.invalidation import (
+    RESET,
+    ChangeEvent,
+    LocalCache,
+    invalidation_bus,
+    publish,
+)
+from flaskr.models import User
+from tests.helpers import create_user
+
+
+def test_changes_are_delivered_after_commit(
+    app: Flask, db: SQLAlchemy, mocker: MockerFixture
+) -> None:
+    subscriber = mocker.Mock()
+
+    invalidation_bus().subscribe("thing", subscriber)
+
+    publish("thing", 1, "updated")
+
+    subscriber.assert_not_called()
+
+    db.session.commit()
+
+    subscriber.assert_called_once_with(ChangeEvent("thing", 1, "updated"))
+
+
+def test_changes_are_dropped_on_rollback(
+    app: Flask, db: SQLAlchemy, mocker: MockerFixture
+) -> None:
+    subscriber = mocker.Mock()
+
+    invalidation_bus().subscribe("thing", subscriber)
+
+    publish("thing", 1, "updated")
+
+    db.session.rollback()
+    db.session.commit()
+
+    subscriber.assert_not_called()
+
+
+def test_savepoint_rollbacks_keep_changes_published_outside_of_them(
+    app: Flask, db: SQLAlchemy, mocker: MockerFixture
+) -> None:
+    subscriber = mocker.Mock()
+
+    invalidation_bus().subscribe("thing", subscriber)
+
+    publish("thing", 1, "updated")
+
+    savepoint = db.session.begin_nested()
+
+    publish("thing", 2, "updated")
+
+    savepoint.rollback()
+
+    publish("thing", 3, "updated")
+
+    db.session.commit()
+
+    assert subscriber.call_args_list == [
+        mocker.call(ChangeEvent("thing", 1, "updated")),
+        mocker.call(ChangeEvent("thing", 3, "updated")),
+    ]
+
+
+def test_failing_subscribers_dont_stop_delivery(
+    app: Flask, mocker: MockerFixture
+) -> None:
+    failing_subscriber = mocker.Mock(side_effect=RuntimeError)
+    subscriber = mocker.Mock()
+
+    bus = invalidation_bus()
+
+    bus.subscribe("thing", failing_subscriber)
+    bus.subscribe("thing", subscriber)
+
+    bus.dispatch(ChangeEvent("thing", 1, "deleted"))
+
+    subscriber.assert_called_once_with(ChangeEvent("thing", 1, "deleted"))
+
+
+def test_notifications_from_other_processes_are_delivered(
+    app: Flask, mocker: MockerFixture
+) -> None:
+    subscriber = mocker.Mock()
+
+    bus = invalidation_bus()
+
+    bus.subscribe("thing", subscriber)
+
+    own_change = {"origin": bus.origin, "change": ["thing", 1, "updated"]}
+    other_change = {"origin": "other", "change": ["thing", 2, "updated"]}
+
+    bus._deliver(json.dumps(own_change))
+    bus._deliver(json.dumps(other_change))
+
+    subscriber.assert_called_once_with(ChangeEvent("thing", 2, "updated"))
+
+
+def test_listening_resets_every_subscriber(app: Flask, mocker: MockerFixture) -> None:
+    subscriber = mocker.Mock()
+
+    bus = invalidation_bus()
+
+    bus.subscribe("thing", subscriber)
+
+    engine = mocker.MagicMock()
+    # Stands in for the connection dropping right after LISTEN.
+    mocker.patch(
+        "flaskr.invalidation.selectors.DefaultSelector", side_effect=ConnectionError
+    )
+
+    with pytest.raises(ConnectionError):
+        bus._listen(engine)
+
+    engine.raw_connection().cursor().__enter__().execute.assert_called_once_with(
+        "LISTEN flaskr_changes"
+    )
+    subscriber.assert_called_once_with(ChangeEvent("thing", 0, RESET))
+
+
+def test_local_cache_evicts_oldest_entries() -> None:
+    cache: LocalCache[str] = LocalCache(max_size=2)
+
+    cache.set(1, "a")
+    cache.set(2, "b")
+    cache.set(3, "c")
+
+    assert cache.get(1) is None
+    assert cache.get(2) == "b"
+    assert cache.get(3) == "c"
+
+    cache.handle_change(ChangeEvent("thing", 2, "deleted"))
+
+    assert cache.get(2) is None
+    assert cache.get(3) == "c"
+
+    cache.handle_change(ChangeEvent("thing", 0, RESET))
+
+    assert cache.get(3) is None
+
+
+def test_users_are_cached_until_they_change(
+    client: FlaskClient, db: SQLAlchemy, mocker: MockerFixture
+) -> None:
+    user, _ = create_user()
+
+    user_id, username = user.id, user.username
+
+    assert load_user(user_id) == CurrentUser(user_id, username)
+
+    User.query.filter_by(id=user_id).update({"username": "renamed"})
+    db.session.commit()
+
+    assert load_user(user_id) == CurrentUser(user_id, username)
+
+    publish("user", user_id, "updated")
+    db.session.commit()
+
+    assert load_user(user_id) == CurrentUser(user_id, "renamed")
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the background job queue
+"""
+from datetime import datetime, timedelta
+from typing import Any
+
+import threading
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskCliRunner
+from flask_sqlalchemy import SQLAlchemy
+from pytest_mock import MockerFixture
+
+from flaskr.jobs import (
+    claim_jobs,
+    delete_expired_jobs,
+    enqueue,
+    job_handler,
+    retry_delay,
+    run_job,
+    work,
+)
+from flaskr.models import Job
+
+
+@pytest.fixture
+def calls() -> list[dict[str, Any]]:
+    """
+    Registers handlers for test jobs, recording the payloads they get called with.
+
+    Returns:
+        List the payloads get added to.
+    """
+    calls: list[dict[str, Any]] = []
+
+    @job_handler("test.record")
+    def record(**payload: Any) -> None:
+        calls.append(payload)
+
+    @job_handler("test.fail")
+    def fail(**payload: Any) -> None:
+        raise RuntimeError("nope")
+
+    return calls
+
+
+def test_worker_runs_and_removes_jobs(
+    runner: FlaskCliRunner, db: SQLAlchemy, calls: list[dict[str, Any]]
+) -> None:
+    enqueue("test.record", number=1)
+    enqueue("test.record", number=2)
+    db.session.commit()
+
+    result = runner.invoke(args=["worker", "--burst", "--batch-size", "1"])
+
+    assert "Workers stopped." in result.output
+
+    assert calls == [{"number": 1}, {"number": 2}]
+
+    assert Job.query.count() == 0
+
+
+def test_uncommitted_jobs_are_not_run(
+    db: SQLAlchemy, calls: list[dict[str, Any]]
+) -> None:
+    enqueue("test.record", number=1)
+    db.session.rollback()
+
+    assert claim_jobs("worker", 10) == []
+
+
+def test_claims_are_batched_and_leased(
+    db: SQLAlchemy, calls: list[dict[str, Any]]
+) -> None:
+    for number in range(3):
+        enqueue("test.record", number=number)
+
+    db.session.commit()
+
+    first_batch = claim_jobs("first", 2)
+    second_batch = claim_jobs("second", 2)
+
+    assert [job.payload["number"] for job in first_batch] == [0, 1]
+    assert [job.payload["number"] for job in second_batch] == [2]
+    assert claim_jobs("third", 2) == []
+
+
+def test_expired_leases_can_be_claimed_again(
+    db: SQLAlchemy, calls: list[dict[str, Any]]
+) -> None:
+    enqueue("test.record", number=1)
+    db.session.commit()
+
+    (job,) = claim_jobs("first", 1)
+
+    Job.query.filter_by(id=job.id).update(
+        {"locked_until": datetime.utcnow() - timedelta(seconds=1)}
+    )
+    db.session.commit()
+
+    (reclaimed,) = claim_jobs("second", 1)
+
+    assert reclaimed.id == job.id
+    assert reclaimed.attempts == 2
+
+
+def test_results_of_expired_claims_are_not_recorded(
+    db: SQLAlchemy, calls: list[dict[str, Any]]
+) -> None:
+    enqueue("test.record", number=1)
+    db.session.commit()
+
+    (job,) = claim_jobs("first", 1)
+
+    Job.query.filter_by(id=job.id).update(
+        {"locked_until": datetime.utcnow() - timedelta(seconds=1)}
+    )
+    db.session.commit()
+
+    claim_jobs("second", 1)
+
+    assert run_job(job)
+
+    stored_job = Job.query.one()
+
+    assert stored_job.claimed_by == "second"
+    assert stored_job.locked_until > datetime.utcnow()
+
+
+def test_worker_survives_errors_outside_of_jobs(
+    app: Flask, db: SQLAlchemy, calls: list[dict[str, Any]], mocker: MockerFixture
+) -> None:
+    app.config["JOB_WORKER_BACKOFF_SECONDS"] = 0.01
+
+    enqueue("test.record", number=1)
+    db.session.commit()
+
+    failures = iter([RuntimeError("database went away")])
+
+    def flaky_claim_jobs(worker_id: str, limit: int) -> list[Any]:
+        for error in failures:
+            raise error
+
+        return claim_jobs(worker_id, limit)
+
+    logger = mocker.spy(app.logger, "exception")
+    mocker.patch("flaskr.jobs.claim_jobs", side_effect=flaky_claim_jobs)
+
+    work(app, batch_size=10, poll_interval=0.01, stop=threading.Event(), burst=True)
+
+    assert calls == [{"number": 1}]
+    logger.assert_called_once()
+
+
+def test_failed_jobs_are_retried_with_backoff(
+    app: Flask, db: SQLAlchemy, calls: list[dict[str, Any]]
+) -> None:
+    enqueue("test.fail")
+    db.session.commit()
+
+    (job,) = claim_jobs("worker", 1)
+
+    assert not run_job(job)
+
+    stored_job = Job.query.one()
+
+    assert not stored_job.failed
+    assert stored_job.locked_until is None
+    assert "RuntimeError: nope" in stored_job.last_error
+    assert stored_job.run_at > datetime.utcnow()
+
+    # Not due yet
+    assert claim_jobs("worker", 1) == []
+
+
+def test_jobs_fail_after_max_attempts(
+    app: Flask, db: SQLAlchemy, calls: list[dict[str, Any]]
+) -> None:
+    app.config["JOB_MAX_ATTEMPTS"] = 1
+
+    enqueue("test.fail")
+    db.session.commit()
+
+    (job,) = claim_jobs("worker", 1)
+
+    run_job(job)
+
+    assert Job.query.one().failed
+
+
+def test_retry_delay_backs_off_exponentially(app: Flask) -> None:
+    app.config["JOB_RETRY_BACKOFF_SECONDS"] = 2
+    app.config["JOB_RETRY_BACKOFF_MAX_SECONDS"] = 10
+
+    assert retry_delay(1) == timedelta(seconds=2)
+    assert retry_delay(2) == timedelta(seconds=4)
+    assert retry_delay(3) == timedelta(seconds=8)
+    assert retry_delay(4) == timedelta(seconds=10)
+
+
+def test_expired_failed_jobs_are_deleted(
+    app: Flask, db: SQLAlchemy, calls: list[dict[str, Any]]
+) -> None:
+    app.config["JOB_FAILED_RETENTION_DAYS"] = 7
+
+    for days_ago in (8, 6):
+        job = enqueue("test.fail", days_ago=days_ago)
+        job.failed = True
+        job.run_at = datetime.utcnow() - timedelta(days=days_ago)
+
+    enqueue("test.record", days_ago=8).run_at = datetime.utcnow() - timedelta(days=8)
+    db.session.commit()
+
+    assert delete_expired_jobs() == 1
+
+    assert sorted((job.name, job.payload["days_ago"]) for job in Job.query) == [
+        ("test.fail", 6),
+        ("test.record", 8),
+    ]
+
+
+def test_workers_delete_expired_failed_jobs_when_idle(
+    app: Flask, db: SQLAlchemy, calls: list[dict[str, Any]]
+) -> None:
+    job = enqueue("test.fail")
+    job.failed = True
+    job.run_at = datetime.utcnow() - timedelta(days=31)
+    db.session.commit()
+
+    work(app, batch_size=10, poll_interval=0.01, stop=threading.Event(), burst=True)
+
+    assert Job.query.count() == 0
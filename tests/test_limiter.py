@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for adaptive concurrency limiting
+"""
+from http import HTTPStatus
+
+import pytest
+from flask import Flask, session
+from flask.testing import FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+
+from flaskr.limiter import AdaptiveLimit, concurrency_limiter, request_priority
+from tests.conftest import AuthActions
+from tests.helpers import create_user
+
+
+def make_limit(initial: float = 10) -> AdaptiveLimit:
+    """
+    Makes a limit with a latency target of one second.
+
+    Args:
+        initial: Initial limit.
+
+    Returns:
+        The limit.
+    """
+    return AdaptiveLimit(
+        initial=initial, minimum=2, maximum=12, latency_target=1, backoff=0.5
+    )
+
+
+def make_client(app: Flask) -> FlaskClient:
+    """
+    Makes a test client that tears down each request as soon as it is done, so that its slot is
+    released right away. The client fixture keeps the last request around instead.
+
+    Args:
+        app: initialized app
+
+    Returns:
+        Test client.
+    """
+    return app.test_client()
+
+
+def test_limit_admits_requests_up_to_their_share() -> None:
+    limit = make_limit()
+
+    assert all(limit.try_acquire(0.5) for _ in range(5))
+    assert not limit.try_acquire(0.5)
+    assert limit.try_acquire(1.0)
+
+
+def test_slow_requests_shrink_the_limit_once_per_target_latency() -> None:
+    limit = make_limit()
+
+    for _ in range(3):
+        limit.try_acquire(1.0)
+
+    limit.release(latency=2, failed=False, now=100)
+    limit.release(latency=2, failed=False, now=100.5)
+
+    assert limit.limit == 5
+    assert limit.decreases == 1
+
+    limit.release(latency=0, failed=True, now=101)
+
+    assert limit.limit == 2.5
+
+
+def test_requests_without_latency_only_count_failures() -> None:
+    limit = make_limit()
+
+    for _ in range(6):
+        limit.try_acquire(1.0)
+
+    limit.release(latency=None, failed=False, now=100)
+
+    assert limit.limit == 10
+
+    limit.release(latency=None, failed=True, now=100)
+
+    assert limit.limit == 5
+
+
+def test_slow_endpoints_dont_shrink_the_limit(app: Flask, db: SQLAlchemy) -> None:
+    # Every request counts as slow.
+    app.config["LIMITER_LATENCY_TARGET"] = 0
+
+    user, password = create_user()
+
+    client = make_client(app)
+
+    AuthActions(client).login(username=user.username, password=password)
+
+    limit = concurrency_limiter().limits["auth"]
+
+    assert limit.decreases == 0
+
+    client.get("/auth/logout")
+
+    assert limit.decreases == 1
+
+
+def test_limit_never_drops_below_its_minimum() -> None:
+    limit = make_limit(initial=3)
+
+    for now in range(5):
+        limit.try_acquire(1.0)
+        limit.release(latency=2, failed=False, now=now)
+
+    assert limit.limit == 2
+
+
+def test_fast_requests_grow_a_busy_limit() -> None:
+    limit = make_limit(initial=4)
+
+    limit.try_acquire(1.0)
+    limit.release(latency=0.1, failed=False, now=0)
+
+    assert limit.limit == 4
+
+    for _ in range(2):
+        limit.try_acquire(1.0)
+
+    limit.release(latency=0.1, failed=False, now=0)
+
+    assert limit.limit == 4.25
+
+
+@pytest.mark.parametrize(
+    ("method", "logged_in", "priority"),
+    (
+        ("GET", False, "anonymous_read"),
+        ("GET", True, "read"),
+        ("POST", False, "read"),
+        ("POST", True, "write"),
+    ),
+)
+def test_request_priority(
+    app: Flask, method: str, logged_in: bool, priority: str
+) -> None:
+    with app.test_request_context("/", method=method):
+        if logged_in:
+            session["user_id"] = 1
+
+        assert request_priority() == priority
+
+
+def test_busy_blueprints_shed_anonymous_reads_first(app: Flask, db: SQLAlchemy) -> None:
+    app.config["LIMITER_INITIAL_LIMIT"] = 10
+
+    client = make_client(app)
+    auth = AuthActions(client)
+
+    user, password = create_user()
+
+    # Take up most of the blog's limit, as if other requests were in flight.
+    client.get("/create")
+
+    limit = concurrency_limiter().limits["blog"]
+    limit.in_flight = 7
+
+    response = client.get("/tags")
+
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert response.headers["Retry-After"] == "1"
+
+    auth.login(username=user.username, password=password)
+
+    assert client.get("/tags").status_code == HTTPStatus.OK
+    assert limit.in_flight == 7
+
+
+def test_metrics_export_decisions(app: Flask, db: SQLAlchemy) -> None:
+    app.config["LIMITER_INITIAL_LIMIT"] = 1
+    app.config["METRICS_ENABLED"] = True
+
+    client = make_client(app)
+
+    client.get("/tags")
+
+    concurrency_limiter().limits["blog"].in_flight = 1
+
+    client.get("/tags")
+
+    metrics = client.get("/metrics")
+
+    assert metrics.mimetype == "text/plain"
+
+    text = metrics.get_data(as_text=True)
+
+    assert (
+        'flaskr_limiter_requests_total{blueprint="blog",priority="anonymous_read",'
+        'decision="admitted"} 1' in text
+    )
+    assert (
+        'flaskr_limiter_requests_total{blueprint="blog",priority="anonymous_read",'
+        'decision="shed"} 1' in text
+    )
+    assert 'flaskr_limiter_in_flight{blueprint="blog"} 1' in text
+    assert 'flaskr_request_latency_seconds_count{endpoint="blog.tags"} 1' in text
+
+
+def test_metrics_are_not_found_unless_enabled(app: Flask) -> None:
+    assert make_client(app).get("/metrics").status_code == HTTPStatus.NOT_FOUND
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the live stream of post changes
+"""
+from typing import Iterator, cast
+
+from flask import Flask
+from flask.testing import FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+from pytest_mock import MockerFixture
+
+from flaskr.invalidation import RESET, ChangeEvent
+from flaskr.live import ChangeStream, change_stream, stream_events
+from tests.conftest import AuthActions
+from tests.helpers import create_user
+
+
+def test_streams_new_changes() -> None:
+    stream = ChangeStream(history_size=10)
+
+    events = stream_events(stream, None, heartbeat=0.01, max_pending=10)
+
+    assert next(events) == "retry: 10\n\n"
+    assert next(events) == ": keep-alive\n\n"
+
+    stream.handle_change(ChangeEvent("post", 1, "created"))
+
+    assert next(events) == (
+        f"id: {stream.stream_id}-1\n"
+        "event: post\n"
+        'data: {"id": 1, "action": "created"}\n\n'
+    )
+
+
+def test_loads_each_post_once_for_all_clients(mocker: MockerFixture) -> None:
+    load_post = mocker.Mock(return_value={"title": "changed"})
+
+    stream = ChangeStream(history_size=10, load_post=load_post)
+
+    clients = [
+        stream_events(stream, None, heartbeat=0.01, max_pending=10) for _ in range(3)
+    ]
+
+    for events in clients:
+        next(events)
+
+    stream.handle_change(ChangeEvent("post", 1, "updated"))
+    stream.handle_change(ChangeEvent("post", 1, "deleted"))
+
+    for events in clients:
+        assert '"post": {"title": "changed"}' in next(events)
+        assert next(events).endswith('data: {"id": 1, "action": "deleted"}\n\n')
+
+    load_post.assert_called_once_with(1)
+
+
+def test_only_streams_created_updated_and_deleted_posts() -> None:
+    stream = ChangeStream(history_size=10)
+
+    stream.handle_change(ChangeEvent("post", 1, "commented"))
+    stream.handle_change(ChangeEvent("post", 1, "attached"))
+
+    assert stream.last_sequence == 0
+
+
+def test_resumes_from_last_event_id() -> None:
+    stream = ChangeStream(history_size=10)
+
+    for post_id in range(1, 4):
+        stream.handle_change(ChangeEvent("post", post_id, "created"))
+
+    events = stream_events(
+        stream, f"{stream.stream_id}-1", heartbeat=0.01, max_pending=10
+    )
+
+    next(events)
+
+    assert f"id: {stream.stream_id}-2\n" in next(events)
+    assert f"id: {stream.stream_id}-3\n" in next(events)
+
+
+def test_resets_clients_that_cant_be_resumed() -> None:
+    stream = ChangeStream(history_size=2)
+
+    for post_id in range(1, 5):
+        stream.handle_change(ChangeEvent("post", post_id, "created"))
+
+    for last_event_id in ("other-1", f"{stream.stream_id}-1", "nonsense"):
+        events = stream_events(stream, last_event_id, heartbeat=0.01, max_pending=10)
+
+        next(events)
+
+        assert "event: reset\n" in next(events)
+
+
+def test_bus_resets_reach_clients() -> None:
+    stream = ChangeStream(history_size=10)
+
+    events = stream_events(stream, None, heartbeat=0.01, max_pending=10)
+
+    next(events)
+
+    stream.handle_change(ChangeEvent("post", 0, RESET))
+
+    assert next(events) == f"id: {stream.stream_id}-1\nevent: reset\ndata: {{}}\n\n"
+
+
+def test_disconnects_slow_clients() -> None:
+    stream = ChangeStream(history_size=10)
+
+    events = stream_events(stream, None, heartbeat=0.01, max_pending=2)
+
+    next(events)
+
+    for post_id in range(1, 4):
+        stream.handle_change(ChangeEvent("post", post_id, "created"))
+
+    assert "event: reset\n" in next(events)
+    assert next(events, None) is None
+
+
+def test_post_changes_reach_the_event_stream(
+    app: Flask, client: FlaskClient, db: SQLAlchemy, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    response = client.get("/events")
+
+    assert response.mimetype == "text/event-stream"
+
+    events = iter(cast(Iterator[bytes], response.response))
+
+    next(events)
+
+    client.post("/create", data={"title": "created", "body": ""})
+
+    event = next(events).decode()
+
+    assert "event: post\n" in event
+    assert '"action": "created"' in event
+    assert '"title": "created"' in event
+    assert f'"author_username": "{user.username}"' in event
+
+    assert change_stream().last_sequence == 1
+
+    response.close()
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for Markdown rendering
+"""
+from flaskr.markup import html_to_text, render_markdown
+
+
+def test_renders_markdown() -> None:
+    assert render_markdown("**bold**") == "<p><strong>bold</strong></p>"
+
+
+def test_strips_disallowed_markup() -> None:
+    rendered = render_markdown(
+        '<script>alert("hi")</script> [link](javascript:alert) <b onclick="x">b</b>'
+    )
+
+    assert "<script>" not in rendered
+    assert "javascript:" not in rendered
+    assert "onclick" not in rendered
+
+
+def test_html_to_text_drops_markup() -> None:
+    assert html_to_text("<h1>Fish &amp; chips</h1>") == "Fish & chips"
@@ -5,10 +5,14 @@ Tests for models
 from _pytest.monkeypatch import MonkeyPatch
 from faker import Faker
 from flask.testing import FlaskCliRunner
+from flask_sqlalchemy import SQLAlchemy
 from pytest_mock import MockerFixture
 from werkzeug.security import check_password_hash
 
-from flaskr.models import User
+from flaskr.invalidation import ChangeEvent, invalidation_bus
+from flaskr.markup import RENDERER_VERSION
+from flaskr.models import EXCERPT_LENGTH, Post, User, make_excerpt
+from tests.helpers import create_user
 
 
 def test_hashes_password(faker: Faker) -> None:
@@ -41,3 +45,70 @@ def test_init_db_command(
     assert "Initialized" in result.output
 
     fake_db.create_all.assert_called_once()
+
+
+def test_short_bodies_are_their_own_excerpt(faker: Faker) -> None:
+    body = faker.paragraph()
+
+    assert make_excerpt(body) == body
+
+
+def test_long_bodies_are_cut_at_a_word_boundary() -> None:
+    body = "word " * EXCERPT_LENGTH
+
+    excerpt = make_excerpt(body)
+
+    assert len(excerpt) <= EXCERPT_LENGTH + 1
+    assert excerpt.endswith("word…")
+
+
+def test_setting_body_sets_excerpt(faker: Faker) -> None:
+    post = Post(title=faker.sentence(), body="  body  ")
+
+    assert post.excerpt == "body"
+
+
+def test_setting_body_renders_markdown(faker: Faker) -> None:
+    post = Post(title=faker.sentence(), body="Some *emphasis*")
+
+    assert post.body_html == "<p>Some <em>emphasis</em></p>"
+    assert post.excerpt == "Some emphasis"
+    assert post.renderer_version == RENDERER_VERSION
+
+
+def test_rerender_posts_command(
+    faker: Faker, runner: FlaskCliRunner, db: SQLAlchemy, mocker: MockerFixture
+) -> None:
+    user, _ = create_user()
+
+    stale_post = Post(title=faker.sentence(), body="*stale*", author=user)
+    current_post = Post(title=faker.sentence(), body="*current*", author=user)
+
+    db.session.add_all([stale_post, current_post])
+    db.session.commit()
+
+    stale_post_id = stale_post.id
+
+    db.session.execute(
+        Post.__table__.update()
+        .where(Post.__table__.c.id == stale_post_id)
+        .values(body_html="old", renderer_version=RENDERER_VERSION - 1)
+    )
+    db.session.commit()
+
+    subscriber = mocker.Mock()
+
+    invalidation_bus().subscribe("post", subscriber)
+
+    result = runner.invoke(args=["rerender-posts", "--batch-size", "1"])
+
+    assert "Re-rendered 1 posts." in result.output
+
+    stale_post = Post.query.get(stale_post_id)
+
+    assert stale_post.body_html == "<p><em>stale</em></p>"
+    assert stale_post.renderer_version == RENDERER_VERSION
+    assert stale_post.updated is not None
+    assert stale_post.version == 1
+
+    subscriber.assert_called_once_with(ChangeEvent("post", stale_post_id, "updated"))
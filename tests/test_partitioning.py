@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for table partitioning helpers
+"""
+import os
+from collections.abc import Iterable
+from datetime import date, datetime
+
+import pytest
+from _pytest.tmpdir import TempPathFactory
+from flask import Flask
+from flask.testing import FlaskCliRunner
+from pytest_mock import MockerFixture
+from sqlalchemy import inspect, select, text
+from sqlalchemy.dialects.postgresql.base import PGDialect
+from sqlalchemy.schema import CreateTable
+
+from flaskr import create_app
+from flaskr.models import (
+    Attachment,
+    Comment,
+    Post,
+    PostStats,
+    Tag,
+    db,
+    maintain_post_partitions,
+    partitioned_post_metadata,
+    post_partitioning_enabled,
+    post_tag,
+)
+from flaskr.partitioning import (
+    add_months,
+    create_month_partitions,
+    detach_month_partitions,
+    list_partitions,
+    month_partition_name,
+    month_start,
+    parse_month_partition_name,
+)
+from flaskr.tags import set_post_tags
+from tests.helpers import create_user
+
+
+@pytest.fixture
+def postgres_app(tmp_path_factory: TempPathFactory) -> Iterable[Flask]:
+    """
+    Initialize app against the Postgres database in TEST_POSTGRES_URI, with partitioned posts.
+    Skips the test if no such database is configured.
+
+    Returns:
+        initialized app, with its tables created
+    """
+    database_uri = os.environ.get("TEST_POSTGRES_URI")
+
+    if not database_uri:
+        pytest.skip("TEST_POSTGRES_URI is not set.")
+
+    app = create_app(
+        {
+            "TESTING": True,
+            "SQLALCHEMY_DATABASE_URI": database_uri,
+            "FRONT_PAGE_REBUILD_DELAY": None,
+            "COUNTER_FLUSH_INTERVAL": None,
+            "ATTACHMENT_ROOT": str(tmp_path_factory.mktemp("attachments")),
+            "POST_PARTITIONING": True,
+        }
+    )
+
+    with app.app_context():
+        metadata = partitioned_post_metadata()
+        metadata.create_all(db.engine)
+
+        yield app
+
+        db.session.remove()
+
+        with db.engine.begin() as connection:
+            # Detached partitions and the tables archived with them.
+            for name in inspect(connection).get_table_names():
+                if parse_month_partition_name("post", name[: len("post_p0000_00")]):
+                    connection.execute(text(f'DROP TABLE "{name}" CASCADE'))
+
+        metadata.drop_all(db.engine)
+
+
+def add_post(created: datetime, tags: list[str]) -> Post:
+    """
+    Adds a post with a comment, an attachment and counts, created at a given time.
+
+    Args:
+        created: Creation time of the post.
+        tags: Names of the tags to file the post under.
+
+    Returns:
+        The post.
+    """
+    user, _ = create_user()
+
+    post = Post(author=user, title="title", body="body", created=created)
+
+    db.session.add(post)
+    db.session.flush()
+
+    set_post_tags(post.id, tags)
+
+    db.session.add_all(
+        [
+            Comment(post_id=post.id, author_id=user.id, body="comment", path="x/"),
+            Attachment(
+                post_id=post.id,
+                filename="a.txt",
+                content_type="text/plain",
+                size=1,
+                sha256="0" * 64,
+                storage_key=f"key{post.id}",
+            ),
+            PostStats(post_id=post.id, views=3, likes=1),
+        ]
+    )
+    db.session.commit()
+
+    return post
+
+
+def test_month_start() -> None:
+    assert month_start(datetime(2022, 3, 17, 12, 30)) == date(2022, 3, 1)
+
+
+def test_add_months_wraps_years() -> None:
+    assert add_months(date(2022, 11, 1), 3) == date(2023, 2, 1)
+    assert add_months(date(2022, 2, 1), -3) == date(2021, 11, 1)
+
+
+def test_month_partition_names_round_trip() -> None:
+    name = month_partition_name("post", date(2022, 3, 1))
+
+    assert name == "post_p2022_03"
+    assert parse_month_partition_name("post", name) == date(2022, 3, 1)
+    assert parse_month_partition_name("post", "post_default") is None
+
+
+def compile_create_table(table_name: str) -> str:
+    """
+    Compiles the CREATE TABLE statement of a table with partitioned posts, for Postgres.
+
+    Args:
+        table_name: Name of the table.
+
+    Returns:
+        The DDL.
+    """
+    return str(
+        CreateTable(partitioned_post_metadata().tables[table_name]).compile(
+            dialect=PGDialect()
+        )
+    )
+
+
+def test_partitioned_metadata_emits_partitioned_post_table() -> None:
+    ddl = compile_create_table("post")
+
+    assert "id SERIAL NOT NULL" in ddl
+    assert "PRIMARY KEY (id, created)" in ddl
+    assert "PARTITION BY RANGE (created)" in ddl
+
+    # The table the ORM uses is left alone.
+    assert list(db.metadata.tables["post"].primary_key.columns.keys()) == ["id"]
+
+
+def test_partitioned_metadata_keeps_foreign_keys_that_carry_the_key() -> None:
+    assert (
+        "FOREIGN KEY(post_id, post_created) REFERENCES post (id, created) "
+        "ON DELETE CASCADE" in compile_create_table("post_tag")
+    )
+    assert "REFERENCES post" not in compile_create_table("comment")
+    assert "REFERENCES post" not in compile_create_table("attachment")
+    assert "REFERENCES post" in str(
+        CreateTable(db.metadata.tables["comment"]).compile(dialect=PGDialect())
+    )
+
+
+def test_detach_month_partitions_prepares_each_partition_first(
+    mocker: MockerFixture,
+) -> None:
+    mocker.patch(
+        "flaskr.partitioning.list_partitions",
+        return_value=["post_default", "post_p2022_01", "post_p2022_02"],
+    )
+
+    statements: list[str] = []
+
+    connection = mocker.MagicMock()
+    connection.execute.side_effect = lambda statement: statements.append(str(statement))
+
+    detached = detach_month_partitions(
+        connection,
+        "post",
+        date(2022, 2, 1),
+        before_detach=lambda _, name: statements.append(f"prepare {name}"),
+    )
+
+    assert detached == ["post_p2022_01"]
+    assert statements == [
+        "prepare post_p2022_01",
+        'ALTER TABLE "post" DETACH PARTITION "post_p2022_01"',
+    ]
+
+
+def test_partitioning_is_not_enabled_on_sqlite(app: Flask) -> None:
+    app.config["POST_PARTITIONING"] = True
+
+    assert not post_partitioning_enabled()
+
+
+def test_maintain_post_partitions_command_without_partitioning(
+    runner: FlaskCliRunner,
+) -> None:
+    result = runner.invoke(args=["maintain-post-partitions"])
+
+    assert "Post partitioning is not enabled." in result.output
+
+
+def test_maintain_post_partitions_creates_upcoming_months(postgres_app: Flask) -> None:
+    current_month = month_start(date.today())
+
+    created, detached = maintain_post_partitions(
+        premake_months=2, retention_months=None
+    )
+
+    assert created == [
+        month_partition_name("post", add_months(current_month, offset))
+        for offset in range(3)
+    ]
+    assert detached == []
+    assert maintain_post_partitions(premake_months=2, retention_months=None) == (
+        [],
+        [],
+    )
+
+    with db.engine.connect() as connection:
+        assert "post_default" in list_partitions(connection, "post")
+
+
+def test_creating_a_month_moves_its_posts_out_of_the_default_partition(
+    postgres_app: Flask,
+) -> None:
+    next_month = add_months(month_start(date.today()), 1)
+
+    maintain_post_partitions(premake_months=0, retention_months=None)
+
+    early_post_id = add_post(
+        datetime(next_month.year, next_month.month, 10), ["python"]
+    ).id
+    db.session.commit()
+
+    assert db.session.execute(text("SELECT id FROM post_default")).scalars().all() == [
+        early_post_id
+    ]
+
+    # Creating a partition waits for every transaction that read posts.
+    db.session.commit()
+
+    created, _ = maintain_post_partitions(premake_months=1, retention_months=None)
+
+    partition_name = month_partition_name("post", next_month)
+
+    assert created == [partition_name]
+    assert db.session.execute(text("SELECT id FROM post_default")).all() == []
+    assert db.session.execute(
+        text(f'SELECT id FROM "{partition_name}"')
+    ).scalars().all() == [early_post_id]
+    assert db.session.execute(select(post_tag.c.post_id)).scalars().all() == [
+        early_post_id
+    ]
+    assert db.session.execute(select(Tag.post_count)).scalar_one() == 1
+
+
+def test_detaching_archives_what_belongs_to_old_posts(postgres_app: Flask) -> None:
+    old_month = add_months(month_start(date.today()), -24)
+
+    maintain_post_partitions(premake_months=0, retention_months=None)
+
+    with db.engine.begin() as connection:
+        create_month_partitions(connection, "post", old_month, 1)
+
+    old_post_id = add_post(datetime(old_month.year, old_month.month, 10), ["python"]).id
+    new_post_id = add_post(datetime.now(), ["python"]).id
+
+    # Detaching waits for every transaction that read posts.
+    db.session.commit()
+
+    _, detached = maintain_post_partitions(premake_months=0, retention_months=12)
+
+    partition_name = month_partition_name("post", old_month)
+
+    assert detached == [partition_name]
+    assert db.session.execute(select(Post.id)).scalars().all() == [new_post_id]
+    assert db.session.execute(select(Tag.post_count)).scalar_one() == 1
+
+    for table in (post_tag, Comment.__table__, Attachment.__table__):
+        assert db.session.execute(select(table.c.post_id)).scalars().all() == [
+            new_post_id
+        ]
+
+        assert db.session.execute(
+            text(f'SELECT post_id FROM "{partition_name}_{table.name}"')
+        ).scalars().all() == [old_post_id]
+
+    # Post tags still have their foreign key, so deleting a post removes them.
+    db.session.delete(db.session.get(Post, new_post_id))
+    db.session.commit()
+
+    assert db.session.execute(select(post_tag.c.post_id)).all() == []
+
+
+def test_deleting_a_partitioned_post_deletes_what_belongs_to_it(
+    postgres_app: Flask,
+) -> None:
+    maintain_post_partitions(premake_months=0, retention_months=None)
+
+    post = add_post(datetime.now(), ["python"])
+
+    client = postgres_app.test_client()
+
+    with client.session_transaction() as session:
+        session["user_id"] = post.author_id
+
+    client.post(f"/{post.id}/delete")
+
+    assert db.session.execute(select(Post.id)).all() == []
+    assert db.session.execute(select(Tag.post_count)).scalar_one() == 0
+
+    for table in (post_tag, Comment.__table__, Attachment.__table__):
+        assert db.session.execute(select(table.c.post_id)).all() == []
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the query cache regions
+"""
+import threading
+from datetime import datetime
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+
+from flaskr.auth import find_login_user
+from flaskr.invalidation import publish
+from flaskr.models import Post, User
+from flaskr.querycache import CacheRegion
+from tests.conftest import AuthActions
+from tests.helpers import create_user
+
+
+class FakeClock:
+    """
+    Clock that only moves when told to.
+    """
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_entries_expire_after_their_ttl() -> None:
+    clock = FakeClock()
+    region = CacheRegion("test", ttl=10, max_size=10, clock=clock)
+
+    assert region.get_or_load("key", lambda: "old") == "old"
+
+    clock.now = 9
+
+    assert region.get_or_load("key", lambda: "new") == "old"
+
+    clock.now = 10
+
+    assert region.get_or_load("key", lambda: "new") == "new"
+
+
+def test_least_recently_used_entries_are_evicted() -> None:
+    region = CacheRegion("test", ttl=10, max_size=2)
+
+    region.get_or_load(1, lambda: "a")
+    region.get_or_load(2, lambda: "b")
+    region.get_or_load(1, lambda: "unused")
+    region.get_or_load(3, lambda: "c")
+
+    assert len(region) == 2
+    assert region.get_or_load(1, lambda: "reloaded") == "a"
+    assert region.get_or_load(2, lambda: "reloaded") == "reloaded"
+
+
+def test_invalidating_a_tag_drops_its_entries() -> None:
+    region = CacheRegion("test", ttl=10, max_size=10)
+
+    region.get_or_load("one", lambda: 1, tags=[("post", 1)])
+    region.get_or_load("two", lambda: 2, tags=[("post", 2)])
+    region.get_or_load("all", lambda: 3, tags=["post"])
+
+    region.invalidate("post", ("post", 1))
+
+    assert region.get_or_load("one", lambda: None) is None
+    assert region.get_or_load("two", lambda: None) == 2
+    assert region.get_or_load("all", lambda: None) is None
+
+
+def test_missing_results_are_not_cached() -> None:
+    region = CacheRegion("test", ttl=10, max_size=10)
+
+    assert region.get_or_load("key", lambda: None) is None
+    assert region.get_or_load("key", lambda: "found") == "found"
+
+
+def test_concurrent_misses_run_one_load() -> None:
+    region = CacheRegion("test", ttl=10, max_size=10)
+
+    release = threading.Event()
+    loads = []
+    results = []
+
+    def load() -> str:
+        loads.append(1)
+        release.wait()
+
+        return "value"
+
+    threads = [
+        threading.Thread(target=lambda: results.append(region.get_or_load("key", load)))
+        for _ in range(10)
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    # Gives the waiting threads time to pile up behind the first one.
+    threading.Event().wait(0.1)
+
+    release.set()
+
+    for thread in threads:
+        thread.join()
+
+    assert len(loads) == 1
+    assert results == ["value"] * 10
+
+
+def test_failed_loads_are_raised_and_not_cached() -> None:
+    region = CacheRegion("test", ttl=10, max_size=10)
+
+    def fail() -> str:
+        raise RuntimeError("down")
+
+    with pytest.raises(RuntimeError):
+        region.get_or_load("key", fail)
+
+    assert region.get_or_load("key", lambda: "value") == "value"
+
+
+def test_loads_overtaken_by_an_invalidation_are_not_cached() -> None:
+    region = CacheRegion("test", ttl=10, max_size=10)
+
+    def load() -> str:
+        region.invalidate(("post", 1))
+
+        return "stale"
+
+    assert region.get_or_load("key", load, tags=[("post", 1)]) == "stale"
+    assert region.get_or_load("key", lambda: "fresh") == "fresh"
+
+
+def test_login_lookups_are_dropped_when_the_user_changes(db: SQLAlchemy) -> None:
+    user, _ = create_user()
+
+    user_id, username = user.id, user.username
+
+    db.session.commit()
+
+    login_user = find_login_user(username)
+
+    assert login_user is not None
+    assert login_user.id == user_id
+
+    User.query.filter_by(id=user_id).update({"username": "renamed"})
+    db.session.commit()
+
+    assert find_login_user(username) is not None
+
+    publish("user", user_id, "updated")
+    db.session.commit()
+
+    assert find_login_user(username) is None
+
+
+def test_post_list_pages_are_dropped_when_posts_change(
+    app: Flask, db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    app.config["POSTS_PER_PAGE"] = 1
+
+    user, password = create_user()
+
+    db.session.add_all(
+        Post(title=f"day {day}", body="", author=user, created=datetime(2022, 1, day))
+        for day in range(1, 3)
+    )
+    db.session.commit()
+
+    older = "/?before=2022-01-02T00:00:00_2"
+
+    assert b"day 1" in client.get(older).data
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/1/update", data={"title": "renamed", "body": ""})
+
+    assert b"renamed" in client.get(older).data
+
+
+def test_edit_form_is_cached_until_the_post_changes(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/create", data={"title": "post", "body": "", "tags": "a"})
+
+    assert b'value="post"' in client.get("/1/update").data
+
+    Post.query.filter_by(id=1).update({"title": "behind the cache"})
+    db.session.commit()
+
+    assert b'value="post"' in client.get("/1/update").data
+
+    publish("post", 1, "updated")
+    db.session.commit()
+
+    assert b'value="behind the cache"' in client.get("/1/update").data
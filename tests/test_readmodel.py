@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the read model and the JSON API built on it
+"""
+from datetime import datetime
+from http import HTTPStatus
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+
+from flaskr.counters import post_counters
+from flaskr.models import Post, PostCursor
+from flaskr.readmodel import PostRow, list_feed_posts, list_posts, listed_posts_select
+from flaskr.tags import set_post_tags
+from tests.helpers import create_user
+
+
+def test_list_posts_returns_plain_rows(db: SQLAlchemy) -> None:
+    user, _ = create_user()
+
+    post = Post(title="post", body="Some *text*", author=user)
+
+    db.session.add(post)
+    db.session.flush()
+
+    set_post_tags(post.id, ["b", "a"])
+
+    db.session.commit()
+
+    (row,) = list_posts(10)
+
+    assert row == PostRow(
+        id=post.id,
+        title="post",
+        excerpt="Some text",
+        created=post.created,
+        author_id=user.id,
+        author_username=user.username,
+        comment_count=0,
+        tags=("a", "b"),
+    )
+
+    with pytest.raises(AttributeError):
+        row.title = "changed"  # type: ignore[misc]
+
+
+def test_list_posts_leaves_view_and_like_counts_out() -> None:
+    assert "post_stats" not in str(listed_posts_select())
+
+
+def test_list_posts_pages_newest_first(db: SQLAlchemy) -> None:
+    user, _ = create_user()
+
+    db.session.add_all(
+        Post(title=f"day {day}", body="", author=user, created=datetime(2022, 1, day))
+        for day in range(1, 4)
+    )
+    db.session.commit()
+
+    first_page = list_posts(2)
+
+    assert [row.title for row in first_page] == ["day 3", "day 2"]
+
+    second_page = list_posts(2, first_page[-1].cursor)
+
+    assert [row.title for row in second_page] == ["day 1"]
+
+
+def test_list_feed_posts_filters_by_author(db: SQLAlchemy) -> None:
+    author, _ = create_user()
+    other, _ = create_user()
+
+    db.session.add_all(
+        [
+            Post(title="mine", body="**bold**", author=author),
+            Post(title="theirs", body="", author=other),
+        ]
+    )
+    db.session.commit()
+
+    (row,) = list_feed_posts(author_id=author.id, limit=10)
+
+    assert row.title == "mine"
+    assert row.body_html == "<p><strong>bold</strong></p>"
+    assert row.author_username == author.username
+    assert row.cursor == PostCursor(created=row.created, id=row.id)
+
+
+def test_api_lists_posts(app: Flask, db: SQLAlchemy, client: FlaskClient) -> None:
+    app.config["POSTS_PER_PAGE"] = 1
+
+    user, _ = create_user()
+
+    db.session.add_all(
+        Post(title=f"day {day}", body="", author=user, created=datetime(2022, 1, day))
+        for day in range(1, 3)
+    )
+    db.session.commit()
+
+    counters = post_counters()
+    counters.increment(2, "views", 2)
+    counters.flush()
+
+    response = client.get("/api/posts")
+
+    assert response.json == {
+        "posts": [
+            {
+                "id": 2,
+                "title": "day 2",
+                "excerpt": "",
+                "created": "2022-01-02T00:00:00",
+                "author_id": user.id,
+                "author_username": user.username,
+                "comment_count": 0,
+                "views": 2,
+                "likes": 0,
+                "tags": [],
+            }
+        ],
+        "next": "2022-01-02T00:00:00_2",
+    }
+
+    older = client.get(f"/api/posts?before={response.json['next']}")
+
+    assert older.json is not None
+    assert [post["title"] for post in older.json["posts"]] == ["day 1"]
+    assert older.json["next"] is None
+
+
+def test_api_filters_by_tag(db: SQLAlchemy, client: FlaskClient) -> None:
+    user, _ = create_user()
+
+    posts = [
+        Post(title="tagged", body="", author=user),
+        Post(title="plain", body="", author=user),
+    ]
+
+    db.session.add_all(posts)
+    db.session.flush()
+
+    set_post_tags(posts[0].id, ["news"])
+
+    db.session.commit()
+
+    response = client.get("/api/posts?tag=news")
+
+    assert response.json is not None
+    assert [post["title"] for post in response.json["posts"]] == ["tagged"]
+    assert client.get("/api/posts?tag=nope").status_code == HTTPStatus.NOT_FOUND
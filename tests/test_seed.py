@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for bulk seeding and the post factory
+"""
+from http import HTTPStatus
+
+from flask.testing import FlaskCliRunner, FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, select
+
+from flaskr.models import Post, User
+from flaskr.seed import SeedResult, seed_database
+from tests.conftest import AuthActions
+from tests.factories import PostFactory
+from tests.helpers import create_user
+
+
+def get_posts() -> list[tuple]:
+    """
+    Reads the seeded columns of every post.
+
+    Returns:
+        Author ID, title, body and creation time of each post, in ID order.
+    """
+    return [
+        (post.author_id, post.title, post.body, post.created)
+        for post in Post.query.order_by(Post.id)
+    ]
+
+
+def test_seeded_fixture_adds_users_and_posts(seeded: SeedResult) -> None:
+    assert seeded == SeedResult(users=20, posts=200)
+    assert User.query.count() == 20
+    assert Post.query.count() == 200
+
+
+def test_seeding_is_deterministic(db: SQLAlchemy) -> None:
+    seed_database(users=5, posts=30, seed=7)
+
+    first = get_posts()
+
+    db.session.execute(Post.__table__.delete())
+    db.session.execute(User.__table__.delete())
+    db.session.commit()
+
+    seed_database(users=5, posts=30, seed=7)
+
+    assert get_posts() == first
+
+
+def test_seeding_adds_to_existing_users(db: SQLAlchemy) -> None:
+    user, _ = create_user()
+
+    db.session.commit()
+
+    seed_database(users=3, posts=10)
+
+    assert User.query.count() == 4
+    assert db.session.execute(select(func.max(User.id))).scalar() == user.id + 3
+    assert Post.query.filter_by(author_id=user.id).count() == 0
+
+
+def test_seeded_users_can_log_in(
+    seeded: SeedResult, client: FlaskClient, auth: AuthActions
+) -> None:
+    user = User.query.first()
+
+    response = auth.login(username=user.username, password="password")
+
+    assert response.status_code == HTTPStatus.FOUND
+
+    with client.session_transaction() as session:
+        assert session["user_id"] == user.id
+
+
+def test_seed_db_command(db: SQLAlchemy, runner: FlaskCliRunner) -> None:
+    result = runner.invoke(args=["seed-db", "--users", "2", "--posts", "5"])
+
+    assert "Added 2 users and 5 posts" in result.output
+    assert Post.query.count() == 5
+
+
+def test_post_factory_creates_a_post_with_an_author(db: SQLAlchemy) -> None:
+    post = PostFactory()
+
+    assert post.author.id is not None
+    assert post.title
+    assert post.body_html.startswith("<p>")
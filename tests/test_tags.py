@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for post tags
+"""
+from datetime import datetime
+from http import HTTPStatus
+from typing import Any
+
+from flask import Flask
+from flask.testing import FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+from pytest_mock import MockerFixture
+from sqlalchemy import event
+
+from flaskr import blog
+from flaskr.models import Post, Tag
+from flaskr.readmodel import list_posts
+from flaskr.tags import MAX_TAGS, parse_tags, set_post_tags
+from tests.conftest import AuthActions
+from tests.helpers import create_user
+
+
+def get_post_counts() -> dict[str, int]:
+    """
+    Reads the stored post count of every tag.
+
+    Returns:
+        Post counts, by tag name.
+    """
+    return {tag.name: tag.post_count for tag in Tag.query.all()}
+
+
+def test_parse_tags_normalizes_names() -> None:
+    assert parse_tags(" Python,  web   dev ,python,, ") == ["python", "web dev"]
+
+
+def test_parse_tags_caps_number_of_tags() -> None:
+    tags = ",".join(f"tag{number}" for number in range(MAX_TAGS + 5))
+
+    assert len(parse_tags(tags)) == MAX_TAGS
+
+
+def test_creating_a_post_counts_its_tags(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/create", data={"title": "first", "body": "", "tags": "a, b"})
+    client.post("/create", data={"title": "second", "body": "", "tags": "b"})
+
+    assert get_post_counts() == {"a": 1, "b": 2}
+    assert [tag.name for tag in Post.query.get(1).tags] == ["a", "b"]
+
+
+def test_updating_a_post_adjusts_tag_counts(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/create", data={"title": "post", "body": "", "tags": "a, b"})
+
+    response = client.post(
+        "/1/update", data={"title": "post", "body": "", "tags": "b, c"}
+    )
+
+    assert response.status_code == HTTPStatus.FOUND
+    assert get_post_counts() == {"a": 0, "b": 1, "c": 1}
+
+
+def test_updating_without_tags_field_keeps_tags(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/create", data={"title": "post", "body": "", "tags": "a"})
+    client.post("/1/update", data={"title": "renamed", "body": ""})
+
+    assert get_post_counts() == {"a": 1}
+
+
+def test_deleting_a_post_adjusts_tag_counts(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/create", data={"title": "post", "body": "", "tags": "a"})
+    client.post("/1/delete")
+
+    assert get_post_counts() == {"a": 0}
+
+
+def test_delete_adjusts_counts_of_tags_changed_before_the_lock(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions, mocker: MockerFixture
+) -> None:
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/create", data={"title": "post", "body": "", "tags": "a"})
+
+    lock_owned_post = blog.lock_owned_post
+
+    def lock_after_concurrent_update(conditions: list[Any]) -> bool:
+        # Stands in for an update that commits while the delete waits for the lock.
+        set_post_tags(1, ["b"])
+        db.session.commit()
+
+        return lock_owned_post(conditions)
+
+    mocker.patch(
+        "flaskr.blog.lock_owned_post", side_effect=lock_after_concurrent_update
+    )
+
+    client.post("/1/delete")
+
+    assert Post.query.count() == 0
+    assert get_post_counts() == {"a": 0, "b": 0}
+
+
+def test_missed_delete_keeps_tag_counts(
+    db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    auth.login(username=user.username, password=password)
+
+    client.post("/create", data={"title": "post", "body": "", "tags": "a"})
+    client.post("/1/delete", data={"version": "42"})
+
+    assert Post.query.count() == 1
+    assert get_post_counts() == {"a": 1}
+
+
+def test_tagged_listing_pages_through_posts_with_the_tag(
+    app: Flask, db: SQLAlchemy, client: FlaskClient
+) -> None:
+    app.config["POSTS_PER_PAGE"] = 2
+
+    user, _ = create_user()
+
+    for day in range(1, 6):
+        post = Post(
+            title=f"post {day}", body="", author=user, created=datetime(2022, 1, day)
+        )
+
+        db.session.add(post)
+        db.session.flush()
+
+        set_post_tags(post.id, ["odd" if day % 2 else "even"])
+
+    db.session.commit()
+
+    response = client.get("/tags/odd")
+
+    assert b"post 5" in response.data
+    assert b"post 3" in response.data
+    assert b"post 4" not in response.data
+    assert b"3 posts" in response.data
+
+    older = client.get("/tags/odd?before=2022-01-03T00:00:00_3")
+
+    assert b"post 1" in older.data
+    assert b"post 3" not in older.data
+    assert b"Older posts" not in older.data
+
+
+def test_tagged_listing_of_unknown_tag_is_not_found(
+    db: SQLAlchemy, client: FlaskClient
+) -> None:
+    assert client.get("/tags/nope").status_code == HTTPStatus.NOT_FOUND
+
+
+def test_tags_page_lists_tags_by_popularity(
+    db: SQLAlchemy, client: FlaskClient
+) -> None:
+    user, _ = create_user()
+
+    for tags in (["common", "rare"], ["common"]):
+        post = Post(title="post", body="", author=user)
+
+        db.session.add(post)
+        db.session.flush()
+
+        set_post_tags(post.id, tags)
+
+    db.session.commit()
+
+    response = client.get("/tags")
+
+    assert response.data.index(b"common") < response.data.index(b"rare")
+
+
+def test_list_posts_loads_tags_of_a_page_in_one_query(db: SQLAlchemy) -> None:
+    user, _ = create_user()
+
+    for number in range(5):
+        post = Post(title=f"post {number}", body="", author=user)
+
+        db.session.add(post)
+        db.session.flush()
+
+        set_post_tags(post.id, [f"tag {number}", "shared"])
+
+    db.session.commit()
+    db.session.expunge_all()
+
+    statements: list[str] = []
+
+    def record(*args: Any) -> None:
+        statements.append(args[2])
+
+    event.listen(db.engine, "before_cursor_execute", record)
+
+    try:
+        posts = list_posts(10)
+
+        assert all(len(post.tags) == 2 for post in posts)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+    assert len(statements) == 2
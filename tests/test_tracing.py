@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for request tracing
+"""
+import json
+from collections.abc import Iterable
+from http import HTTPStatus
+from typing import Any
+
+import pytest
+from _pytest.tmpdir import TempPathFactory
+from flask import Flask
+from flask.testing import FlaskClient
+from flask_sqlalchemy import SQLAlchemy
+
+from flaskr import create_app
+from flaskr.limiter import concurrency_limiter
+from flaskr.tracing import (
+    BatchSpanProcessor,
+    JsonFileExporter,
+    MemoryExporter,
+    TraceParent,
+    parse_traceparent,
+    tracer,
+)
+from tests.conftest import AuthActions
+from tests.helpers import create_user
+
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+@pytest.fixture
+def app(tmp_path_factory: TempPathFactory) -> Iterable[Flask]:
+    """
+    Initialize app with test config and tracing of every request into memory.
+
+    Returns:
+        initialized app, ready for use
+    """
+    db_path = tmp_path_factory.mktemp("test_db") / "test_db.sqlite"
+
+    app = create_app(
+        {
+            "TESTING": True,
+            "SQLALCHEMY_DATABASE_URI": f"sqlite:////{db_path}",
+            "FRONT_PAGE_REBUILD_DELAY": None,
+            "COUNTER_FLUSH_INTERVAL": None,
+            "TRACING_EXPORTER": MemoryExporter(),
+            "TRACING_SAMPLE_RATE": 1.0,
+            "TRACING_EXPORT_INTERVAL": None,
+            "ATTACHMENT_ROOT": str(tmp_path_factory.mktemp("attachments")),
+        }
+    )
+
+    with app.app_context():
+        yield app
+
+
+def exported_spans(app: Flask) -> list[dict[str, Any]]:
+    """
+    Exports the queued spans and returns everything exported so far.
+
+    Args:
+        app: initialized app
+
+    Returns:
+        Exported spans, in the order they finished.
+    """
+    tracer().processor.flush()
+
+    return list(app.config["TRACING_EXPORTER"].spans)
+
+
+def test_requests_are_traced_through_view_template_and_sql(
+    app: Flask, db: SQLAlchemy
+) -> None:
+    with app.test_client() as client:
+        client.get("/tags")
+
+    spans = exported_spans(app)
+    by_name = {span["name"]: span for span in spans}
+
+    request_span = by_name["GET /tags"]
+    view_span = by_name["view blog.tags"]
+    render_span = by_name["render blog/tags.html"]
+    sql_spans = [span for span in spans if span["name"] == "sql"]
+
+    assert request_span["parent_id"] is None
+    assert request_span["attributes"]["http.status_code"] == 200
+    assert view_span["parent_id"] == request_span["span_id"]
+    assert render_span["parent_id"] == view_span["span_id"]
+    assert sql_spans
+    assert all(span["parent_id"] == view_span["span_id"] for span in sql_spans)
+    assert {span["trace_id"] for span in spans} == {request_span["trace_id"]}
+    assert all(span["end"] >= span["start"] for span in spans)
+
+
+def test_incoming_trace_context_is_continued(app: Flask, db: SQLAlchemy) -> None:
+    with app.test_client() as client:
+        response = client.get(
+            "/tags", headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"}
+        )
+
+    (request_span,) = [
+        span for span in exported_spans(app) if span["name"] == "GET /tags"
+    ]
+
+    assert request_span["trace_id"] == TRACE_ID
+    assert request_span["parent_id"] == PARENT_ID
+    assert (
+        response.headers["traceresponse"]
+        == f"00-{TRACE_ID}-{request_span['span_id']}-01"
+    )
+
+
+def test_callers_sampling_decision_is_followed(app: Flask, db: SQLAlchemy) -> None:
+    with app.test_client() as client:
+        response = client.get(
+            "/tags", headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-00"}
+        )
+
+    assert exported_spans(app) == []
+    assert response.headers["traceresponse"].endswith("-00")
+
+
+def test_unsampled_requests_export_nothing(app: Flask, db: SQLAlchemy) -> None:
+    app.config["TRACING_SAMPLE_RATE"] = 0.0
+
+    with app.test_client() as client:
+        client.get("/tags")
+
+    assert exported_spans(app) == []
+
+
+def test_password_checks_are_traced(
+    app: Flask, db: SQLAlchemy, client: FlaskClient, auth: AuthActions
+) -> None:
+    user, password = create_user()
+
+    db.session.commit()
+
+    auth.login(username=user.username, password=password)
+
+    names = [span["name"] for span in exported_spans(app)]
+
+    assert "check_password" in names
+    assert "view auth.login" in names
+
+
+def test_full_queue_drops_spans(app: Flask, db: SQLAlchemy) -> None:
+    app.config["TRACING_MAX_QUEUE_SIZE"] = 1
+
+    processor = tracer().processor = BatchSpanProcessor(
+        app, app.config["TRACING_EXPORTER"]
+    )
+
+    with app.test_client() as client:
+        client.get("/tags")
+
+    assert processor.dropped > 0
+    assert len(exported_spans(app)) == 1
+
+
+def test_json_file_exporter_appends_lines(tmp_path_factory: TempPathFactory) -> None:
+    path = tmp_path_factory.mktemp("traces") / "traces.jsonl"
+
+    exporter = JsonFileExporter(str(path))
+    exporter.export([{"name": "a"}])
+    exporter.export([{"name": "b"}, {"name": "c"}])
+
+    lines = path.read_text().splitlines()
+
+    assert [json.loads(line)["name"] for line in lines] == ["a", "b", "c"]
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    (
+        (f"00-{TRACE_ID}-{PARENT_ID}-01", TraceParent(TRACE_ID, PARENT_ID, True)),
+        (f"00-{TRACE_ID}-{PARENT_ID}-00", TraceParent(TRACE_ID, PARENT_ID, False)),
+        (f"00-{'0' * 32}-{PARENT_ID}-01", None),
+        (f"00-{TRACE_ID}-{'0' * 16}-01", None),
+        (f"00-{TRACE_ID.upper()}-{PARENT_ID}-01", None),
+        ("garbage", None),
+        (None, None),
+    ),
+)
+def test_parse_traceparent(value: str, expected: TraceParent) -> None:
+    assert parse_traceparent(value) == expected
+
+
+def test_shed_requests_are_not_traced(app: Flask, db: SQLAlchemy) -> None:
+    app.config["LIMITER_INITIAL_LIMIT"] = 10
+
+    client = app.test_client()
+    client.get("/tags")
+
+    # Take up most of the blog's limit, as if other requests were in flight.
+    concurrency_limiter().limits["blog"].in_flight = 7
+
+    response = client.get("/tags")
+
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert [
+        span["name"] for span in exported_spans(app) if span["parent_id"] is None
+    ] == ["GET /tags"]